@@ -9,6 +9,9 @@ import { HistoryScreen } from './components/HistoryScreen';
 import { ProfileScreen } from './components/ProfileScreen';
 import { apiService } from './services/api';
 
+// Intervalo do heartbeat do WebSocket (o servidor derruba após 60s sem sinal)
+const HEARTBEAT_INTERVAL_MS = 20000;
+
 const App: React.FC = () => {
   const [session, setSession] = useState<AuthSession | null>(null);
   const [activeTab, setActiveTab] = useState<AppTab>(AppTab.HOME);
@@ -112,11 +115,41 @@ const App: React.FC = () => {
       console.log('Connecting to WebSocket:', wsUrl);
       const ws = new WebSocket(wsUrl);
 
-      ws.onopen = () => console.log('✅ WebSocket Connected');
+      // Sinal de vida periódico, e também a resposta ao PING do servidor
+      const isCourier = session.user.role === UserRole.COURIER;
+      const sendHeartbeat = () => {
+        if (ws.readyState !== WebSocket.OPEN) return;
+        ws.send(isCourier ? JSON.stringify({ type: 'HEARTBEAT' }) : 'ping');
+      };
+      let heartbeat: ReturnType<typeof setInterval> | undefined;
+
+      ws.onopen = () => {
+        console.log('✅ WebSocket Connected');
+        heartbeat = setInterval(sendHeartbeat, HEARTBEAT_INTERVAL_MS);
+      };
       ws.onmessage = (event) => {
+        // Resposta do restaurante ao 'ping' vem como texto puro
+        if (event.data === 'pong') return;
         const data = JSON.parse(event.data);
         console.log('📩 WebSocket Message:', data);
+
+        if (data.type === 'PING') {
+          sendHeartbeat();
+          return;
+        }
         
+        if (data.type === 'ORDER_WITHDRAWN') {
+          // Oferta expirou ou foi para outro motoboy: tira o card antes que ele tente aceitar
+          setDeliveries(prev => prev.filter(d => !(d.id === data.order_id && d.status === DeliveryStatus.SEARCHING)));
+          return;
+        }
+
+        if (data.type === 'RESYNC_REQUIRED') {
+          // Mensagens perdidas durante a queda: recarrega a lista inteira
+          fetchDeliveries();
+          return;
+        }
+
         if (data.type === 'NEW_ORDER' || data.type === 'ORDER_UPDATE') {
           fetchDeliveries();
           // Som sonoro ou notificação visual poderia ser disparada aqui
@@ -127,6 +160,7 @@ const App: React.FC = () => {
       };
       ws.onclose = () => {
         console.log('❌ WebSocket Disconnected. Retrying...');
+        clearInterval(heartbeat);
         socketRef.current = null;
         setTimeout(connectWebSocket, 3000);
       };
@@ -0,0 +1,179 @@
+"""
+Barramento de mensagens entre workers.
+
+WebSocket connections and running dispatches live in one worker each. When a
+message or a courier response reaches a worker that does not hold the target,
+it is published on the bus so the worker that does can deliver it. ``publish``
+only reaches the *other* workers: callers always serve the local worker
+directly and fall back to the bus on a miss, so nothing is delivered twice.
+
+Two implementations are provided: ``InMemoryBus`` (a single process; buses
+sharing a hub behave like separate workers, which tests use) and
+``PostgresBus`` on ``LISTEN/NOTIFY``. ``MESSAGE_BUS=postgres`` selects the
+latter, using the same ``DATABASE_URL`` as the application.
+"""
+import abc
+import asyncio
+import inspect
+import json
+import logging
+import os
+import uuid
+from typing import Any, Callable, Dict, List, Optional, Set
+
+from backend.encoding import dumps
+
+logger = logging.getLogger("telego.bus")
+
+Handler = Callable[[dict], Any]
+
+
+class MessageBus(abc.ABC):
+    def __init__(self):
+        self.node_id = uuid.uuid4().hex
+        self._handlers: Dict[str, List[Handler]] = {}
+        self._start_listeners: List[Callable[[], Any]] = []
+        self._tasks: Set[asyncio.Task] = set()
+
+    def subscribe(self, channel: str, handler: Handler):
+        """Registers a handler (sync or async) for messages from other workers."""
+        self._handlers.setdefault(channel, []).append(handler)
+
+    def on_start(self, listener: Callable[[], Any]):
+        """Calls ``listener()`` each time the bus (re)connects, e.g. to resync state."""
+        self._start_listeners.append(listener)
+
+    def _started(self):
+        for listener in self._start_listeners:
+            listener()
+
+    @abc.abstractmethod
+    async def publish(self, channel: str, payload: dict):
+        """Sends ``payload`` to the subscribers of ``channel`` on the other workers."""
+
+    def publish_nowait(self, channel: str, payload: dict):
+        """Publishes from synchronous code; the send runs in the background."""
+        self._spawn(self.publish(channel, payload))
+
+    def _spawn(self, coro):
+        task = asyncio.get_running_loop().create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _deliver(self, channel: str, payload: dict):
+        for handler in self._handlers.get(channel, ()):
+            try:
+                result = handler(payload)
+                if inspect.isawaitable(result):
+                    await result
+            except Exception:
+                logger.exception("Erro ao processar mensagem do barramento", extra={"channel": channel})
+
+    async def start(self):
+        self._started()
+
+    async def stop(self):
+        tasks = list(self._tasks)
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+class InMemoryBus(MessageBus):
+    """Bus for a single process; buses created on the same hub reach each other."""
+
+    def __init__(self, hub: Optional[List["InMemoryBus"]] = None):
+        super().__init__()
+        self.hub = hub if hub is not None else []
+        self.hub.append(self)
+
+    async def publish(self, channel: str, payload: dict):
+        for peer in list(self.hub):
+            if peer is not self:
+                await peer._deliver(channel, payload)
+
+
+class PostgresBus(MessageBus):
+    """
+    Bus on Postgres ``LISTEN/NOTIFY``. Payloads must stay under the 8000-byte
+    NOTIFY limit; messages published while the connection is down are dropped.
+    """
+
+    def __init__(self, dsn: str, ssl: bool = False, reconnect_delay: float = 1.0):
+        super().__init__()
+        self.dsn = dsn
+        self.ssl = ssl
+        self.reconnect_delay = reconnect_delay
+        self._conn = None
+        self._listening: Set[str] = set()
+        self._closing = False
+
+    def subscribe(self, channel: str, handler: Handler):
+        super().subscribe(channel, handler)
+        if self._conn is not None and channel not in self._listening:
+            self._spawn(self._listen(channel))
+
+    async def _listen(self, channel: str):
+        await self._conn.add_listener(channel, self._on_notify)
+        self._listening.add(channel)
+
+    async def start(self):
+        import asyncpg
+
+        self._closing = False
+        self._conn = await asyncpg.connect(self.dsn, ssl=self.ssl or None)
+        self._conn.add_termination_listener(self._on_terminated)
+        self._listening.clear()
+        for channel in self._handlers:
+            await self._listen(channel)
+        logger.info("Barramento Postgres conectado", extra={"channels": len(self._listening)})
+        # Mensagens perdidas enquanto estava desconectado: quem escuta se ressincroniza
+        self._started()
+
+    def _on_terminated(self, conn):
+        self._conn = None
+        if not self._closing:
+            logger.warning("Conexão do barramento caiu; reconectando")
+            self._spawn(self._reconnect())
+
+    async def _reconnect(self):
+        while not self._closing and self._conn is None:
+            await asyncio.sleep(self.reconnect_delay)
+            try:
+                await self.start()
+            except Exception:
+                logger.warning("Erro ao reconectar o barramento", exc_info=True)
+
+    def _on_notify(self, conn, pid, channel, raw):
+        message = json.loads(raw)
+        if message.get("origin") == self.node_id:
+            return
+        self._spawn(self._deliver(channel, message["payload"]))
+
+    async def publish(self, channel: str, payload: dict):
+        if self._conn is None:
+            logger.warning(
+                "Barramento desconectado; mensagem descartada", extra={"channel": channel, "sample": 100}
+            )
+            return
+        raw = dumps({"origin": self.node_id, "payload": payload}).decode("utf-8")
+        await self._conn.execute("SELECT pg_notify($1, $2)", channel, raw)
+
+    async def stop(self):
+        self._closing = True
+        await super().stop()
+        if self._conn is not None:
+            await self._conn.close()
+            self._conn = None
+
+
+def create_bus() -> MessageBus:
+    """Builds the bus selected by ``MESSAGE_BUS`` (memory or postgres)."""
+    kind = os.getenv("MESSAGE_BUS", "memory").lower()
+    if kind == "postgres":
+        dsn = os.getenv("DATABASE_URL", "")
+        # asyncpg usa a URL sem o sufixo de driver do SQLAlchemy
+        dsn = dsn.replace("postgresql+asyncpg://", "postgresql://", 1)
+        return PostgresBus(dsn, ssl=dsn.startswith("postgres"))
+    return InMemoryBus()
+
+
+bus = create_bus()
@@ -1,12 +1,13 @@
+import logging
 import os
-import os
-
-SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL")
-
-print("DATABASE_URL RAW =>", repr(SQLALCHEMY_DATABASE_URL))
+import time
 
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
 from sqlalchemy.orm import declarative_base
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from backend.metrics import metrics
 
 SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///./telego.db")
 
@@ -14,11 +15,31 @@ SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///./teleg
 if SQLALCHEMY_DATABASE_URL.startswith("postgresql://"):
     SQLALCHEMY_DATABASE_URL = SQLALCHEMY_DATABASE_URL.replace("postgresql://", "postgresql+asyncpg://", 1)
 
+logger = logging.getLogger("telego.db")
+# Sem a senha: a URL crua ia parar nos logs
+logger.info("Banco de dados configurado", extra={"url": make_url(SQLALCHEMY_DATABASE_URL).render_as_string(hide_password=True)})
+
+POOL_WAIT = metrics.histogram(
+    "telego_db_pool_wait_seconds", "Time spent waiting for a connection from the pool.",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0, 30.0),
+)
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """Pool padrão do engine assíncrono, medindo a espera por uma conexão."""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            POOL_WAIT.observe(time.perf_counter() - started)
+
 engine = create_async_engine(
     SQLALCHEMY_DATABASE_URL,
     echo=False,
     connect_args={"ssl": True} if SQLALCHEMY_DATABASE_URL.startswith("postgresql") else {},
     pool_pre_ping=True,
+    poolclass=TimedQueuePool,
 )
 
 SessionLocal = async_sessionmaker(
@@ -31,6 +52,26 @@ SessionLocal = async_sessionmaker(
 
 Base = declarative_base()
 
+def pool_status() -> dict:
+    """Ocupação atual do pool de conexões do engine."""
+    pool = engine.pool
+    status = {"pool": type(pool).__name__}
+    for name in ("size", "checkedin", "checkedout", "overflow"):
+        value = getattr(pool, name, None)
+        if callable(value):
+            status[name] = value()
+    return status
+
+metrics.gauge(
+    "telego_db_pool_checked_out", "Connections currently checked out of the pool.",
+    callback=lambda: engine.pool.checkedout(),
+)
+metrics.gauge(
+    "telego_db_pool_overflow", "Connections open beyond the pool size (negative while below it).",
+    callback=lambda: engine.pool.overflow(),
+)
+metrics.gauge("telego_db_pool_size", "Configured pool size.", callback=lambda: engine.pool.size())
+
 async def get_db():
     async with SessionLocal() as db:
         yield db
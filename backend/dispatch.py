@@ -1,157 +1,713 @@
 import asyncio
 import datetime
+import itertools
+import logging
+import os
+import time
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import and_, exists, literal, or_, update
 from sqlalchemy.future import select
 from sqlalchemy.orm import selectinload
-from geopy.distance import geodesic
-from backend import models
+from backend import ledger, models
+from backend.bus import bus
 from backend.db import SessionLocal
+from backend.metrics import metrics
 from backend.websocket_manager import manager  # 🔥 NOVA IMPORTACAO
+from backend.registry import courier_registry
+from backend.reservations import reservations
+from backend.spatial import courier_index
+from backend.timing_wheel import Timer, TimingWheel
 
-# This is a simplified in-memory store for pending offers and events.
-# In a real-world application, you'd use a more robust solution like Redis.
-courier_responses = {}
+logger = logging.getLogger("telego.dispatch")
 
-async def get_available_couriers(db: AsyncSession):
-    """Fetches all available couriers from the database."""
-    stmt = select(models.Courier).where(models.Courier.available == 1)
+# Métricas do dispatch (/metrics)
+TIME_TO_ASSIGN = metrics.histogram(
+    "telego_dispatch_time_to_assign_seconds", "Time from the start of a dispatch until a courier accepts.",
+    buckets=(1, 5, 10, 20, 30, 60, 120, 300, 600),
+)
+ATTEMPTS = metrics.histogram(
+    "telego_dispatch_attempts", "Offer attempts of an order when its dispatch finishes.",
+    buckets=(1, 2, 3, 4, 5, 7, 10, 15, 20),
+)
+OFFER_RESPONSE = metrics.histogram(
+    "telego_dispatch_offer_response_seconds", "Time for a courier to answer an offer.", ("outcome",),
+    buckets=(0.5, 1, 2, 5, 10, 15, 20, 30),
+)
+OUTCOMES = metrics.counter("telego_dispatch_outcomes_total", "Finished dispatches by final status.", ("status",))
+
+# Ofertas abertas por pedido: {order_id: {courier_id, ...}}
+open_offers: Dict[int, Set[int]] = {}
+
+# "sequential" oferece a um motoboy por vez; "parallel" oferece em ondas
+# para os K mais próximos e o primeiro aceite vence; "batch" agrupa os
+# pedidos em janelas e resolve a atribuição global (backend.matching).
+DISPATCH_STRATEGY = os.getenv("DISPATCH_STRATEGY", "sequential")
+
+OFFER_TIMEOUT_SECONDS = 20.0
+RADII = [1, 2, 3, 5, 10]
+
+# Folga da reserva além do prazo da oferta
+LEASE_GRACE_SECONDS = 5.0
+
+# Motoboys sem WebSocket aberto não recebem ofertas (evita esperar o timeout à toa)
+SKIP_OFFLINE_COURIERS = os.getenv("DISPATCH_SKIP_OFFLINE", "1") == "1"
+
+
+class Wave(NamedTuple):
+    radius_km: float
+    size: int
+    timeout: float
+
+
+# Each wave widens the radius and offers to more couriers at once
+PARALLEL_WAVES = [
+    Wave(radius_km=2, size=3, timeout=15.0),
+    Wave(radius_km=5, size=5, timeout=15.0),
+    Wave(radius_km=10, size=10, timeout=20.0),
+]
+
+def offers_for_courier(courier_id: int) -> List[int]:
+    """Ids of the orders currently offered to a courier."""
+    return [order_id for order_id, couriers in open_offers.items() if courier_id in couriers]
+
+# Canal das respostas de motoboys para dispatches que rodam em outro worker
+RESPONSES_CHANNEL = "telego_dispatch_responses"
+
+def _respond_locally(order_id: int, courier_id: int, accepted: bool) -> bool:
+    if not dispatcher.owns(order_id):
+        return False
+    if not accepted:
+        pending = open_offers.get(order_id)
+        if pending is not None:
+            pending.discard(courier_id)
+        reservations.release(courier_id, order_id)
+    return dispatcher.signal(order_id, courier_id, accepted)
+
+def _on_remote_response(payload: dict):
+    _respond_locally(payload["order_id"], payload["courier_id"], payload["accepted"])
+
+def signal_response(order_id: int, courier_id: int, accepted: bool):
+    """
+    Queues a courier response for the dispatch state machine, forwarding it
+    over the bus when the dispatch runs in another worker.
+    """
+    if not _respond_locally(order_id, courier_id, accepted):
+        bus.publish_nowait(RESPONSES_CHANNEL, {"order_id": order_id, "courier_id": courier_id, "accepted": accepted})
+
+def decline_offer(order_id: int, courier_id: int):
+    """Removes a courier from an open offer and wakes the dispatch."""
+    signal_response(order_id, courier_id, False)
+
+def _holds_offer(courier_id: int, now: datetime.datetime):
+    """
+    SQL condition: the courier holds an open offer for the order - it is the
+    current candidate or is listed in the ledger wave - and its deadline has
+    not passed.
+    """
+    entry = models.DispatchLedger
+    in_wave = exists().where(
+        entry.order_id == models.Order.id,
+        entry.deadline > now,
+        # Lista "1,2,3": as vírgulas nas pontas evitam que 1 case com 12
+        (literal(",") + entry.candidate_courier_ids + ",").contains(f",{courier_id},"),
+    )
+    expired = exists().where(entry.order_id == models.Order.id, entry.deadline <= now)
+    return or_(and_(models.Order.current_candidate_courier_id == courier_id, ~expired), in_wave)
+
+async def claim_order(db: AsyncSession, order_id: int, courier_id: int) -> bool:
+    """
+    Atomically assigns a searching order to a courier holding an open offer.
+    Returns False when another courier already won the order or the courier's
+    offer expired or was withdrawn in the meantime.
+    """
+    stmt = (
+        update(models.Order)
+        .where(
+            models.Order.id == order_id,
+            models.Order.status == "SEARCHING",
+            _holds_offer(courier_id, datetime.datetime.utcnow()),
+        )
+        .values(status="ASSIGNED", courier_id=courier_id, current_candidate_courier_id=courier_id)
+    )
     result = await db.execute(stmt)
-    return result.scalars().all()
+    await db.commit()
+    return result.rowcount == 1
+
+def _offerable(courier_id: int, tried: Set[int]) -> bool:
+    if courier_id in tried or reservations.is_reserved(courier_id):
+        return False
+    return not SKIP_OFFLINE_COURIERS or manager.presence.is_courier_online(courier_id)
+
+def _sequential_waves(lat: float, lng: float, tried: Set[int]) -> Iterator[Tuple[List[int], float]]:
+    # One grid query and one sort split the candidates into every radius tier
+    for nearby_couriers in courier_index.tiers(lat, lng, RADII):
+        for courier_id in nearby_couriers:
+            if _offerable(courier_id, tried):
+                yield [courier_id], OFFER_TIMEOUT_SECONDS
+
+def _parallel_waves(lat: float, lng: float, tried: Set[int]) -> Iterator[Tuple[List[int], float]]:
+    for wave in PARALLEL_WAVES:
+        # Consulta o índice a cada onda para pegar posições atualizadas
+        nearby = courier_index.within(lat, lng, wave.radius_km)
+        candidates = [
+            courier_id for courier_id, _ in nearby if _offerable(courier_id, tried)
+        ][:wave.size]
+        if candidates:
+            yield candidates, wave.timeout
 
-def filter_couriers_by_distance(couriers, lat, lng, radius_km):
-    """Filters a list of couriers by their distance to a point."""
-    nearby_couriers = []
-    for courier in couriers:
-        distance = geodesic((lat, lng), (courier.lat, courier.lng)).kilometers
-        if distance <= radius_km:
-            nearby_couriers.append((courier, distance))
 
-    nearby_couriers.sort(key=lambda x: x[1])
-    return [courier for courier, distance in nearby_couriers]
+def _offer_payload(order: models.Order, restaurant: models.Restaurant, timeout: float, attempt_count: int) -> dict:
+    # Preparamos os dados no formato que o frontend espera (Delivery interface)
+    return {
+        "id": order.id,
+        "restaurantId": restaurant.id,
+        "restaurantName": restaurant.name,
+        "customerName": order.customer_name or "Cliente TeleGo",
+        "pickupAddress": order.pickup_address or f"{restaurant.name} (Loja)",
+        "pickupCoords": [restaurant.lat, restaurant.lng],
+        "deliveryAddress": order.delivery_address or "Endereço de Entrega",
+        "deliveryCoords": [restaurant.lat - 0.005, restaurant.lng - 0.005],
+        "price": order.price,
+        "orderValue": order.order_value,
+        "status": "SEARCHING",
+        "createdAt": datetime.datetime.now().isoformat(),
+        "attempt_count": attempt_count,
+        "message": f"📦 Novo pedido de {restaurant.name}",
+        "timeout_seconds": int(timeout),
+        "action_required": True
+    }
 
-async def dispatch_order(order_id: int, session_local=None):
+async def _send_offers(order_id: int, courier_ids: List[int], order_data: dict):
+    # 🔥🔥🔥 NOTIFICAR VIA WEBSOCKET 🔥🔥🔥
+    for courier_id in courier_ids:
+        try:
+            websocket_notified = await manager.send_to_courier(courier_id, order_data)
+            if websocket_notified:
+                logger.debug("Oferta enviada por WebSocket", extra={"order_id": order_id, "courier_id": courier_id})
+            else:
+                logger.debug(
+                    "Motoboy não conectado neste worker (barramento/polling)",
+                    extra={"order_id": order_id, "courier_id": courier_id},
+                )
+        except Exception:
+            logger.exception("Erro ao enviar oferta", extra={"order_id": order_id, "courier_id": courier_id})
+
+async def _withdraw(courier_ids: Iterable[int], order_id: int, reason: str):
+    for courier_id in courier_ids:
+        try:
+            await manager.withdraw_offer(courier_id, order_id, reason)
+        except Exception:
+            logger.exception("Erro ao retirar oferta", extra={"order_id": order_id, "courier_id": courier_id})
+
+
+def _settle(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+# Estados do dispatch de um pedido
+LOADING = "LOADING"
+OFFERING = "OFFERING"
+WAITING = "WAITING"
+RESOLVING = "RESOLVING"
+FINISHING = "FINISHING"
+
+
+class OrderDispatch:
+    """Dispatch state of one order; advanced only by the engine's driver."""
+    __slots__ = (
+        "order_id", "session_factory", "strategy", "state", "order", "restaurant",
+        "waves", "tried", "pending", "reserved", "resume", "timer", "expired", "signalled",
+        "finish_when_exhausted", "done", "first_offer", "started", "offered_at", "attempts",
+    )
+
+    def __init__(self, order_id, session_factory, strategy, tried, resume, waves, finish_when_exhausted, done):
+        self.order_id = order_id
+        self.session_factory = session_factory
+        self.strategy = strategy
+        self.state = LOADING
+        self.order = None
+        self.restaurant = None
+        self.waves = waves
+        self.tried: Set[int] = set(tried)
+        self.pending: Set[int] = set()
+        self.reserved: Set[int] = set()
+        self.resume = resume
+        self.timer: Optional[Timer] = None
+        self.expired = False
+        self.signalled = False
+        self.finish_when_exhausted = finish_when_exhausted
+        self.done: asyncio.Future = done
+        # Resolve quando a primeira oferta sai (ou o dispatch termina antes disso)
+        self.first_offer: asyncio.Future = done.get_loop().create_future()
+        self.started = 0.0
+        self.offered_at: Optional[float] = None
+        self.attempts = 0
+
+
+class DispatchEngine:
     """
-    Manages the sequential dispatch of an order to nearby couriers.
-    Accepts an optional session_local for testing purposes.
+    Explicit per-order dispatch state machine driven by a single task.
+
+    offer -> waiting -> (accept | decline | timeout) -> next wave, until the
+    order is assigned or the plan runs out. Offer deadlines live in a
+    hierarchical timing wheel and courier responses arrive through an event
+    queue, so a pending offer costs one small record instead of a coroutine,
+    an Event and a loop timer. Database work for a transition runs as a short
+    step task that posts its result back to the queue.
+
+    ``clock`` is injectable (defaults to time.monotonic) so tests can move
+    time forward instead of waiting for real offer timeouts.
     """
-    use_session = session_local or SessionLocal
-    async with use_session() as db:
-        # Carrega o pedido com o restaurante associado
-        stmt = select(models.Order).where(models.Order.id == order_id)
-        result = await db.execute(stmt)
-        order = result.scalars().first()
-
-        if not order:
-            print(f"❌ Pedido {order_id} não encontrado")
-            return
-            
-        if order.status != "SEARCHING":
-            print(f"⚠️ Pedido {order_id} já está com status {order.status}")
+
+    def __init__(self, clock: Callable[[], float] = time.monotonic, tick: float = 0.05):
+        self.clock = clock
+        self.tick = tick
+        self._wheel = TimingWheel(tick=tick, start=clock())
+        self._events: Optional[asyncio.Queue] = None
+        self._orders: Dict[int, OrderDispatch] = {}
+        self._driver: Optional[asyncio.Task] = None
+        self._tasks: Set[asyncio.Task] = set()
+
+    def __len__(self) -> int:
+        return len(self._orders)
+
+    def __contains__(self, order_id: int) -> bool:
+        return order_id in self._orders
+
+    def submit(
+        self,
+        order_id: int,
+        session_factory=None,
+        strategy: str = None,
+        tried: Iterable[int] = (),
+        resume: Optional[Tuple[List[int], float]] = None,
+        waves: Optional[Iterable[Tuple[List[int], float]]] = None,
+        finish_when_exhausted: bool = True,
+    ) -> asyncio.Future:
+        """
+        Starts dispatching an order. The returned future resolves to the final
+        status (None when ``waves`` ran out and ``finish_when_exhausted`` is
+        False). Submitting an order that is already dispatching returns its
+        existing future.
+        """
+        self._ensure_driver()
+        existing = self._orders.get(order_id)
+        if existing is not None:
+            return existing.done
+        d = OrderDispatch(
+            order_id,
+            session_factory or SessionLocal,
+            strategy or DISPATCH_STRATEGY,
+            tried,
+            resume,
+            iter(waves) if waves is not None else None,
+            finish_when_exhausted,
+            asyncio.get_running_loop().create_future(),
+        )
+        d.started = self.clock()
+        self._orders[order_id] = d
+        d.done.add_done_callback(lambda done: self._abandon(d) if done.cancelled() else None)
+        d.done.add_done_callback(lambda done: _settle(d.first_offer))
+        self._step(d, self._load)
+        return d.done
+
+    def first_offer(self, order_id: int) -> Optional[asyncio.Future]:
+        """
+        Future that resolves once the order's first offer went out, or its
+        dispatch finished without one; None if the order is not dispatching.
+        """
+        d = self._orders.get(order_id)
+        return d.first_offer if d is not None else None
+
+    def owns(self, order_id: int) -> bool:
+        """True if this worker is running the dispatch of the order."""
+        return order_id in self._orders
+
+    def signal(self, order_id: int, courier_id: int, accepted: bool) -> bool:
+        if self._events is not None and order_id in self._orders:
+            self._events.put_nowait(("response", order_id, courier_id, accepted))
+            return True
+        return False
+
+    async def stop(self):
+        """Stops the driver and every step; ledger rows stay as checkpoints."""
+        if self._driver is not None:
+            self._driver.cancel()
+            await asyncio.gather(self._driver, return_exceptions=True)
+            self._driver = None
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for d in self._orders.values():
+            self._close_wave(d)
+            d.done.cancel()
+        self._orders.clear()
+        self._events = None
+
+    # -- driver -----------------------------------------------------------
+
+    def _ensure_driver(self):
+        loop = asyncio.get_running_loop()
+        if self._driver is not None and self._driver.get_loop() is not loop:
+            # Loop novo (ex.: entre testes): o estado do loop anterior não vale mais
+            self._driver = None
+            self._orders.clear()
+            self._tasks.clear()
+            self._wheel = TimingWheel(tick=self.tick, start=self.clock())
+        if self._driver is None or self._driver.done():
+            self._events = asyncio.Queue()
+            self._driver = asyncio.create_task(self._drive())
+
+    async def _drive(self):
+        while True:
+            timeout = self.tick if len(self._wheel) else None
+            try:
+                event = await asyncio.wait_for(self._events.get(), timeout)
+            except asyncio.TimeoutError:
+                event = None
+            if event is not None:
+                self._handle(event)
+                while not self._events.empty():
+                    self._handle(self._events.get_nowait())
+            for order_id in self._wheel.advance(self.clock()):
+                self._handle(("expire", order_id))
+
+    def _handle(self, event):
+        kind, order_id, *args = event
+        d = self._orders.get(order_id)
+        if d is None:
             return
+        try:
+            getattr(self, f"_on_{kind}")(d, *args)
+        except Exception as e:
+            self._fail(d, e)
+
+    def _step(self, d: OrderDispatch, step, *args):
+        task = asyncio.create_task(self._run_step(d, step, *args))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run_step(self, d: OrderDispatch, step, *args):
+        try:
+            event = await step(d, *args)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            event = ("failed", d.order_id, e)
+        if self._events is not None:
+            self._events.put_nowait(event)
+
+    def _background(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    # -- transitions ------------------------------------------------------
+
+    def _on_loaded(self, d: OrderDispatch, order, restaurant):
+        d.order = order
+        d.restaurant = restaurant
+        if d.waves is None:
+            plan = _parallel_waves if d.strategy == "parallel" else _sequential_waves
+            d.waves = plan(restaurant.lat, restaurant.lng, d.tried)
+        if d.resume is not None:
+            # Retoma a onda interrompida antes de seguir com o plano
+            d.waves = itertools.chain([d.resume], d.waves)
+        self._next_wave(d)
+
+    def _next_wave(self, d: OrderDispatch):
+        while True:
+            wave = next(d.waves, None)
+            if wave is None:
+                if d.finish_when_exhausted:
+                    d.state = FINISHING
+                    self._step(d, self._mark_no_courier_found)
+                else:
+                    self._finish(d, None)
+                return
+            courier_ids, timeout = wave
+            # Reserva antes de ofertar: quem já está com outro pedido fica de fora
+            courier_ids = [
+                courier_id for courier_id in courier_ids
+                if reservations.reserve(courier_id, d.order_id, timeout + LEASE_GRACE_SECONDS)
+            ]
+            if courier_ids:
+                break
+        d.reserved = set(courier_ids)
+        count_attempt = d.resume is None
+        d.resume = None
+        d.tried.update(courier_ids)
+        d.state = OFFERING
+        d.expired = False
+        d.signalled = False
+        self._step(d, self._record_offer, list(courier_ids), timeout, count_attempt)
+
+    def _on_offered(self, d: OrderDispatch, courier_ids: List[int], timeout: float, attempt_count: int):
+        d.state = WAITING
+        d.pending = set(courier_ids)
+        d.offered_at = self.clock()
+        d.attempts = attempt_count
+        open_offers[d.order_id] = d.pending
+        d.timer = self._wheel.schedule(self.clock() + timeout, d.order_id)
+        order_data = _offer_payload(d.order, d.restaurant, timeout, attempt_count)
+        self._background(_send_offers(d.order_id, courier_ids, order_data))
+        _settle(d.first_offer)
+        if d.signalled:
+            # A resposta chegou antes de a oferta terminar de ser registrada
+            self._resolve(d)
 
-        # Carrega o restaurante explicitamente para garantir que temos os dados
-        stmt_res = select(models.Restaurant).where(models.Restaurant.id == order.restaurant_id)
-        result_res = await db.execute(stmt_res)
-        restaurant = result_res.scalars().first()
-        
-        if not restaurant:
-            print(f"❌ Restaurante {order.restaurant_id} não encontrado para o pedido {order_id}")
+    def _on_response(self, d: OrderDispatch, courier_id: int, accepted: bool):
+        if d.offered_at is not None:
+            OFFER_RESPONSE.observe(self.clock() - d.offered_at, outcome="accepted" if accepted else "declined")
+        if d.state != WAITING:
+            d.signalled = True
             return
+        if accepted or not d.pending:
+            self._resolve(d)
+
+    def _on_expire(self, d: OrderDispatch):
+        d.timer = None
+        if d.state == WAITING:
+            d.expired = True
+            self._resolve(d)
+        elif d.state == RESOLVING:
+            d.expired = True
+
+    def _resolve(self, d: OrderDispatch):
+        d.state = RESOLVING
+        d.signalled = False
+        self._step(d, self._check_wave, d.expired or not d.pending)
+
+    def _on_waiting(self, d: OrderDispatch):
+        d.state = WAITING
+        if d.expired or d.signalled or not d.pending:
+            self._resolve(d)
+
+    def _on_wave_ended(self, d: OrderDispatch):
+        self._close_wave(d)
+        if d.pending:
+            self._background(_withdraw(list(d.pending), d.order_id, "EXPIRED"))
+        d.pending = set()
+        self._next_wave(d)
+
+    def _on_resolved(self, d: OrderDispatch, status: str, winner: Optional[int]):
+        self._close_wave(d)
+        losers = [courier_id for courier_id in d.pending if courier_id != winner]
+        if losers:
+            # Retira a oferta de quem não venceu
+            self._background(_withdraw(losers, d.order_id, status))
+        if status == "ASSIGNED" and d.restaurant is not None:
+            self._background(notify_assigned(d.order, d.restaurant))
+        self._finish(d, status)
+
+    def _on_finished(self, d: OrderDispatch, status: Optional[str]):
+        self._finish(d, status)
+
+    def _on_failed(self, d: OrderDispatch, error: Exception):
+        self._fail(d, error)
+
+    def _finish(self, d: OrderDispatch, status: Optional[str]):
+        self._orders.pop(d.order_id, None)
+        if status is not None:
+            OUTCOMES.inc(status=status)
+            ATTEMPTS.observe(d.attempts)
+            if status == "ASSIGNED":
+                TIME_TO_ASSIGN.observe(self.clock() - d.started)
+        if not d.done.done():
+            d.done.set_result(status)
+
+    def _close_wave(self, d: OrderDispatch):
+        open_offers.pop(d.order_id, None)
+        if d.timer is not None:
+            self._wheel.cancel(d.timer)
+            d.timer = None
+        for courier_id in d.reserved:
+            reservations.release(courier_id, d.order_id)
+        d.reserved = set()
+
+    def _abandon(self, d: OrderDispatch):
+        # Quem esperava pelo pedido desistiu: o ledger fica como checkpoint
+        if self._orders.get(d.order_id) is d:
+            del self._orders[d.order_id]
+            self._close_wave(d)
+
+    def _fail(self, d: OrderDispatch, error: Exception):
+        logger.error("Erro no dispatch", exc_info=error, extra={"order_id": d.order_id})
+        OUTCOMES.inc(status="FAILED")
+        self._close_wave(d)
+        self._orders.pop(d.order_id, None)
+        if not d.done.done():
+            d.done.set_exception(error)
+
+    # -- database steps ---------------------------------------------------
+    # Each step checks a session out only for its own short transaction.
+
+    async def _load(self, d: OrderDispatch):
+        async with d.session_factory() as db:
+            # Carrega o pedido com o restaurante associado
+            stmt = select(models.Order).where(models.Order.id == d.order_id)
+            result = await db.execute(stmt)
+            order = result.scalars().first()
 
-        # Fetch all couriers once
-        all_couriers = await get_available_couriers(db)
+            if not order:
+                logger.warning("Pedido não encontrado", extra={"order_id": d.order_id})
+                return ("finished", d.order_id, None)
 
-        radii = [1, 2, 3, 5, 10]
-        tried_couriers = set()
+            if order.status != "SEARCHING":
+                logger.info("Pedido já saiu de SEARCHING", extra={"order_id": d.order_id, "status": order.status})
+                return ("finished", d.order_id, order.status)
 
-        for radius in radii:
-            # Filter couriers in memory to avoid sync I/O in the DB transaction
-            nearby_couriers = filter_couriers_by_distance(all_couriers, restaurant.lat, restaurant.lng, radius)
+            # Carrega o restaurante explicitamente para garantir que temos os dados
+            stmt_res = select(models.Restaurant).where(models.Restaurant.id == order.restaurant_id)
+            result_res = await db.execute(stmt_res)
+            restaurant = result_res.scalars().first()
 
-            for courier in nearby_couriers:
-                if courier.id in tried_couriers:
-                    continue
+            if not restaurant:
+                logger.warning(
+                    "Restaurante do pedido não encontrado",
+                    extra={"order_id": d.order_id, "restaurant_id": order.restaurant_id},
+                )
+                return ("finished", d.order_id, None)
 
-                tried_couriers.add(courier.id)
+        # Os motoboys vêm do registro em memória, não do banco
+        await courier_registry.ensure_warm(d.session_factory)
+        return ("loaded", d.order_id, order, restaurant)
 
-                order.current_candidate_courier_id = courier.id
-                order.offer_sent_at = datetime.datetime.now(datetime.UTC)
-                order.attempt_count += 1
+    async def _record_offer(self, d: OrderDispatch, courier_ids: List[int], timeout: float, count_attempt: bool):
+        # Em ondas com um único motoboy ele fica registrado como candidato atual
+        candidate_id = courier_ids[0] if len(courier_ids) == 1 else None
+        async with d.session_factory() as db:
+            stmt = (
+                update(models.Order)
+                .where(models.Order.id == d.order_id, models.Order.status == "SEARCHING")
+                .values(
+                    current_candidate_courier_id=candidate_id,
+                    offer_sent_at=datetime.datetime.now(datetime.UTC),
+                    attempt_count=models.Order.attempt_count + (len(courier_ids) if count_attempt else 0),
+                )
+                .returning(models.Order.attempt_count)
+            )
+            attempt_count = (await db.execute(stmt)).scalar()
+            if attempt_count is None:
+                # O pedido foi aceito ou cancelado por fora antes da onda começar
+                status = (await db.execute(
+                    select(models.Order.status).where(models.Order.id == d.order_id)
+                )).scalar()
+                await ledger.remove(db, d.order_id)
                 await db.commit()
-                await db.refresh(order)
-
-                # 🔥🔥🔥 NOVO: NOTIFICAR VIA WEBSOCKET 🔥🔥🔥
-                try:
-                    # Preparamos os dados no formato que o frontend espera (Delivery interface)
-                    order_data = {
-                        "id": order.id,
-                        "restaurantId": restaurant.id,
-                        "restaurantName": restaurant.name,
-                        "customerName": order.customer_name or "Cliente TeleGo",
-                        "pickupAddress": order.pickup_address or f"{restaurant.name} (Loja)",
-                        "pickupCoords": [restaurant.lat, restaurant.lng],
-                        "deliveryAddress": order.delivery_address or "Endereço de Entrega",
-                        "deliveryCoords": [restaurant.lat - 0.005, restaurant.lng - 0.005],
-                        "price": order.price,
-                        "orderValue": order.order_value,
-                        "status": "SEARCHING",
-                        "createdAt": datetime.datetime.now().isoformat(),
-                        "attempt_count": order.attempt_count,
-                        "message": f"📦 Novo pedido de {restaurant.name}",
-                        "timeout_seconds": 20,
-                        "action_required": True
-                    }
-                    
-                    websocket_notified = await manager.send_to_courier(
-                        courier.id,
-                        order_data
-                    )
-                    
-                    if websocket_notified:
-                        print(f"✅ WebSocket: Pedido {order.id} enviado para motoboy {courier.id}")
-                    else:
-                        print(f"⚠️ WebSocket: Motoboy {courier.id} offline (usando polling)")
-                except Exception as e:
-                    print(f"❌ Erro WebSocket: {e}")
-                # 🔥🔥🔥 FIM DA NOTIFICAÇÃO WEBSOCKET 🔥🔥🔥
-
-                try:
-                    response_event = asyncio.Event()
-                    courier_responses[order.id] = response_event
-                    await asyncio.wait_for(response_event.wait(), timeout=20.0)
-                except asyncio.TimeoutError:
-                    order.current_candidate_courier_id = None
-                    await db.commit()
-                    continue
-                finally:
-                    courier_responses.pop(order.id, None)
-
-                await db.refresh(order)
-                if order.status == "ASSIGNED":
-                    # 🔥🔥🔥 NOVO: NOTIFICAR RESTAURANTE QUE PEDIDO FOI ACEITO 🔥🔥🔥
-                    try:
-                        await manager.notify_order_update(
-                            order.id, 
-                            "ASSIGNED", 
-                            f"restaurant_{restaurant.id}"
-                        )
-                        print(f"✅ Restaurante {restaurant.id} notificado: pedido {order.id} ACEITO")
-                    except Exception as e:
-                        print(f"❌ Erro ao notificar restaurante: {e}")
-                    # 🔥🔥🔥 FIM DA NOTIFICAÇÃO 🔥🔥🔥
-                    return
-
-        order.status = "NO_COURIER_FOUND"
-        # 🔥🔥🔥 NOVO: NOTIFICAR RESTAURANTE QUE NENHUM MOTOBOY ENCONTRADO 🔥🔥🔥
-        try:
-            await manager.notify_order_update(
-                order.id, 
-                "NO_COURIER_FOUND", 
-                f"restaurant_{restaurant.id}"
+                return ("resolved", d.order_id, status or "CANCELLED", None)
+            await ledger.record_offer(db, d.order_id, d.strategy, courier_ids, d.tried, timeout)
+            await db.commit()
+        return ("offered", d.order_id, courier_ids, timeout, attempt_count)
+
+    async def _check_wave(self, d: OrderDispatch, wave_over: bool):
+        async with d.session_factory() as db:
+            result = await db.execute(
+                select(models.Order.status, models.Order.courier_id).where(models.Order.id == d.order_id)
             )
-            print(f"⚠️ Restaurante {restaurant.id} notificado: NENHUM motoboy encontrado")
-        except Exception as e:
-            print(f"❌ Erro ao notificar restaurante: {e}")
-        # 🔥🔥🔥 FIM DA NOTIFICAÇÃO 🔥🔥🔥
-        
-        await db.commit()
\ No newline at end of file
+            row = result.first()
+            if row is None or row.status != "SEARCHING":
+                await ledger.remove(db, d.order_id)
+                await db.commit()
+                return ("resolved", d.order_id, row.status if row else "CANCELLED", row.courier_id if row else None)
+            if not wave_over:
+                return ("waiting", d.order_id)
+            await db.execute(
+                update(models.Order)
+                .where(models.Order.id == d.order_id, models.Order.status == "SEARCHING")
+                .values(current_candidate_courier_id=None)
+            )
+            await ledger.clear_offer(db, d.order_id)
+            await db.commit()
+        return ("wave_ended", d.order_id)
+
+    async def _mark_no_courier_found(self, d: OrderDispatch):
+        status = await mark_no_courier_found(d.session_factory, d.order, d.restaurant)
+        return ("finished", d.order_id, status)
+
+
+dispatcher = DispatchEngine()
+
+
+def start_dispatch(order_id: int, **kwargs) -> asyncio.Future:
+    """Submits an order to the dispatch engine without waiting for the outcome."""
+    done = dispatcher.submit(order_id, **kwargs)
+    done.add_done_callback(_on_dispatch_done)
+    return done
+
+def _on_dispatch_done(done: asyncio.Future):
+    if not done.cancelled() and done.exception() is not None:
+        logger.error("Erro no dispatch", exc_info=done.exception())
+
+async def drain(timeout: float = 5.0):
+    """
+    Stops the in-flight dispatches. Their ledger rows are left in place as
+    checkpoints and a recovery pass resumes them.
+    """
+    await asyncio.wait_for(dispatcher.stop(), timeout)
+
+async def dispatch_order(
+    order_id: int,
+    session_local=None,
+    strategy: str = None,
+    tried: Iterable[int] = (),
+    resume: Optional[Tuple[List[int], float]] = None,
+):
+    """
+    Dispatches an order to nearby couriers, either one courier at a time or in
+    parallel waves (see DISPATCH_STRATEGY), and waits for the final status.
+    Accepts an optional session_local for testing purposes.
+
+    ``tried`` and ``resume`` (the couriers still holding an offer and the
+    seconds left on it) continue a dispatch recovered from the ledger.
+    """
+    return await dispatcher.submit(order_id, session_local, strategy, tried, resume)
+
+async def notify_assigned(order: models.Order, restaurant: models.Restaurant):
+    # 🔥🔥🔥 NOVO: NOTIFICAR RESTAURANTE QUE PEDIDO FOI ACEITO 🔥🔥🔥
+    try:
+        await manager.notify_order_update(
+            order.id, 
+            "ASSIGNED", 
+            f"restaurant_{restaurant.id}"
+        )
+        logger.info("Pedido aceito; restaurante notificado", extra={"order_id": order.id, "restaurant_id": restaurant.id})
+    except Exception:
+        logger.exception("Erro ao notificar restaurante", extra={"order_id": order.id, "restaurant_id": restaurant.id})
+    # 🔥🔥🔥 FIM DA NOTIFICAÇÃO 🔥🔥🔥
+
+async def mark_no_courier_found(session_factory, order: models.Order, restaurant: models.Restaurant) -> Optional[str]:
+    """Marks the order NO_COURIER_FOUND unless it left SEARCHING meanwhile; returns the status set."""
+    async with session_factory() as db:
+        result = await db.execute(
+            update(models.Order)
+            .where(models.Order.id == order.id, models.Order.status == "SEARCHING")
+            .values(status="NO_COURIER_FOUND", current_candidate_courier_id=None)
+        )
+        await ledger.remove(db, order.id)
+        await db.commit()
+
+    if result.rowcount != 1:
+        # Aceito ou cancelado enquanto a última onda terminava
+        return None
+
+    # 🔥🔥🔥 NOVO: NOTIFICAR RESTAURANTE QUE NENHUM MOTOBOY ENCONTRADO 🔥🔥🔥
+    try:
+        await manager.notify_order_update(
+            order.id, 
+            "NO_COURIER_FOUND", 
+            f"restaurant_{restaurant.id}"
+        )
+        logger.info(
+            "Nenhum motoboy encontrado; restaurante notificado",
+            extra={"order_id": order.id, "restaurant_id": restaurant.id},
+        )
+    except Exception:
+        logger.exception("Erro ao notificar restaurante", extra={"order_id": order.id, "restaurant_id": restaurant.id})
+    # 🔥🔥🔥 FIM DA NOTIFICAÇÃO 🔥🔥🔥
+    return "NO_COURIER_FOUND"
+
+bus.subscribe(RESPONSES_CHANNEL, _on_remote_response)
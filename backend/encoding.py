@@ -0,0 +1,83 @@
+"""
+Serialização JSON compartilhada por WebSocket e HTTP.
+
+Uses orjson when it is installed and falls back to the stdlib encoder with the
+same output otherwise: compact separators, datetimes in ISO 8601, other unknown
+types through ``str`` and NaN/Infinity as ``null`` (what orjson does; neither
+is valid JSON). ``Envelope`` wraps an outgoing message and
+encodes it at most once, however many connections it is sent to.
+"""
+import datetime
+import json
+import math
+from typing import Any, Optional
+
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - depende do ambiente
+    orjson = None
+
+
+def _default(obj: Any) -> str:
+    # orjson já serializa datetimes em ISO 8601; o stdlib passa por aqui
+    if isinstance(obj, (datetime.datetime, datetime.date, datetime.time)):
+        return obj.isoformat()
+    return str(obj)
+
+
+def _finite(obj: Any) -> Any:
+    """Copy of ``obj`` with NaN and infinities replaced by None."""
+    if isinstance(obj, float):
+        return obj if math.isfinite(obj) else None
+    if isinstance(obj, dict):
+        return {key: _finite(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_finite(value) for value in obj]
+    return obj
+
+
+def _stdlib_dumps(obj: Any) -> bytes:
+    return json.dumps(obj, ensure_ascii=False, allow_nan=False, separators=(",", ":"), default=_default).encode("utf-8")
+
+
+def dumps(obj: Any) -> bytes:
+    """Encodes ``obj`` as compact UTF-8 JSON."""
+    if orjson is not None:
+        return orjson.dumps(obj, default=_default, option=orjson.OPT_NON_STR_KEYS)
+    try:
+        return _stdlib_dumps(obj)
+    except ValueError:
+        # NaN/Infinity: só paga a cópia quando o payload tem um
+        return _stdlib_dumps(_finite(obj))
+
+
+class Envelope:
+    """A message and its encoded form, computed on first use and then reused."""
+
+    __slots__ = ("message", "_data", "_text")
+
+    def __init__(self, message: dict):
+        self.message = message
+        self._data: Optional[bytes] = None
+        self._text: Optional[str] = None
+
+    @property
+    def data(self) -> bytes:
+        if self._data is None:
+            self._data = dumps(self.message)
+        return self._data
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._text = self.data.decode("utf-8")
+        return self._text
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse rendered with the shared encoder."""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
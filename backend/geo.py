@@ -0,0 +1,86 @@
+"""
+Kernel vetorizado de distâncias para o dispatch.
+
+All functions take coordinates in degrees and return kilometers. Inputs may be
+scalars or NumPy arrays and are broadcast against each other, so one call
+covers one pickup point against the whole fleet, or many pickup points against
+many couriers.
+"""
+from typing import List, Sequence
+
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0088
+
+# WGS-84
+WGS84_A_KM = 6378.137
+WGS84_F = 1 / 298.257223563
+
+
+def haversine_km(lat, lng, lats, lngs) -> np.ndarray:
+    """Great-circle distance on a spherical earth."""
+    phi1 = np.radians(lat)
+    phi2 = np.radians(lats)
+    dphi = phi2 - phi1
+    dlmb = np.radians(np.subtract(lngs, lng))
+    a = np.sin(dphi / 2) ** 2 + np.cos(phi1) * np.cos(phi2) * np.sin(dlmb / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def lambert_km(lat, lng, lats, lngs) -> np.ndarray:
+    """
+    Ellipsoidal (WGS-84) distance using Lambert's formula for long lines.
+
+    Stays within a few meters of the full geodesic solution at dispatch
+    distances, at a fraction of the cost of geopy's iterative solver.
+    """
+    beta1 = np.arctan((1 - WGS84_F) * np.tan(np.radians(lat)))
+    beta2 = np.arctan((1 - WGS84_F) * np.tan(np.radians(lats)))
+    dlmb = np.radians(np.subtract(lngs, lng))
+
+    a = np.sin((beta2 - beta1) / 2) ** 2 + np.cos(beta1) * np.cos(beta2) * np.sin(dlmb / 2) ** 2
+    sigma = 2 * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+    p = (beta1 + beta2) / 2
+    q = (beta2 - beta1) / 2
+    half = sigma / 2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        x = (sigma - np.sin(sigma)) * np.sin(p) ** 2 * np.cos(q) ** 2 / np.cos(half) ** 2
+        y = (sigma + np.sin(sigma)) * np.cos(p) ** 2 * np.sin(q) ** 2 / np.sin(half) ** 2
+        distance = WGS84_A_KM * (sigma - WGS84_F / 2 * (x + y))
+    # Pontos coincidentes geram 0/0 na fórmula
+    return np.where(sigma == 0, 0.0, distance)
+
+
+def distances_km(lat, lng, lats, lngs, ellipsoidal: bool = False) -> np.ndarray:
+    """Distances from one point (or broadcastable points) to many."""
+    if ellipsoidal:
+        return lambert_km(lat, lng, lats, lngs)
+    return haversine_km(lat, lng, lats, lngs)
+
+
+def distance_matrix(points_lat, points_lng, lats, lngs, ellipsoidal: bool = False) -> np.ndarray:
+    """Returns an (M, N) matrix of distances from M pickup points to N couriers."""
+    points_lat = np.asarray(points_lat, dtype=np.float64)[:, np.newaxis]
+    points_lng = np.asarray(points_lng, dtype=np.float64)[:, np.newaxis]
+    lats = np.asarray(lats, dtype=np.float64)[np.newaxis, :]
+    lngs = np.asarray(lngs, dtype=np.float64)[np.newaxis, :]
+    return distances_km(points_lat, points_lng, lats, lngs, ellipsoidal=ellipsoidal)
+
+
+def radius_tiers(distances: np.ndarray, radii: Sequence[float]) -> List[np.ndarray]:
+    """
+    Splits candidates into radius tiers with a single sort.
+
+    Tier i holds the indices with radii[i-1] < distance <= radii[i], nearest
+    first, so walking the tiers in order visits each candidate once.
+    """
+    order = np.argsort(distances, kind="stable")
+    cuts = np.searchsorted(distances[order], radii, side="right")
+    tiers = []
+    start = 0
+    for cut in cuts:
+        tiers.append(order[start:cut])
+        start = max(start, cut)
+    return tiers
+
@@ -0,0 +1,86 @@
+"""
+Hash de senhas fora do event loop.
+
+bcrypt takes tens to hundreds of milliseconds per call. Running it inside a
+request handler freezes every WebSocket and dispatch timer on the worker for
+that long, so hashing and verification run on a small dedicated thread pool
+(bcrypt releases the GIL while it works). At most ``max_pending`` calls may be
+queued or running; beyond that ``HasherBusy`` is raised at once so a login
+storm gets fast 503s instead of an ever-growing queue.
+
+``verify`` also returns a new hash when the stored one was made with outdated
+parameters (e.g. a lower ``BCRYPT_ROUNDS``), so passwords are upgraded as users
+log in.
+"""
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+
+from passlib.context import CryptContext
+
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+HASH_MAX_PENDING = int(os.getenv("HASH_MAX_PENDING", "64"))
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+
+
+class HasherBusy(Exception):
+    """Too many hashes queued; the caller should answer 503."""
+
+
+class PasswordHasher:
+    def __init__(self, context: CryptContext, max_workers: int = HASH_WORKERS, max_pending: int = HASH_MAX_PENDING):
+        self.context = context
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        # _done roda na thread do pool
+        self._lock = threading.Lock()
+
+    def _submit(self, fn, *args):
+        with self._lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                raise HasherBusy()
+            self.pending += 1
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix="hasher")
+        # O slot só é liberado quando o bcrypt termina de fato: cancelar quem
+        # espera (cliente desconectou) não para a thread que está calculando
+        work = self._executor.submit(fn, *args)
+        work.add_done_callback(self._done)
+        return asyncio.wrap_future(work)
+
+    def _done(self, work):
+        with self._lock:
+            self.pending -= 1
+            self.completed += 1
+
+    async def hash(self, password: str) -> str:
+        return await self._submit(self.context.hash, password)
+
+    async def verify(self, password: str, hashed: str) -> Tuple[bool, Optional[str]]:
+        """``(valid, new_hash)``; ``new_hash`` is set when the stored hash should be replaced."""
+        return await self._submit(self.context.verify_and_update, password, hashed)
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.max_workers,
+            "pending": self.pending,
+            "max_pending": self.max_pending,
+            "completed": self.completed,
+            "rejected": self.rejected,
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+password_hasher = PasswordHasher(pwd_context)
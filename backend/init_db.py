@@ -1,14 +1,13 @@
 import asyncio
 
-from backend.db import Base, engine
-from backend import models
+from backend.db import engine
+from backend.migrations import run_migrations
 
-async def init_db():
-    print("Criando tabelas do banco de dados...")
-    async with engine.begin() as conn:
-        # await conn.run_sync(Base.metadata.drop_all) # Opcional: limpa o banco antes de criar
-        await conn.run_sync(Base.metadata.create_all)
-    print("Tabelas criadas com sucesso!")
+async def init_db(target=engine):
+    # Mesmo caminho do startup: o schema_version fica registrado e o app não reaplica nada
+    print("Aplicando migrações do banco de dados...")
+    applied = await run_migrations(target)
+    print(f"Banco pronto ({len(applied)} migrações aplicadas)")
 
 if __name__ == "__main__":
     asyncio.run(init_db())
@@ -0,0 +1,67 @@
+"""
+Ledger persistido das ofertas de dispatch em andamento.
+
+Every offer wave writes one ``dispatch_ledger`` row per order in the same
+transaction that records the offer on the order: the strategy, the couriers
+holding the offer, the couriers already tried and the offer deadline. A
+restarted process uses these rows to resume or expire in-flight dispatches.
+"""
+import datetime
+from typing import Iterable, List, Optional, Set
+
+from sqlalchemy import delete
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+from backend import models
+
+
+def encode_ids(courier_ids: Iterable[int]) -> str:
+    return ",".join(str(courier_id) for courier_id in sorted(courier_ids))
+
+
+def parse_ids(value: Optional[str]) -> Set[int]:
+    return {int(part) for part in value.split(",") if part} if value else set()
+
+
+async def record_offer(
+    db: AsyncSession,
+    order_id: int,
+    strategy: str,
+    candidate_ids: Iterable[int],
+    tried_ids: Iterable[int],
+    timeout: float,
+):
+    """Stages the ledger row for a new offer wave; the caller commits."""
+    deadline = datetime.datetime.utcnow() + datetime.timedelta(seconds=timeout)
+    await db.merge(models.DispatchLedger(
+        order_id=order_id,
+        strategy=strategy,
+        candidate_courier_ids=encode_ids(candidate_ids),
+        tried_courier_ids=encode_ids(tried_ids),
+        deadline=deadline,
+    ))
+
+
+async def clear_offer(db: AsyncSession, order_id: int):
+    """Stages the end of an offer wave: no courier holds the offer anymore."""
+    entry = await db.get(models.DispatchLedger, order_id)
+    if entry is not None:
+        entry.candidate_courier_ids = None
+        entry.deadline = None
+
+
+async def remove(db: AsyncSession, order_id: int):
+    """Stages the removal of an order's ledger row once dispatch is over."""
+    await db.execute(delete(models.DispatchLedger).where(models.DispatchLedger.order_id == order_id))
+
+
+async def remove_finished(db: AsyncSession):
+    """Stages the removal of the rows whose order left SEARCHING (or was deleted)."""
+    searching = select(models.Order.id).where(models.Order.status == "SEARCHING")
+    await db.execute(delete(models.DispatchLedger).where(models.DispatchLedger.order_id.not_in(searching)))
+
+
+async def load(db: AsyncSession, order_ids: Iterable[int]) -> List[models.DispatchLedger]:
+    result = await db.execute(select(models.DispatchLedger).where(models.DispatchLedger.order_id.in_(list(order_ids))))
+    return result.scalars().all()
@@ -0,0 +1,190 @@
+"""
+Ingestão das localizações enviadas pelos motoboys (write-behind).
+
+``LOCATION_UPDATE`` frames update an in-memory latest-position table and the
+courier registry right away, so dispatch always ranks on the freshest position.
+Persisting is deferred: updates are coalesced per courier (last write wins) and
+flushed to the ``couriers`` table in periodic bulk UPDATE batches. The dirty
+table is bounded; when it is full, producers wait for the next flush instead of
+growing memory without limit. A failed flush keeps the batch and retries
+after a backoff that grows with each consecutive failure, so an unavailable
+database is not hammered in a loop.
+"""
+import asyncio
+import logging
+import time
+from typing import Dict, Optional, Tuple
+
+from sqlalchemy import bindparam, update
+
+from backend import models
+from backend.db import SessionLocal
+from backend.registry import CourierRegistry, courier_registry
+
+logger = logging.getLogger("telego.locations")
+
+
+# UPDATE em lote (executemany); motoboys removidos no meio do caminho são ignorados
+_UPDATE_POSITION = (
+    update(models.Courier.__table__)
+    .where(models.Courier.__table__.c.id == bindparam("courier_id"))
+    .values(lat=bindparam("lat"), lng=bindparam("lng"))
+)
+
+
+class LocationPipeline:
+    def __init__(
+        self,
+        flush_interval: float = 2.0,
+        max_pending: int = 10_000,
+        batch_size: int = 500,
+        max_backoff: float = 30.0,
+        session_factory=None,
+        registry: Optional[CourierRegistry] = None,
+    ):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.max_backoff = max_backoff
+        self.session_factory = session_factory or SessionLocal
+        self.registry = registry if registry is not None else courier_registry
+        # {courier_id: (lat, lng, recebido_em)}
+        self._latest: Dict[int, Tuple[float, float, float]] = {}
+        # Posições ainda não gravadas no banco: {courier_id: (lat, lng)}
+        self._dirty: Dict[int, Tuple[float, float]] = {}
+        self._wake: Optional[asyncio.Event] = None
+        self._space: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+        self.received = 0
+        self.coalesced = 0
+        self.written = 0
+        self.flushes = 0
+        self.failures = 0
+        self.failures_in_a_row = 0
+        self.backpressure_waits = 0
+        self.last_flush_seconds = 0.0
+
+    def position(self, courier_id: int) -> Optional[Tuple[float, float]]:
+        """Latest reported (lat, lng) of a courier, if any was received."""
+        latest = self._latest.get(courier_id)
+        return None if latest is None else latest[:2]
+
+    def forget(self, courier_id: int):
+        self._latest.pop(courier_id, None)
+        self._dirty.pop(courier_id, None)
+
+    async def put(self, courier_id: int, lat: float, lng: float):
+        """Records a position update, waiting for a flush if the dirty table is full."""
+        self.received += 1
+        self._latest[courier_id] = (lat, lng, time.time())
+        self.registry.set_location(courier_id, lat, lng)
+
+        if courier_id in self._dirty:
+            self.coalesced += 1
+            self._dirty[courier_id] = (lat, lng)
+            return
+        while len(self._dirty) >= self.max_pending:
+            self.backpressure_waits += 1
+            self._ensure_running()
+            self._space.clear()
+            self._wake.set()
+            await self._space.wait()
+        self._dirty[courier_id] = (lat, lng)
+        self._ensure_running()
+
+    def _ensure_running(self):
+        if self._task is None or self._task.done():
+            self._wake = asyncio.Event()
+            self._space = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while not self._stopping:
+            if self.failures_in_a_row:
+                await self._backoff()
+            else:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            self._wake.clear()
+            await self.flush()
+
+    async def _backoff(self):
+        """Waits before retrying a failed flush; only ``stop`` cuts the wait short."""
+        delay = min(self.flush_interval * 2 ** (self.failures_in_a_row - 1), self.max_backoff)
+        deadline = asyncio.get_running_loop().time() + delay
+        while not self._stopping:
+            remaining = deadline - asyncio.get_running_loop().time()
+            if remaining <= 0:
+                return
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=remaining)
+            except asyncio.TimeoutError:
+                return
+            # Produtores em backpressure não antecipam a nova tentativa
+            self._wake.clear()
+
+    async def flush(self) -> int:
+        """Writes every dirty position in bulk UPDATE batches; returns the rows written."""
+        if not self._dirty:
+            return 0
+        batch, self._dirty = self._dirty, {}
+
+        started = time.perf_counter()
+        rows = [{"courier_id": courier_id, "lat": lat, "lng": lng} for courier_id, (lat, lng) in batch.items()]
+        written = 0
+        try:
+            async with self.session_factory() as db:
+                for start in range(0, len(rows), self.batch_size):
+                    await db.execute(_UPDATE_POSITION, rows[start:start + self.batch_size])
+                    written += len(rows[start:start + self.batch_size])
+                await db.commit()
+        except Exception:
+            self.failures += 1
+            self.failures_in_a_row += 1
+            logger.exception("Erro ao gravar localizações", extra={"couriers": len(rows), "attempt": self.failures_in_a_row})
+            # Devolve o que não foi gravado, sem sobrescrever posições mais novas
+            for courier_id, position in batch.items():
+                self._dirty.setdefault(courier_id, position)
+            return 0
+        finally:
+            self.last_flush_seconds = time.perf_counter() - started
+
+        # Só libera os produtores depois que o lote saiu da memória
+        if self._space is not None:
+            self._space.set()
+        self.failures_in_a_row = 0
+        self.flushes += 1
+        self.written += written
+        return written
+
+    def stats(self) -> dict:
+        return {
+            "tracked": len(self._latest),
+            "pending": len(self._dirty),
+            "max_pending": self.max_pending,
+            "received": self.received,
+            "coalesced": self.coalesced,
+            "written": self.written,
+            "flushes": self.flushes,
+            "failures": self.failures,
+            "failures_in_a_row": self.failures_in_a_row,
+            "backpressure_waits": self.backpressure_waits,
+            "last_flush_ms": round(self.last_flush_seconds * 1000, 2),
+        }
+
+    async def stop(self):
+        """Stops the flush loop and writes what is still pending."""
+        if self._task is not None:
+            # Sem cancelar no meio de um flush, que perderia o lote em andamento
+            self._stopping = True
+            self._wake.set()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+            self._stopping = False
+        await self.flush()
+
+
+location_pipeline = LocationPipeline()
@@ -0,0 +1,139 @@
+"""
+Logging estruturado sem bloquear o event loop.
+
+Every ``telego.*`` logger (``telego.dispatch``, ``telego.ws``, ``telego.bus``...)
+hands its records to a bounded queue; a background thread formats them as one
+JSON object per line and writes them to stdout. A slow or blocked stdout
+therefore costs the request path a ``put_nowait``, and when the queue is full
+records are dropped and counted instead of stalling the loop.
+
+Configuration comes from the environment:
+
+* ``LOG_LEVEL`` - level of the ``telego`` logger (default INFO);
+* ``LOG_LEVELS`` - per-subsystem overrides, e.g. ``dispatch=DEBUG,ws=WARNING``;
+* ``LOG_FORMAT`` - ``json`` (default) or ``text`` for local development.
+
+High-volume events are sampled by passing ``extra={"sample": N}``: only one in
+every N records with the same message template is emitted, tagged with
+``"sampled": N``. Use %-style arguments so the template stays constant.
+"""
+import datetime
+import logging
+import os
+import queue
+import sys
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Optional, Tuple
+
+from backend.encoding import dumps
+from backend.metrics import metrics
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+DROPPED_RECORDS = metrics.counter("telego_log_dropped_total", "Log records dropped because the log queue was full.")
+
+# Atributos que todo LogRecord tem; o resto veio de ``extra``
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "sample"}
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return dumps(entry).decode("utf-8")
+
+
+class SamplingFilter(logging.Filter):
+    """Lets through one in every ``record.sample`` records per message template."""
+
+    def __init__(self):
+        super().__init__()
+        self._counts: Dict[Tuple[str, str], int] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        every = getattr(record, "sample", None)
+        if not every or every <= 1:
+            return True
+        key = (record.name, str(record.msg))
+        count = self._counts.get(key, 0)
+        self._counts[key] = count + 1
+        if count % every:
+            return False
+        record.sampled = every
+        return True
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """Enqueues without formatting; drops (and counts) records when the queue is full."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Só junta msg e args: objetos mutáveis não mudam antes da escrita.
+        # Formatação e exceção ficam para a thread de saída.
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DROPPED_RECORDS.inc()
+
+
+_listener: Optional[QueueListener] = None
+
+
+def _parse_levels(spec: str) -> Dict[str, str]:
+    levels = {}
+    for item in spec.split(","):
+        name, _, level = item.strip().partition("=")
+        if name and level:
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def setup_logging(stream=None, fmt: str = LOG_FORMAT, level: str = LOG_LEVEL, levels: str = LOG_LEVELS) -> QueueListener:
+    """Routes the ``telego`` loggers through the queue; calling it again reconfigures."""
+    global _listener
+    stop_logging()
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    if fmt == "text":
+        output.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    else:
+        output.setFormatter(JSONFormatter())
+
+    records: "queue.Queue[logging.LogRecord]" = queue.Queue(LOG_QUEUE_SIZE)
+    handler = NonBlockingQueueHandler(records)
+    handler.addFilter(SamplingFilter())
+
+    root = logging.getLogger("telego")
+    root.handlers = [handler]
+    root.setLevel(level)
+    root.propagate = False
+    for name, subsystem_level in _parse_levels(levels).items():
+        logging.getLogger(f"telego.{name}").setLevel(subsystem_level)
+
+    _listener = QueueListener(records, output, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+
+def stop_logging():
+    """Writes out what is still queued and stops the writer thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
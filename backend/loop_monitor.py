@@ -0,0 +1,69 @@
+"""
+Medição de travamentos do event loop.
+
+A background task sleeps for ``interval`` and measures how late it wakes up.
+The overshoot is time the loop spent running something that did not yield
+(bcrypt in a handler, a big JSON encode, a sync DB driver...). Stalls longer
+than ``threshold`` are counted and summed, so the effect of moving work off
+the loop can be compared before and after.
+"""
+import asyncio
+import os
+import time
+from collections import deque
+from typing import Deque, Optional
+
+LOOP_MONITOR_INTERVAL = float(os.getenv("LOOP_MONITOR_INTERVAL", "0.25"))
+LOOP_STALL_THRESHOLD = float(os.getenv("LOOP_STALL_THRESHOLD", "0.05"))
+
+
+class LoopLagMonitor:
+    def __init__(self, interval: float = LOOP_MONITOR_INTERVAL, threshold: float = LOOP_STALL_THRESHOLD, window: int = 240):
+        self.interval = interval
+        self.threshold = threshold
+        self.samples: Deque[float] = deque(maxlen=window)
+        self.max_lag = 0.0
+        self.stalls = 0
+        self.stalled_seconds = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    def record(self, lag: float):
+        self.samples.append(lag)
+        self.max_lag = max(self.max_lag, lag)
+        if lag >= self.threshold:
+            self.stalls += 1
+            self.stalled_seconds += lag
+
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.record(max(time.perf_counter() - started - self.interval, 0.0))
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> dict:
+        ordered = sorted(self.samples)
+        p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] if ordered else 0.0
+        return {
+            "interval_ms": self.interval * 1000,
+            "last_lag_ms": round(self.samples[-1] * 1000, 2) if self.samples else 0.0,
+            "p99_lag_ms": round(p99 * 1000, 2),
+            "max_lag_ms": round(self.max_lag * 1000, 2),
+            "stalls": self.stalls,
+            "stalled_seconds": round(self.stalled_seconds, 3),
+        }
+
+
+loop_monitor = LoopLagMonitor()
@@ -0,0 +1,78 @@
+"""
+Caixa postal dos usuários conectados por WebSocket (store-and-forward).
+
+Every message sent to a user gets the next sequence number of that user and is
+kept in a small bounded mailbox. A client that reconnects with the last
+sequence it saw receives only what it missed; when the gap is no longer in the
+mailbox (too old, evicted, or the sequence belongs to another ``epoch``) it is
+told to resync instead.
+
+The epoch identifies this mailbox store: it changes on every restart and
+differs between workers, so sequence numbers are only compared within the
+store that issued them.
+"""
+import uuid
+from collections import OrderedDict, deque
+from typing import Deque, List, Optional, Tuple
+
+from backend.encoding import Envelope
+
+
+class Mailbox:
+    __slots__ = ("last_seq", "messages")
+
+    def __init__(self, capacity: int):
+        self.last_seq = 0
+        self.messages: Deque[Tuple[int, Envelope]] = deque(maxlen=capacity)
+
+
+class MailboxStore:
+    def __init__(self, capacity: int = 100, max_users: int = 10_000):
+        self.capacity = capacity
+        self.max_users = max_users
+        self.epoch = uuid.uuid4().hex[:12]
+        self._mailboxes: "OrderedDict[str, Mailbox]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._mailboxes)
+
+    def _mailbox(self, user_id: str) -> Mailbox:
+        mailbox = self._mailboxes.get(user_id)
+        if mailbox is None:
+            mailbox = self._mailboxes[user_id] = Mailbox(self.capacity)
+            # Usuário há mais tempo sem mensagens perde a caixa (e faz resync)
+            while len(self._mailboxes) > self.max_users:
+                self._mailboxes.popitem(last=False)
+        else:
+            self._mailboxes.move_to_end(user_id)
+        return mailbox
+
+    def append(self, user_id: str, message: dict) -> Envelope:
+        """Stamps the message with the user's next sequence number and stores it."""
+        mailbox = self._mailbox(user_id)
+        mailbox.last_seq += 1
+        envelope = Envelope(dict(message, seq=mailbox.last_seq))
+        mailbox.messages.append((mailbox.last_seq, envelope))
+        return envelope
+
+    def last_seq(self, user_id: str) -> int:
+        mailbox = self._mailboxes.get(user_id)
+        return mailbox.last_seq if mailbox is not None else 0
+
+    def since(self, user_id: str, last_seq: int, epoch: Optional[str] = None) -> Optional[List[Envelope]]:
+        """
+        Messages after ``last_seq``, oldest first, or None when the client has
+        to resync because the gap cannot be filled from this store.
+        """
+        if epoch is not None and epoch != self.epoch:
+            return None
+        mailbox = self._mailboxes.get(user_id)
+        current = mailbox.last_seq if mailbox is not None else 0
+        if last_seq > current:
+            return None
+        if last_seq == current:
+            return []
+        oldest = mailbox.messages[0][0] if mailbox.messages else current + 1
+        if oldest > last_seq + 1:
+            return None
+        return [envelope for seq, envelope in mailbox.messages if seq > last_seq]
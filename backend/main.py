@@ -1,45 +1,64 @@
+from backend.log import setup_logging, stop_logging
+
+# Antes dos outros módulos, que já logam ao serem importados
+setup_logging()
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 from contextlib import asynccontextmanager
-from backend.db import Base, engine
-from backend.routers import auth, couriers, orders, restaurants, websocket
-
-from sqlalchemy import text
+from backend.bus import bus
+from backend.db import engine
+from backend.encoding import FastJSONResponse
+from backend.hashing import password_hasher
+from backend.locations import location_pipeline
+from backend.loop_monitor import loop_monitor
+from backend.metrics import MetricsMiddleware, metrics
+from backend.migrations import run_migrations
+from backend.registry import RECONCILE_SECONDS, courier_registry
+from backend.recovery import drain_dispatches, recover_dispatches, start_recovery
+from backend.scheduler import dispatch_scheduler
+from backend.routers import auth, couriers, health, orders, restaurants, websocket
+from backend.websocket_manager import manager
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    async with engine.begin() as conn:
-        # Cria tabelas se não existirem
-        await conn.run_sync(Base.metadata.create_all)
-        
-        # Migração manual para adicionar novas colunas se elas não existirem (para bancos como PostgreSQL no Railway)
-        try:
-            # Lista de colunas para adicionar à tabela 'orders'
-            columns_to_add = [
-                ("customer_name", "VARCHAR"),
-                ("delivery_address", "VARCHAR"),
-                ("pickup_address", "VARCHAR"),
-                ("price", "FLOAT"),
-                ("order_value", "FLOAT"),
-                ("created_at", "TIMESTAMP")
-            ]
-            
-            for col_name, col_type in columns_to_add:
-                try:
-                    # Tenta adicionar a coluna, ignora se já existir
-                    await conn.execute(text(f"ALTER TABLE orders ADD COLUMN {col_name} {col_type}"))
-                    print(f"✅ Coluna {col_name} adicionada com sucesso.")
-                except Exception as e:
-                    # Provavelmente a coluna já existe
-                    pass
-            
-            await conn.commit()
-        except Exception as e:
-            print(f"⚠️ Erro na migração automática: {e}")
-            
+    # Aplica só as migrações pendentes; com o schema em dia é uma consulta
+    await run_migrations(engine)
+
+    # Mede travamentos do event loop (/health/loop)
+    loop_monitor.start()
+
+    # Barramento entre workers (WebSocket e respostas do dispatch)
+    await bus.start()
+
+    # Carrega os motoboys na memória antes de qualquer dispatch
+    await courier_registry.warm()
+    courier_registry.start(RECONCILE_SECONDS)
+    # Derruba sessões WebSocket sem heartbeat
+    manager.start_reaper()
+
+    # Workers que tiram os pedidos da fila de dispatch
+    dispatch_scheduler.start()
+
+    # Retoma ofertas de workers que pararam (deploy/crash) e renova o lease deste
+    await recover_dispatches()
+    start_recovery()
+
     yield
 
-app = FastAPI(title="TeleGo Backend", version="1.0.0", lifespan=lifespan)
+    await drain_dispatches()
+    await courier_registry.stop()
+    await manager.stop_reaper()
+    # Grava as últimas posições antes de desligar
+    await location_pipeline.stop()
+    await bus.stop()
+    password_hasher.shutdown()
+    await loop_monitor.stop()
+    # Escreve o que ainda está na fila de logs
+    stop_logging()
+
+app = FastAPI(title="TeleGo Backend", version="1.0.0", lifespan=lifespan, default_response_class=FastJSONResponse)
 
 # 🔥🔥🔥 CORS SIMPLIFICADO E FUNCIONAL 🔥🔥🔥
 # 🔥🔥🔥 CORS TOTALMENTE ABERTO PARA RESOLVER O PROBLEMA 🔥🔥🔥
@@ -51,6 +70,8 @@ app.add_middleware(
     allow_headers=["*"],
     expose_headers=["*"],
 )
+# Latência por rota para o /metrics
+app.add_middleware(MetricsMiddleware)
 
 # Rotas principais
 app.include_router(auth.router)
@@ -58,11 +79,17 @@ app.include_router(couriers.router)
 app.include_router(orders.router)
 app.include_router(restaurants.router)
 app.include_router(websocket.router)
+app.include_router(health.router)
 
 @app.get("/")
 async def root():
     return {"status": "ok", "service": "TeleGo Backend", "message": "TeleGo API online"}
 
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    # Formato texto do Prometheus
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
 # Rota de teste CORS
 @app.get("/test-cors")
 async def test_cors():
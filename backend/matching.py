@@ -0,0 +1,268 @@
+"""
+Atribuição global de pedidos a motoboys em janelas (modo "batch").
+
+Instead of one greedy dispatch per order, the batch dispatcher collects the
+orders that are still SEARCHING over a short window, builds an order x courier
+distance matrix and solves a minimum-cost assignment for the whole batch.
+Offers then go out according to the solution; orders whose offer expires or is
+declined return to the next window.
+"""
+import asyncio
+import concurrent.futures
+import logging
+import os
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+from sqlalchemy.future import select
+
+from backend import dispatch, geo, models
+from backend.db import SessionLocal
+from backend.registry import courier_registry
+from backend.reservations import reservations
+from backend.websocket_manager import manager
+
+logger = logging.getLogger("telego.dispatch")
+
+
+def solve_assignment(cost) -> List[Tuple[int, int]]:
+    """
+    Minimum-cost assignment (Hungarian algorithm, shortest augmenting paths).
+
+    Accepts a rectangular matrix where ``inf`` marks forbidden pairs and returns
+    (row, col) pairs; rows without a feasible column are left out.
+    """
+    cost = np.asarray(cost, dtype=np.float64)
+    rows, cols = cost.shape
+    if rows == 0 or cols == 0:
+        return []
+
+    transposed = rows > cols
+    if transposed:
+        cost = cost.T
+        rows, cols = cols, rows
+
+    feasible = np.isfinite(cost)
+    if not feasible.any():
+        return []
+    # Pares proibidos recebem um custo maior que qualquer solução viável
+    forbidden = (np.abs(cost[feasible]).max() + 1.0) * (rows + 1)
+    c = np.where(feasible, cost, forbidden)
+
+    u = np.zeros(rows + 1)
+    v = np.zeros(cols + 1)
+    p = np.zeros(cols + 1, dtype=np.int64)
+    way = np.zeros(cols + 1, dtype=np.int64)
+
+    for i in range(1, rows + 1):
+        p[0] = i
+        j0 = 0
+        minv = np.full(cols + 1, np.inf)
+        used = np.zeros(cols + 1, dtype=bool)
+        while True:
+            used[j0] = True
+            i0 = p[j0]
+            free = ~used[1:]
+            reduced = c[i0 - 1] - u[i0] - v[1:]
+            better = free & (reduced < minv[1:])
+            minv[1:][better] = reduced[better]
+            way[1:][better] = j0
+
+            candidates = np.where(free, minv[1:], np.inf)
+            j1 = int(np.argmin(candidates)) + 1
+            delta = candidates[j1 - 1]
+
+            used_cols = np.nonzero(used)[0]
+            u[p[used_cols]] += delta
+            v[used_cols] -= delta
+            minv[1:][free] -= delta
+
+            j0 = j1
+            if p[j0] == 0:
+                break
+        while j0:
+            j1 = way[j0]
+            p[j0] = p[j1]
+            j0 = j1
+
+    pairs = []
+    for j in range(1, cols + 1):
+        if p[j]:
+            row, col = int(p[j]) - 1, j - 1
+            if feasible[row, col]:
+                pairs.append((col, row) if transposed else (row, col))
+    pairs.sort()
+    return pairs
+
+
+class _BatchEntry:
+    __slots__ = ("first_seen", "tried")
+
+    def __init__(self, first_seen: float):
+        self.first_seen = first_seen
+        self.tried: Set[int] = set()
+
+
+class BatchDispatcher:
+    """
+    Collects SEARCHING orders over a window and dispatches them together.
+
+    Matrices up to ``inline_cells`` entries are solved on the event loop; larger
+    batches go to a process pool so the solver never stalls the loop.
+    """
+
+    def __init__(
+        self,
+        window_seconds: float = 3.0,
+        max_radius_km: float = dispatch.RADII[-1],
+        offer_timeout: float = dispatch.OFFER_TIMEOUT_SECONDS,
+        give_up_after: float = 300.0,
+        inline_cells: int = 10_000,
+        session_factory=None,
+    ):
+        self.window_seconds = window_seconds
+        self.max_radius_km = max_radius_km
+        self.offer_timeout = offer_timeout
+        self.give_up_after = give_up_after
+        self.inline_cells = inline_cells
+        self.session_factory = session_factory or SessionLocal
+        self._pending: Dict[int, _BatchEntry] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._executor: Optional[concurrent.futures.ProcessPoolExecutor] = None
+
+    @property
+    def pending(self) -> List[int]:
+        return list(self._pending)
+
+    def submit(self, order_id: int, tried: Iterable[int] = ()):
+        """Queues an order for the next window, starting the loop if needed."""
+        loop = asyncio.get_running_loop()
+        self._pending.setdefault(order_id, _BatchEntry(loop.time())).tried.update(tried)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.window_seconds)
+            if not self._pending:
+                continue
+            try:
+                await self.run_round()
+            except Exception:
+                logger.exception("Erro na rodada de dispatch em lote")
+
+    async def _solve(self, cost: np.ndarray) -> List[Tuple[int, int]]:
+        if cost.size <= self.inline_cells:
+            return solve_assignment(cost)
+        if self._executor is None:
+            self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=1)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, solve_assignment, cost)
+
+    async def run_round(self) -> List[Tuple[int, int]]:
+        """Solves one window and sends the offers; returns the (order, courier) pairs."""
+        order_ids = list(self._pending)
+        async with self.session_factory() as db:
+            stmt = (
+                select(models.Order.id, models.Order.status, models.Restaurant.lat, models.Restaurant.lng)
+                .join(models.Restaurant, models.Order.restaurant_id == models.Restaurant.id)
+                .where(models.Order.id.in_(order_ids))
+            )
+            rows = (await db.execute(stmt)).all()
+        await courier_registry.ensure_warm(self.session_factory)
+
+        searching = {row.id: row for row in rows if row.status == "SEARCHING"}
+        for order_id in order_ids:
+            if order_id not in searching:
+                # Pedido cancelado, aceito ou removido enquanto aguardava a janela
+                self._pending.pop(order_id, None)
+        batch = [order_id for order_id in order_ids if order_id in searching]
+        if not batch:
+            return []
+
+        courier_ids, lats, lngs = courier_registry.snapshot()
+        if len(courier_ids):
+            cost = geo.distance_matrix(
+                [searching[order_id].lat for order_id in batch],
+                [searching[order_id].lng for order_id in batch],
+                lats,
+                lngs,
+            )
+            cost[cost > self.max_radius_km] = np.inf
+
+            # Motoboys com oferta em andamento ou já tentados ficam de fora
+            column = {courier_id: col for col, courier_id in enumerate(courier_ids.tolist())}
+            for courier_id in reservations.reserved_ids():
+                if courier_id in column:
+                    cost[:, column[courier_id]] = np.inf
+            if dispatch.SKIP_OFFLINE_COURIERS:
+                # Mesma regra do dispatch por pedido: só oferta para quem está conectado
+                offline = [
+                    col for courier_id, col in column.items() if not manager.presence.is_courier_online(courier_id)
+                ]
+                cost[:, offline] = np.inf
+            for row, order_id in enumerate(batch):
+                for courier_id in self._pending[order_id].tried:
+                    if courier_id in column:
+                        cost[row, column[courier_id]] = np.inf
+
+            pairs = await self._solve(cost)
+        else:
+            pairs = []
+
+        assignments = []
+        for row, col in pairs:
+            order_id = batch[row]
+            courier_id = int(courier_ids[col])
+            entry = self._pending.pop(order_id)
+            entry.tried.add(courier_id)
+            self._offer(order_id, courier_id, entry)
+            assignments.append((order_id, courier_id))
+
+        now = asyncio.get_running_loop().time()
+        for order_id in batch:
+            entry = self._pending.get(order_id)
+            if entry is not None and now - entry.first_seen > self.give_up_after:
+                del self._pending[order_id]
+                await self._give_up(order_id)
+
+        return assignments
+
+    def _offer(self, order_id: int, courier_id: int, entry: _BatchEntry):
+        done = dispatch.dispatcher.submit(
+            order_id,
+            session_factory=self.session_factory,
+            strategy="batch",
+            tried=entry.tried,
+            waves=[([courier_id], self.offer_timeout)],
+            finish_when_exhausted=False,
+        )
+        done.add_done_callback(lambda future: self._offer_done(order_id, entry, future))
+
+    def _offer_done(self, order_id: int, entry: _BatchEntry, done: asyncio.Future):
+        if done.cancelled() or done.exception() is not None or done.result() is not None:
+            return
+        # Oferta recusada ou expirada: volta para a próxima janela
+        self._pending[order_id] = entry
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _give_up(self, order_id: int):
+        async with self.session_factory() as db:
+            order = await db.get(models.Order, order_id)
+            if order is None or order.status != "SEARCHING":
+                return
+            restaurant = await db.get(models.Restaurant, order.restaurant_id)
+        await dispatch.mark_no_courier_found(self.session_factory, order, restaurant)
+
+
+batch_dispatcher = BatchDispatcher(window_seconds=float(os.getenv("DISPATCH_BATCH_WINDOW", "3")))
@@ -0,0 +1,242 @@
+"""
+Registro de métricas no formato texto do Prometheus.
+
+A small in-process registry with counters, gauges and histograms (optionally
+labelled), rendered at ``/metrics``. Metrics are declared next to the code
+they measure, e.g.::
+
+    OFFER_RESPONSE = metrics.histogram("telego_offer_response_seconds", "...", ("outcome",))
+    OFFER_RESPONSE.observe(1.2, outcome="accepted")
+
+Gauges may take a ``callback`` that is read at scrape time, for values that
+already live somewhere else (pool occupancy, open connections). Values are per
+worker process; Prometheus sums them across the replicas it scrapes.
+
+``MetricsMiddleware`` records per-route request latency, labelled with the
+route template so path parameters do not explode the label set.
+"""
+import abc
+import bisect
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(pairs: Iterable[Tuple[str, str]]) -> str:
+    pairs = list(pairs)
+    if not pairs:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+        for name, value in pairs
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class _Metric(abc.ABC):
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: dict) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} espera os labels {self.labelnames}, recebeu {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    @abc.abstractmethod
+    def _samples(self) -> List[str]:
+        """Sample lines of the metric in the text exposition format."""
+
+    def render(self) -> str:
+        header = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        return "\n".join(header + self._samples())
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def _samples(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(zip(self.labelnames, key))} {_format_value(value)}"
+            for key, value in sorted(self._values.items())
+        ]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 callback: Optional[Callable[[], float]] = None):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels):
+        self.inc(-amount, **labels)
+
+    def value(self, **labels) -> float:
+        if self.callback is not None:
+            return self.callback()
+        return self._values.get(self._key(labels), 0.0)
+
+    def _samples(self) -> List[str]:
+        if self.callback is not None:
+            return [f"{self.name} {_format_value(self.callback())}"]
+        return [
+            f"{self.name}{_format_labels(zip(self.labelnames, key))} {_format_value(value)}"
+            for key, value in sorted(self._values.items())
+        ]
+
+
+class _HistogramSeries:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self, size: int):
+        self.counts = [0] * size
+        self.sum = 0.0
+        self.count = 0
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[Tuple[str, ...], _HistogramSeries] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = _HistogramSeries(len(self.buckets))
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series.counts[index] += 1
+        series.sum += value
+        series.count += 1
+
+    def count(self, **labels) -> int:
+        series = self._series.get(self._key(labels))
+        return series.count if series is not None else 0
+
+    def _samples(self) -> List[str]:
+        lines = []
+        for key, series in sorted(self._series.items()):
+            pairs = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets, series.counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(pairs + [('le', _format_value(bound))])} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(pairs + [('le', '+Inf')])} {series.count}")
+            lines.append(f"{self.name}_sum{_format_labels(pairs)} {_format_value(series.sum)}")
+            lines.append(f"{self.name}_count{_format_labels(pairs)} {series.count}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def _register(self, metric: _Metric) -> _Metric:
+        existing = self._metrics.get(metric.name)
+        if existing is not None:
+            if type(existing) is not type(metric):
+                raise ValueError(f"Métrica {metric.name} já registrada como {existing.kind}")
+            # Reimportar um módulo não duplica a métrica
+            return existing
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+              callback: Optional[Callable[[], float]] = None) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames, callback))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def get(self, name: str) -> Optional[_Metric]:
+        return self._metrics.get(name)
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for _, metric in sorted(self._metrics.items())) + "\n"
+
+
+metrics = MetricsRegistry()
+
+REQUEST_LATENCY = metrics.histogram(
+    "telego_http_request_duration_seconds",
+    "Time until the response headers are sent, per route.",
+    ("method", "route", "status"),
+)
+
+
+class MetricsMiddleware:
+    """ASGI middleware that times every HTTP request up to its response start."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        recorded = False
+
+        def record(status: int):
+            nonlocal recorded
+            recorded = True
+            route = scope.get("route")
+            # Rotas desconhecidas ficam num label só (cardinalidade)
+            template = getattr(route, "path", None) or "unmatched"
+            REQUEST_LATENCY.observe(
+                time.perf_counter() - started, method=scope["method"], route=template, status=status
+            )
+
+        async def timed_send(message):
+            if message["type"] == "http.response.start" and not recorded:
+                record(message["status"])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, timed_send)
+        except Exception:
+            if not recorded:
+                record(500)
+            raise
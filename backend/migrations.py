@@ -0,0 +1,230 @@
+"""
+Migrações versionadas do schema.
+
+Each migration has a version number and runs once, in order, inside a single
+transaction that also records it in ``schema_version``. When the database is
+already current, startup costs a single ``SELECT MAX(version)``.
+
+Migrations run on a sync connection (``conn.run_sync``) so they can use the
+SQLAlchemy DDL helpers. Each one spells out its own schema - the baseline
+tables are frozen copies defined here and later versions use explicit DDL -
+and never reads ``Base.metadata``: the models describe the latest schema, not
+the one a given version produced. Never edit a migration that has shipped;
+append a new one instead.
+"""
+import datetime
+import logging
+from typing import Callable, List, Tuple
+
+from sqlalchemy import Column, DateTime, Float, ForeignKey, Integer, MetaData, String, Table, inspect, text
+from sqlalchemy.engine import Connection
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+logger = logging.getLogger("telego.db")
+
+# Fora de Base.metadata: só o runner cria e lê esta tabela
+schema_version = Table(
+    "schema_version",
+    MetaData(),
+    Column("version", Integer, primary_key=True),
+    Column("description", String, nullable=False),
+    Column("applied_at", DateTime, nullable=False),
+)
+
+# Chave do advisory lock que serializa workers migrando ao mesmo tempo (Postgres)
+MIGRATION_LOCK_ID = 7_412_019
+
+
+# Schema da versão 1, congelado: não acompanha mudanças em models.py
+_baseline_metadata = MetaData()
+
+Table(
+    "users", _baseline_metadata,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("email", String, unique=True, index=True, nullable=False),
+    Column("hashed_password", String, nullable=False),
+    Column("name", String, nullable=False),
+    Column("role", String, nullable=False),
+)
+
+Table(
+    "restaurants", _baseline_metadata,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("user_id", Integer, ForeignKey("users.id"), nullable=True),
+    Column("name", String, index=True, nullable=False),
+    Column("lat", Float, nullable=False),
+    Column("lng", Float, nullable=False),
+)
+
+Table(
+    "couriers", _baseline_metadata,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("user_id", Integer, ForeignKey("users.id"), nullable=True),
+    Column("name", String, index=True, nullable=False),
+    Column("email", String, unique=True, index=True, nullable=False),
+    Column("lat", Float, nullable=False),
+    Column("lng", Float, nullable=False),
+    Column("available", Integer),
+)
+
+Table(
+    "orders", _baseline_metadata,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("restaurant_id", Integer, ForeignKey("restaurants.id")),
+    Column("courier_id", Integer, ForeignKey("couriers.id"), nullable=True),
+    Column("customer_name", String, nullable=True),
+    Column("delivery_address", String, nullable=True),
+    Column("pickup_address", String, nullable=True),
+    Column("price", Float),
+    Column("order_value", Float),
+    Column("created_at", DateTime),
+    Column("status", String, index=True),
+    Column("current_candidate_courier_id", Integer, ForeignKey("couriers.id"), nullable=True),
+    Column("offer_sent_at", DateTime, nullable=True),
+    Column("attempt_count", Integer),
+)
+
+Table(
+    "dispatch_ledger", _baseline_metadata,
+    Column("order_id", Integer, primary_key=True),
+    Column("strategy", String, nullable=False),
+    Column("candidate_courier_ids", String, nullable=True),
+    Column("tried_courier_ids", String, nullable=True),
+    Column("deadline", DateTime, nullable=True),
+    Column("updated_at", DateTime),
+)
+
+
+def _baseline(conn: Connection):
+    """Baseline tables, plus the order columns older databases lack."""
+    _baseline_metadata.create_all(conn)
+    existing = {column["name"] for column in inspect(conn).get_columns("orders")}
+    for name, type_ in (
+        ("customer_name", "VARCHAR"),
+        ("delivery_address", "VARCHAR"),
+        ("pickup_address", "VARCHAR"),
+        ("price", "FLOAT"),
+        ("order_value", "FLOAT"),
+        ("created_at", "TIMESTAMP"),
+    ):
+        if name not in existing:
+            conn.execute(text(f"ALTER TABLE orders ADD COLUMN {name} {type_}"))
+    # Pedidos anteriores à coluna entram no histórico pela data da migração
+    conn.execute(
+        text("UPDATE orders SET created_at = :now WHERE created_at IS NULL"), {"now": datetime.datetime.utcnow()}
+    )
+
+
+_HOT_PATH_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS ix_orders_restaurant_created ON orders (restaurant_id, created_at, id)",
+    "CREATE INDEX IF NOT EXISTS ix_orders_courier_created ON orders (courier_id, created_at, id)",
+    "CREATE INDEX IF NOT EXISTS ix_orders_candidate_status ON orders (current_candidate_courier_id, status)",
+    # Só os motoboys disponíveis entram no índice
+    "CREATE INDEX IF NOT EXISTS ix_couriers_available ON couriers (id, lat, lng) WHERE available = 1",
+)
+
+
+def _hot_path_indexes(conn: Connection):
+    """Composite and partial indexes for offers, order history and available couriers."""
+    for statement in _HOT_PATH_INDEXES:
+        conn.execute(text(statement))
+
+
+# Tabela orders da versão 3, para refazer a tabela no SQLite
+_restaurant_id = _baseline_metadata.tables["restaurants"].c.id
+_courier_id = _baseline_metadata.tables["couriers"].c.id
+_orders_v3 = Table(
+    "orders", MetaData(),
+    Column("id", Integer, primary_key=True, index=True),
+    Column("restaurant_id", Integer, ForeignKey(_restaurant_id)),
+    Column("courier_id", Integer, ForeignKey(_courier_id), nullable=True),
+    Column("customer_name", String, nullable=True),
+    Column("delivery_address", String, nullable=True),
+    Column("pickup_address", String, nullable=True),
+    Column("price", Float),
+    Column("order_value", Float),
+    Column("created_at", DateTime, nullable=False),
+    Column("status", String, index=True),
+    Column("current_candidate_courier_id", Integer, ForeignKey(_courier_id), nullable=True),
+    Column("offer_sent_at", DateTime, nullable=True),
+    Column("attempt_count", Integer),
+)
+
+
+def _orders_created_at_not_null(conn: Connection):
+    """Keyset pagination needs a created_at on every order: backfill, then NOT NULL."""
+    conn.execute(
+        text("UPDATE orders SET created_at = :now WHERE created_at IS NULL"), {"now": datetime.datetime.utcnow()}
+    )
+    if conn.dialect.name == "postgresql":
+        conn.execute(text("ALTER TABLE orders ALTER COLUMN created_at SET NOT NULL"))
+        return
+    created_at = next(column for column in inspect(conn).get_columns("orders") if column["name"] == "created_at")
+    if not created_at["nullable"]:
+        # Tabela criada já com NOT NULL (ex.: create_all): não precisa refazer
+        return
+
+    # SQLite não altera colunas: recria a tabela e copia as linhas
+    columns = ", ".join(column.name for column in _orders_v3.columns)
+    conn.execute(text("ALTER TABLE orders RENAME TO orders_v2"))
+    for index in ("ix_orders_id", "ix_orders_status", "ix_orders_restaurant_created",
+                  "ix_orders_courier_created", "ix_orders_candidate_status"):
+        conn.execute(text(f"DROP INDEX IF EXISTS {index}"))
+    _orders_v3.create(conn)
+    conn.execute(text(f"INSERT INTO orders ({columns}) SELECT {columns} FROM orders_v2"))
+    conn.execute(text("DROP TABLE orders_v2"))
+    for statement in _HOT_PATH_INDEXES[:3]:
+        conn.execute(text(statement))
+
+
+def _dispatch_ownership(conn: Connection):
+    """Which worker dispatches each order, and the leases that say which workers are alive."""
+    if "dispatch_owner" not in {column["name"] for column in inspect(conn).get_columns("orders")}:
+        conn.execute(text("ALTER TABLE orders ADD COLUMN dispatch_owner VARCHAR"))
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS dispatch_nodes (node_id VARCHAR PRIMARY KEY, lease_until TIMESTAMP NOT NULL)"
+    ))
+
+
+MIGRATIONS: List[Tuple[int, str, Callable[[Connection], None]]] = [
+    (1, "baseline schema", _baseline),
+    (2, "hot path indexes", _hot_path_indexes),
+    (3, "orders.created_at not null", _orders_created_at_not_null),
+    (4, "dispatch ownership", _dispatch_ownership),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+async def current_version(engine: AsyncEngine) -> int:
+    async with engine.connect() as conn:
+        try:
+            return (await conn.execute(text("SELECT MAX(version) FROM schema_version"))).scalar() or 0
+        except DBAPIError:
+            # Banco novo (ou anterior às migrações): a tabela ainda não existe
+            return 0
+
+
+async def run_migrations(engine: AsyncEngine) -> List[int]:
+    """Applies pending migrations and returns the versions applied."""
+    if await current_version(engine) >= LATEST_VERSION:
+        return []
+
+    applied = []
+    async with engine.begin() as conn:
+        if conn.dialect.name == "postgresql":
+            await conn.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": MIGRATION_LOCK_ID})
+        await conn.run_sync(schema_version.create, checkfirst=True)
+        # Relê dentro do lock: outro worker pode ter migrado enquanto esperávamos
+        current = (await conn.execute(text("SELECT MAX(version) FROM schema_version"))).scalar() or 0
+        for version, description, upgrade in MIGRATIONS:
+            if version <= current:
+                continue
+            await conn.run_sync(upgrade)
+            await conn.execute(schema_version.insert().values(
+                version=version, description=description, applied_at=datetime.datetime.utcnow()
+            ))
+            applied.append(version)
+            logger.info("Migração aplicada", extra={"version": version, "description": description})
+    return applied
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey
+from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Index, text
 from sqlalchemy.orm import relationship
 from backend.db import Base
 import datetime
@@ -29,6 +29,14 @@ class Courier(Base):
     lng = Column(Float, nullable=False)
     available = Column(Integer, default=1)
 
+    # Só os motoboys disponíveis entram no índice
+    __table_args__ = (
+        Index(
+            "ix_couriers_available", "id", "lat", "lng",
+            postgresql_where=text("available = 1"), sqlite_where=text("available = 1"),
+        ),
+    )
+
 class Order(Base):
     __tablename__ = "orders"
     id = Column(Integer, primary_key=True, index=True)
@@ -40,13 +48,39 @@ class Order(Base):
     pickup_address = Column(String, nullable=True)
     price = Column(Float, default=0.0)
     order_value = Column(Float, default=0.0)
-    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    created_at = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
 
     status = Column(String, default="SEARCHING", index=True)
     current_candidate_courier_id = Column(Integer, ForeignKey("couriers.id"), nullable=True)
     offer_sent_at = Column(DateTime, nullable=True)
     attempt_count = Column(Integer, default=0)
+    # Worker (bus.node_id) responsável pelo dispatch enquanto o pedido está em SEARCHING
+    dispatch_owner = Column(String, nullable=True)
 
     restaurant = relationship("Restaurant")
     courier = relationship("Courier", foreign_keys=[courier_id])
     current_candidate_courier = relationship("Courier", foreign_keys=[current_candidate_courier_id])
+
+    # Histórico paginado por (created_at, id) de cada restaurante / motoboy
+    __table_args__ = (
+        Index("ix_orders_restaurant_created", "restaurant_id", "created_at", "id"),
+        Index("ix_orders_courier_created", "courier_id", "created_at", "id"),
+        # Ofertas abertas de um motoboy (/orders/available)
+        Index("ix_orders_candidate_status", "current_candidate_courier_id", "status"),
+    )
+
+class DispatchLedger(Base):
+    """Oferta em andamento de um pedido, persistida para sobreviver a restarts."""
+    __tablename__ = "dispatch_ledger"
+    order_id = Column(Integer, primary_key=True)
+    strategy = Column(String, nullable=False)
+    candidate_courier_ids = Column(String, nullable=True)  # "1,2,3"
+    tried_courier_ids = Column(String, nullable=True)
+    deadline = Column(DateTime, nullable=True)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+
+class DispatchNode(Base):
+    """Worker vivo que despacha pedidos; quem para de renovar o lease perde os seus."""
+    __tablename__ = "dispatch_nodes"
+    node_id = Column(String, primary_key=True)
+    lease_until = Column(DateTime, nullable=False)
@@ -0,0 +1,141 @@
+"""
+Presença dos usuários conectados por WebSocket.
+
+A user may hold several sessions at once (a second tab, a reconnect that
+arrives before the old socket is noticed dead), each with its own last-seen
+time refreshed by heartbeats, pings and any other inbound frame. Sessions that
+stay silent longer than the idle timeout are reported by ``idle_sessions`` so
+the connection manager can reap them; ``quiet_sessions`` finds the ones silent
+for a shorter while, which the manager pings so a live client answers first.
+
+Couriers without a socket that poll ``/orders/available`` count as online for
+``POLL_PRESENCE_SECONDS`` after each poll; ``expire_polls`` takes them offline
+again once they stop.
+
+``is_online`` is a dict lookup. It also knows about users connected to other
+workers, as announced over the message bus (and resynced whenever a worker's
+bus connects); if a worker dies without saying goodbye its users keep counting
+as online there, which only costs the offer timeout that every courier used
+to cost.
+"""
+import itertools
+import os
+import time
+from typing import Any, Callable, Dict, List, Set
+
+IDLE_TIMEOUT_SECONDS = float(os.getenv("WS_IDLE_TIMEOUT", "60"))
+POLL_PRESENCE_SECONDS = float(os.getenv("POLL_PRESENCE_SECONDS", "30"))
+
+
+class Session:
+    __slots__ = ("id", "user_id", "websocket", "writer", "last_seen")
+
+    def __init__(self, session_id: int, user_id: str, websocket: Any, last_seen: float):
+        self.id = session_id
+        self.user_id = user_id
+        self.websocket = websocket
+        self.writer = None
+        self.last_seen = last_seen
+
+
+class PresenceRegistry:
+    def __init__(self, clock: Callable[[], float] = time.monotonic, idle_timeout: float = IDLE_TIMEOUT_SECONDS,
+                 poll_ttl: float = POLL_PRESENCE_SECONDS):
+        self.clock = clock
+        self.idle_timeout = idle_timeout
+        self.poll_ttl = poll_ttl
+        self._sessions: Dict[str, Dict[int, Session]] = {}
+        # Último poll de quem não tem sessão aberta: {user_id: momento}
+        self._polled: Dict[str, float] = {}
+        # Usuários conectados em outros workers: {user_id: {node_id}}
+        self._remote: Dict[str, Set[str]] = {}
+        self._ids = itertools.count(1)
+        self._listeners: List[Callable[[str, bool], Any]] = []
+
+    def __len__(self) -> int:
+        return sum(len(sessions) for sessions in self._sessions.values())
+
+    def on_change(self, listener: Callable[[str, bool], Any]):
+        """Calls ``listener(user_id, online)`` when a user's first session opens or last one closes."""
+        self._listeners.append(listener)
+
+    def _notify(self, user_id: str, online: bool):
+        for listener in self._listeners:
+            listener(user_id, online)
+
+    def add(self, user_id: str, websocket: Any) -> Session:
+        session = Session(next(self._ids), user_id, websocket, self.clock())
+        sessions = self._sessions.setdefault(user_id, {})
+        sessions[session.id] = session
+        if len(sessions) == 1 and user_id not in self._polled:
+            self._notify(user_id, True)
+        return session
+
+    def remove(self, session: Session) -> bool:
+        """Drops a session; returns False if it was already gone."""
+        sessions = self._sessions.get(session.user_id)
+        if not sessions or sessions.pop(session.id, None) is None:
+            return False
+        if not sessions:
+            del self._sessions[session.user_id]
+            if session.user_id not in self._polled:
+                self._notify(session.user_id, False)
+        return True
+
+    def poll(self, user_id: str):
+        """Records a poll; the user counts as online here for ``poll_ttl`` seconds."""
+        if not self.is_local(user_id):
+            self._notify(user_id, True)
+        self._polled[user_id] = self.clock()
+
+    def expire_polls(self) -> List[str]:
+        """Forgets polls older than ``poll_ttl``; returns the users that went offline."""
+        limit = self.clock() - self.poll_ttl
+        expired = [user_id for user_id, polled_at in self._polled.items() if polled_at < limit]
+        offline = []
+        for user_id in expired:
+            del self._polled[user_id]
+            if user_id not in self._sessions:
+                offline.append(user_id)
+                self._notify(user_id, False)
+        return offline
+
+    def local_users(self) -> List[str]:
+        """Users online on this worker, by session or by a recent poll."""
+        return list(self._sessions.keys() | self._polled.keys())
+
+    def sessions(self, user_id: str) -> List[Session]:
+        return list(self._sessions.get(user_id, {}).values())
+
+    def all_sessions(self) -> List[Session]:
+        return [session for sessions in self._sessions.values() for session in sessions.values()]
+
+    def touch(self, session: Session):
+        session.last_seen = self.clock()
+
+    def quiet_sessions(self, seconds: float) -> List[Session]:
+        """Sessions silent for longer than ``seconds``."""
+        limit = self.clock() - seconds
+        return [session for session in self.all_sessions() if session.last_seen < limit]
+
+    def idle_sessions(self) -> List[Session]:
+        """Sessions silent for longer than the idle timeout."""
+        return self.quiet_sessions(self.idle_timeout)
+
+    def set_remote(self, user_id: str, node_id: str, online: bool):
+        nodes = self._remote.setdefault(user_id, set())
+        if online:
+            nodes.add(node_id)
+        else:
+            nodes.discard(node_id)
+            if not nodes:
+                del self._remote[user_id]
+
+    def is_local(self, user_id: str) -> bool:
+        return user_id in self._sessions or user_id in self._polled
+
+    def is_online(self, user_id: str) -> bool:
+        return user_id in self._sessions or user_id in self._polled or user_id in self._remote
+
+    def is_courier_online(self, courier_id: int) -> bool:
+        return self.is_online(f"courier_{courier_id}")
@@ -0,0 +1,142 @@
+"""
+Identidade do usuário autenticado, resolvida sem ir ao banco a cada request.
+
+Tokens now carry the user's id, name, role and the id of their restaurant or
+courier, so a request with a current token resolves its principal from the
+claims alone. Claims are trusted until the token expires, like the ``sub``
+claim always was.
+
+Tokens issued before these claims existed (or a courier/restaurant created
+after login) fall back to one joined query, whose result is kept in a bounded
+TTL/LRU cache keyed by email. Code that changes a user or their
+courier/restaurant calls ``principal_cache.invalidate(email)``.
+"""
+import os
+import time
+from collections import OrderedDict
+from typing import Callable, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from backend import models
+
+PRINCIPAL_CACHE_TTL = float(os.getenv("PRINCIPAL_CACHE_TTL", "300"))
+PRINCIPAL_CACHE_SIZE = int(os.getenv("PRINCIPAL_CACHE_SIZE", "10000"))
+
+
+class Principal:
+    __slots__ = ("user_id", "email", "name", "role", "restaurant_id", "courier_id")
+
+    def __init__(self, user_id: int, email: str, name: str, role: str,
+                 restaurant_id: Optional[int] = None, courier_id: Optional[int] = None):
+        self.user_id = user_id
+        self.email = email
+        self.name = name
+        self.role = role
+        self.restaurant_id = restaurant_id
+        self.courier_id = courier_id
+
+    @property
+    def entity_id(self) -> Optional[int]:
+        return self.courier_id if self.role == "COURIER" else self.restaurant_id
+
+    def claims(self) -> dict:
+        """Claims to put in the access token."""
+        return {
+            "sub": self.email,
+            "uid": self.user_id,
+            "name": self.name,
+            "role": self.role,
+            "restaurant_id": self.restaurant_id,
+            "courier_id": self.courier_id,
+        }
+
+    @classmethod
+    def from_claims(cls, payload: dict) -> Optional["Principal"]:
+        """The principal in a token, or None for tokens without the identity claims."""
+        if payload.get("uid") is None or not payload.get("role"):
+            return None
+        principal = cls(
+            payload["uid"], payload["sub"], payload.get("name", ""), payload["role"],
+            payload.get("restaurant_id"), payload.get("courier_id"),
+        )
+        # Motoboy/restaurante criado depois do login: o token não tem o id
+        if principal.role in ("COURIER", "RESTAURANT") and principal.entity_id is None:
+            return None
+        return principal
+
+
+class PrincipalCache:
+    def __init__(self, ttl: float = PRINCIPAL_CACHE_TTL, max_size: int = PRINCIPAL_CACHE_SIZE,
+                 clock: Callable[[], float] = time.monotonic):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.clock = clock
+        self._entries: "OrderedDict[str, Tuple[float, Principal]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, email: str) -> Optional[Principal]:
+        entry = self._entries.get(email)
+        if entry is None or entry[0] <= self.clock():
+            if entry is not None:
+                del self._entries[email]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(email)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, principal: Principal):
+        self._entries[principal.email] = (self.clock() + self.ttl, principal)
+        self._entries.move_to_end(principal.email)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, email: str):
+        self._entries.pop(email, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+async def load_principal(db: AsyncSession, email: str) -> Optional[Principal]:
+    """The user and the ids of their restaurant and courier, in one query."""
+    stmt = (
+        select(
+            models.User.id, models.User.email, models.User.name, models.User.role,
+            models.Restaurant.id.label("restaurant_id"), models.Courier.id.label("courier_id"),
+        )
+        .outerjoin(models.Restaurant, models.Restaurant.user_id == models.User.id)
+        .outerjoin(models.Courier, models.Courier.email == models.User.email)
+        .where(models.User.email == email)
+        .limit(1)
+    )
+    row = (await db.execute(stmt)).first()
+    if row is None:
+        return None
+    return Principal(row.id, row.email, row.name, row.role, row.restaurant_id, row.courier_id)
+
+
+async def resolve_principal(db: AsyncSession, payload: dict) -> Optional[Principal]:
+    """Principal for a decoded token: from its claims, the cache, or the database."""
+    principal = Principal.from_claims(payload)
+    if principal is not None:
+        return principal
+    email = payload.get("sub")
+    principal = principal_cache.get(email)
+    if principal is None:
+        principal = await load_principal(db, email)
+        if principal is not None:
+            principal_cache.put(principal)
+    return principal
+
+
+principal_cache = PrincipalCache()
@@ -0,0 +1,153 @@
+"""
+Recuperação e drain do dispatch no ciclo de vida da aplicação.
+
+Every order records the worker that dispatches it (``orders.dispatch_owner``,
+the worker's ``bus.node_id``) and every worker holds a lease in
+``dispatch_nodes`` that it renews periodically. A recovery pass takes over the
+SEARCHING orders whose owner is gone - no owner, or a lease that expired - and
+queues them again, oldest first: offers whose deadline has not passed are
+resumed with the same couriers, expired ones are dropped and the dispatch
+continues with the couriers that were not tried yet. Orders of live workers
+are left alone, so several replicas can run the pass at once; on Postgres an
+advisory lock serializes the passes so an orphan is claimed only once.
+
+The pass runs at startup and then with every lease renewal, which also picks
+up the orders of a replica that crashed. On shutdown the running dispatches
+are stopped, their ledger rows are kept as checkpoints and the lease is
+released so another replica resumes them on its next pass.
+"""
+import asyncio
+import datetime
+import logging
+import os
+from typing import Iterable, Optional
+
+from sqlalchemy import delete, or_, text, update
+from sqlalchemy.future import select
+
+from backend import dispatch, ledger, models
+from backend.bus import bus
+from backend.db import SessionLocal
+from backend.matching import batch_dispatcher
+from backend.scheduler import DispatchQueueFull, dispatch_scheduler
+
+logger = logging.getLogger("telego.dispatch")
+
+DISPATCH_LEASE_SECONDS = float(os.getenv("DISPATCH_LEASE_SECONDS", "30"))
+DISPATCH_LEASE_RENEW_SECONDS = float(os.getenv("DISPATCH_LEASE_RENEW_SECONDS", "10"))
+
+# Chave do advisory lock que serializa as passadas de recuperação (Postgres)
+RECOVERY_LOCK_ID = 7_412_020
+
+_task: Optional[asyncio.Task] = None
+
+
+async def recover_dispatches(session_factory=None) -> int:
+    """Renews this worker's lease and resumes the orders of dead workers; returns how many."""
+    factory = session_factory or SessionLocal
+    now = datetime.datetime.utcnow()
+    async with factory() as db:
+        if db.bind.dialect.name == "postgresql":
+            await db.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": RECOVERY_LOCK_ID})
+        await db.merge(models.DispatchNode(
+            node_id=bus.node_id, lease_until=now + datetime.timedelta(seconds=DISPATCH_LEASE_SECONDS)
+        ))
+        live = select(models.DispatchNode.node_id).where(models.DispatchNode.lease_until > now)
+        result = await db.execute(
+            select(models.Order.id, models.Order.created_at)
+            .where(
+                models.Order.status == "SEARCHING",
+                or_(models.Order.dispatch_owner.is_(None), models.Order.dispatch_owner.not_in(live)),
+            )
+            .order_by(models.Order.id)
+        )
+        orphaned = dict(result.all())
+        entries = {}
+        if orphaned:
+            await db.execute(
+                update(models.Order).where(models.Order.id.in_(orphaned)).values(dispatch_owner=bus.node_id)
+            )
+            entries = {entry.order_id: entry for entry in await ledger.load(db, orphaned)}
+
+        # Linhas de pedidos que já saíram de SEARCHING (ou foram apagados), e leases vencidos
+        await ledger.remove_finished(db)
+        await db.execute(delete(models.DispatchNode).where(models.DispatchNode.lease_until <= now))
+        await db.commit()
+
+    deferred = []
+    for order_id in orphaned:
+        entry = entries.get(order_id)
+        tried = ledger.parse_ids(entry.tried_courier_ids) if entry else set()
+        strategy = entry.strategy if entry else dispatch.DISPATCH_STRATEGY
+
+        if strategy == "batch":
+            batch_dispatcher.submit(order_id, tried=tried)
+            continue
+
+        resume = None
+        candidates = ledger.parse_ids(entry.candidate_courier_ids) if entry else set()
+        if candidates and entry.deadline and entry.deadline > now:
+            resume = (sorted(candidates), (entry.deadline - now).total_seconds())
+        try:
+            dispatch_scheduler.submit(
+                order_id, created_at=orphaned[order_id],
+                session_factory=factory, strategy=strategy, tried=tried, resume=resume,
+            )
+        except DispatchQueueFull:
+            deferred.append(order_id)
+
+    if deferred:
+        # Fila cheia: devolve os pedidos para uma próxima passada
+        async with factory() as db:
+            await release_orders(db, deferred)
+            await db.commit()
+        logger.warning("Fila de dispatch cheia; pedidos ficam para a próxima passada", extra={"orders": len(deferred)})
+    resumed = len(orphaned) - len(deferred)
+    if resumed:
+        logger.info("Dispatches retomados de workers que pararam", extra={"orders": resumed})
+    return resumed
+
+
+async def release_orders(db, order_ids: Iterable[int]):
+    """Stages giving up this worker's claim on orders it could not queue; the caller commits."""
+    await db.execute(
+        update(models.Order)
+        .where(models.Order.id.in_(list(order_ids)), models.Order.dispatch_owner == bus.node_id)
+        .values(dispatch_owner=None)
+    )
+
+
+async def _renew(interval: float, session_factory):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await recover_dispatches(session_factory)
+        except Exception:
+            logger.exception("Erro ao renovar o lease do dispatch")
+
+
+def start_recovery(interval: float = DISPATCH_LEASE_RENEW_SECONDS, session_factory=None):
+    """Renews the lease (and takes over orphaned orders) every ``interval`` seconds."""
+    global _task
+    if _task is None or _task.done():
+        _task = asyncio.create_task(_renew(interval, session_factory))
+
+
+async def release_lease(session_factory=None):
+    """Gives up this worker's lease so the other replicas resume its orders right away."""
+    async with (session_factory or SessionLocal)() as db:
+        await db.execute(delete(models.DispatchNode).where(models.DispatchNode.node_id == bus.node_id))
+        await db.commit()
+
+
+async def drain_dispatches(timeout: float = 5.0, session_factory=None):
+    """Stops batch and per-order dispatches, leaving the ledger as checkpoint."""
+    global _task
+    if _task is not None:
+        _task.cancel()
+        await asyncio.gather(_task, return_exceptions=True)
+        _task = None
+    await dispatch_scheduler.stop()
+    await batch_dispatcher.stop()
+    await dispatch.drain(timeout)
+    await release_lease(session_factory)
@@ -0,0 +1,170 @@
+"""
+Estado em memória dos motoboys, fonte de verdade do dispatch.
+
+The registry holds one compact record per courier (position, availability,
+connection and last-seen time) and keeps the spatial index in step with it:
+only available couriers are indexed. It is warmed from the database at startup
+and then updated in place by registration, location updates and WebSocket
+connect/disconnect, so dispatching an order never has to load the fleet. A
+periodic reconciliation pass picks up changes made to the database by anything
+else (admin edits, other tools).
+"""
+import asyncio
+import logging
+import os
+import time
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+from sqlalchemy.future import select
+
+from backend import models
+from backend.db import SessionLocal
+from backend.spatial import CourierIndex, courier_index
+
+logger = logging.getLogger("telego.registry")
+
+
+class CourierState:
+    __slots__ = ("id", "lat", "lng", "available", "connected", "last_seen")
+
+    def __init__(self, courier_id: int, lat: float, lng: float, available: bool = True):
+        self.id = courier_id
+        self.lat = lat
+        self.lng = lng
+        self.available = available
+        self.connected = False
+        # Momento da última localização recebida ao vivo (None = posição do banco)
+        self.last_seen: Optional[float] = None
+
+
+class CourierRegistry:
+    def __init__(self, index: Optional[CourierIndex] = None, session_factory=None):
+        self.index = index if index is not None else courier_index
+        self.session_factory = session_factory or SessionLocal
+        self._couriers: Dict[int, CourierState] = {}
+        self._warm = False
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self._couriers)
+
+    def __contains__(self, courier_id: int) -> bool:
+        return courier_id in self._couriers
+
+    def get(self, courier_id: int) -> Optional[CourierState]:
+        return self._couriers.get(courier_id)
+
+    def _reindex(self, state: CourierState):
+        if state.available:
+            self.index.insert(state.id, state.lat, state.lng)
+        else:
+            self.index.remove(state.id)
+
+    def upsert(self, courier_id: int, lat: float, lng: float, available: bool = True) -> CourierState:
+        """Adds or replaces a courier record (registration, admin changes)."""
+        state = self._couriers.get(courier_id)
+        if state is None:
+            state = self._couriers[courier_id] = CourierState(courier_id, lat, lng, bool(available))
+        else:
+            state.lat, state.lng, state.available = lat, lng, bool(available)
+        self._reindex(state)
+        return state
+
+    def remove(self, courier_id: int):
+        self._couriers.pop(courier_id, None)
+        self.index.remove(courier_id)
+
+    def set_available(self, courier_id: int, available: bool):
+        state = self._couriers.get(courier_id)
+        if state is not None and state.available != bool(available):
+            state.available = bool(available)
+            self._reindex(state)
+
+    def set_location(self, courier_id: int, lat: float, lng: float):
+        """Applies a live location update; unknown couriers are ignored."""
+        state = self._couriers.get(courier_id)
+        if state is None:
+            return
+        state.lat, state.lng = lat, lng
+        state.last_seen = time.time()
+        if state.available:
+            self.index.move(courier_id, lat, lng)
+
+    def set_connected(self, courier_id: int, connected: bool):
+        state = self._couriers.get(courier_id)
+        if state is not None:
+            state.connected = connected
+            if connected:
+                state.last_seen = state.last_seen or time.time()
+
+    def snapshot(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Consistent copy of (ids, lats, lngs) of every available courier."""
+        return self.index.snapshot()
+
+    async def _load(self, session_factory):
+        async with (session_factory or self.session_factory)() as db:
+            stmt = select(models.Courier.id, models.Courier.lat, models.Courier.lng, models.Courier.available)
+            return (await db.execute(stmt)).all()
+
+    async def warm(self, session_factory=None):
+        """Rebuilds the registry and the index from the database."""
+        rows = await self._load(session_factory)
+        self._couriers.clear()
+        self.index.sync(())
+        for row in rows:
+            self.upsert(row.id, row.lat, row.lng, bool(row.available))
+        self._warm = True
+
+    async def ensure_warm(self, session_factory=None):
+        if not self._warm:
+            await self.warm(session_factory)
+
+    async def reconcile(self, session_factory=None) -> dict:
+        """
+        Brings the registry in line with the database. Positions reported live
+        since the last load win over the stored ones, which may not be flushed yet.
+        """
+        rows = await self._load(session_factory)
+        seen = set()
+        added = updated = 0
+        for row in rows:
+            seen.add(row.id)
+            state = self._couriers.get(row.id)
+            if state is None:
+                self.upsert(row.id, row.lat, row.lng, bool(row.available))
+                added += 1
+                continue
+            lat, lng = (state.lat, state.lng) if state.last_seen is not None else (row.lat, row.lng)
+            if (lat, lng, bool(row.available)) != (state.lat, state.lng, state.available):
+                self.upsert(row.id, lat, lng, bool(row.available))
+                updated += 1
+        removed = [courier_id for courier_id in self._couriers if courier_id not in seen]
+        for courier_id in removed:
+            self.remove(courier_id)
+        self._warm = True
+        return {"added": added, "updated": updated, "removed": len(removed)}
+
+    def start(self, interval: float):
+        """Starts the periodic reconciliation loop."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(interval))
+
+    async def _run(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.reconcile()
+            except Exception:
+                logger.exception("Erro ao reconciliar motoboys com o banco")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+
+RECONCILE_SECONDS = float(os.getenv("COURIER_RECONCILE_SECONDS", "60"))
+
+courier_registry = CourierRegistry()
@@ -0,0 +1,67 @@
+"""
+Reservas de motoboys durante as ofertas de dispatch.
+
+A courier is leased to one order before the offer goes out and released on
+decline, timeout or resolution, so concurrent dispatches never offer the same
+courier at the same time. Leases expire on their own, so a dispatch that dies
+without releasing cannot keep a courier out of rotation.
+"""
+import time
+from typing import Callable, Dict, Optional, Set, Tuple
+
+
+class ReservationLedger:
+    def __init__(self, clock: Callable[[], float] = time.monotonic, default_ttl: float = 30.0):
+        self.clock = clock
+        self.default_ttl = default_ttl
+        # {courier_id: (order_id, expires_at)}
+        self._leases: Dict[int, Tuple[int, float]] = {}
+
+    def __len__(self) -> int:
+        return len(self.reserved_ids())
+
+    def reserve(self, courier_id: int, order_id: int, ttl: Optional[float] = None) -> bool:
+        """
+        Leases a courier to an order. Returns False when another order holds a
+        live lease; renews the lease when the same order reserves again.
+        """
+        now = self.clock()
+        lease = self._leases.get(courier_id)
+        if lease is not None and lease[0] != order_id and lease[1] > now:
+            return False
+        self._leases[courier_id] = (order_id, now + (ttl if ttl is not None else self.default_ttl))
+        return True
+
+    def release(self, courier_id: int, order_id: int) -> bool:
+        """Releases a lease if it is held by ``order_id``."""
+        lease = self._leases.get(courier_id)
+        if lease is None or lease[0] != order_id:
+            return False
+        del self._leases[courier_id]
+        return True
+
+    def holder(self, courier_id: int) -> Optional[int]:
+        """Order holding a live lease on the courier, if any."""
+        lease = self._leases.get(courier_id)
+        if lease is None:
+            return None
+        if lease[1] <= self.clock():
+            del self._leases[courier_id]
+            return None
+        return lease[0]
+
+    def is_reserved(self, courier_id: int, order_id: Optional[int] = None) -> bool:
+        """True when another order (or any order, if none given) holds the courier."""
+        holder = self.holder(courier_id)
+        return holder is not None and holder != order_id
+
+    def reserved_ids(self) -> Set[int]:
+        """Couriers with a live lease; expired leases are dropped on the way."""
+        now = self.clock()
+        expired = [courier_id for courier_id, (_, expires) in self._leases.items() if expires <= now]
+        for courier_id in expired:
+            del self._leases[courier_id]
+        return set(self._leases)
+
+
+reservations = ReservationLedger()
@@ -7,10 +7,12 @@ from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 from jose import JWTError, jwt
-from passlib.context import CryptContext
 from backend.db import get_db
 from backend import models
 from backend import schemas
+from backend.hashing import HasherBusy, password_hasher, pwd_context
+from backend.principals import Principal, load_principal, principal_cache, resolve_principal
+from backend.registry import courier_registry
 
 router = APIRouter(tags=["auth"])
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/token")
@@ -22,21 +24,29 @@ SECRET_KEY = os.getenv("SECRET_KEY", "telego-logistica-expressa-2026-chave-segur
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
-# Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
 # Funções de autenticação
+# Síncronas: bloqueiam o event loop, usar só fora dos handlers (scripts, testes)
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 
-def get_password_hash(password: str) -> str:
+def _truncate_password(password: str) -> str:
     # Bcrypt tem limite de 72 bytes
     if len(password.encode('utf-8')) > 72:
         # Trunca mantendo caracteres UTF-8 seguros
         truncated = password.encode('utf-8')[:72]
         password = truncated.decode('utf-8', 'ignore').rstrip('\x00')
         logger.warning(f"Senha truncada para {len(password)} caracteres devido a limite do bcrypt")
-    return pwd_context.hash(password)
+    return password
+
+def get_password_hash(password: str) -> str:
+    return pwd_context.hash(_truncate_password(password))
+
+def _hasher_busy():
+    return HTTPException(
+        status_code=503,
+        detail="Servidor ocupado, tente novamente em instantes",
+        headers={"Retry-After": "1"},
+    )
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
@@ -55,17 +65,18 @@ def decode_access_token(token: str):
     except JWTError:
         return None
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)):
+async def get_current_principal(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)) -> Principal:
     payload = decode_access_token(token)
     if not payload or "sub" not in payload:
         raise HTTPException(status_code=401, detail="Invalid token")
-    email = payload.get("sub")
-    stmt = select(models.User).where(models.User.email == email)
-    result = await db.execute(stmt)
-    user = result.scalars().first()
-    if not user:
+    principal = await resolve_principal(db, payload)
+    if principal is None:
         raise HTTPException(status_code=401, detail="User not found")
-    return user
+    return principal
+
+async def get_current_user(principal: Principal = Depends(get_current_principal)):
+    # Objeto transiente: a identidade vem do token/cache, não de uma consulta
+    return models.User(id=principal.user_id, email=principal.email, name=principal.name, role=principal.role)
 
 @router.post("/register", response_model=schemas.Token)
 async def register(user_in: schemas.UserCreate, db: AsyncSession = Depends(get_db)):
@@ -86,7 +97,10 @@ async def register(user_in: schemas.UserCreate, db: AsyncSession = Depends(get_d
             )
 
         # 3. Cria usuário
-        hashed_password = get_password_hash(user_in.password)
+        try:
+            hashed_password = await password_hasher.hash(_truncate_password(user_in.password))
+        except HasherBusy:
+            raise _hasher_busy()
         new_user = models.User(
             email=user_in.email,
             hashed_password=hashed_password,
@@ -118,8 +132,16 @@ async def register(user_in: schemas.UserCreate, db: AsyncSession = Depends(get_d
 
         await db.commit()
 
+        principal = Principal(new_user.id, new_user.email, new_user.name, new_user.role)
+        if new_user.role == "RESTAURANT":
+            principal.restaurant_id = restaurant.id
+        elif new_user.role == "COURIER":
+            principal.courier_id = courier.id
+            courier_registry.upsert(courier.id, courier.lat, courier.lng)
+        principal_cache.invalidate(new_user.email)
+
         # 5. Gera token
-        access_token = create_access_token(data={"sub": new_user.email})
+        access_token = create_access_token(data=principal.claims())
         logger.info(f"Usuário registrado com sucesso: {user_in.email} (role={user_in.role})")
         
         return {
@@ -151,14 +173,26 @@ async def login_for_access_token(
     result = await db.execute(stmt)
     user = result.scalars().first()
 
-    if not user or not verify_password(form_data.password, user.hashed_password):
+    valid, new_hash = False, None
+    if user:
+        try:
+            valid, new_hash = await password_hasher.verify(_truncate_password(form_data.password), user.hashed_password)
+        except HasherBusy:
+            raise _hasher_busy()
+    if not valid:
         raise HTTPException(
             status_code=401,
             detail="Email ou senha incorretos",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    if new_hash:
+        # Parâmetros do bcrypt mudaram: aproveita a senha em mãos para atualizar o hash
+        user.hashed_password = new_hash
+        await db.commit()
     
-    access_token = create_access_token(data={"sub": user.email})
+    principal = await load_principal(db, user.email)
+    principal_cache.put(principal)
+    access_token = create_access_token(data=principal.claims())
     return {
         "access_token": access_token, 
         "token_type": "Bearer", 
@@ -171,14 +205,11 @@ async def login_for_access_token(
     }
 
 @router.get("/me")
-async def get_me(
-    current_user: models.User = Depends(get_current_user), 
-    db: AsyncSession = Depends(get_db)
-):
+async def get_me(current_user: Principal = Depends(get_current_principal)):
     # Retorna o usuário e o ID do restaurante/entregador associado
     response = {
         "user": {
-            "id": current_user.id,
+            "id": current_user.user_id,
             "email": current_user.email,
             "name": current_user.name,
             "role": current_user.role
@@ -186,15 +217,9 @@ async def get_me(
     }
     
     if current_user.role == "RESTAURANT":
-        stmt = select(models.Restaurant).where(models.Restaurant.user_id == current_user.id)
-        result = await db.execute(stmt)
-        restaurant = result.scalars().first()
-        response["restaurant_id"] = restaurant.id if restaurant else None
+        response["restaurant_id"] = current_user.restaurant_id
     
     elif current_user.role == "COURIER":
-        stmt = select(models.Courier).where(models.Courier.user_id == current_user.id)
-        result = await db.execute(stmt)
-        courier = result.scalars().first()
-        response["courier_id"] = courier.id if courier else None
+        response["courier_id"] = current_user.courier_id
     
-    return response
\ No newline at end of file
+    return response
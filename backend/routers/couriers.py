@@ -6,6 +6,8 @@ from typing import List
 from backend.db import SessionLocal, get_db
 from backend import models
 from backend import schemas
+from backend.principals import principal_cache
+from backend.registry import courier_registry
 
 router = APIRouter(prefix="/couriers", tags=["couriers"])
 
@@ -18,6 +20,9 @@ async def create_courier(courier: schemas.CourierCreate, db: AsyncSession = Depe
     db.add(db_courier)
     await db.commit()
     await db.refresh(db_courier)
+    courier_registry.upsert(db_courier.id, db_courier.lat, db_courier.lng, bool(db_courier.available))
+    # Um usuário com este email passa a ser motoboy
+    principal_cache.invalidate(db_courier.email)
     return db_courier
 
 @router.get("/", response_model=List[schemas.Courier])
@@ -0,0 +1,45 @@
+from fastapi import APIRouter
+
+from backend.db import pool_status
+from backend.hashing import password_hasher
+from backend.locations import location_pipeline
+from backend.loop_monitor import loop_monitor
+from backend.scheduler import dispatch_scheduler
+from backend.websocket_manager import manager
+
+router = APIRouter(prefix="/health", tags=["health"])
+
+@router.get("/pool")
+async def get_pool_status():
+    """
+    Returns the occupancy of the database connection pool.
+    """
+    return pool_status()
+
+@router.get("/locations")
+async def get_location_pipeline_status():
+    """
+    Returns the write-behind location pipeline counters.
+    """
+    return location_pipeline.stats()
+
+@router.get("/websockets")
+async def get_websocket_status():
+    """
+    Returns the outbound queue depth and send latency of each WebSocket connection.
+    """
+    return manager.stats()
+
+@router.get("/dispatch")
+async def get_dispatch_status():
+    """
+    Returns the dispatch queue length, wait times and in-flight dispatches.
+    """
+    return dispatch_scheduler.stats()
+
+@router.get("/loop")
+async def get_loop_status():
+    """
+    Returns event loop stall measurements and the password hashing pool counters.
+    """
+    return {"loop": loop_monitor.stats(), "hashing": password_hasher.stats()}
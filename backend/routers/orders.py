@@ -1,21 +1,46 @@
 import asyncio
-from fastapi import APIRouter, Depends, HTTPException, status
+import base64
+import datetime
+import logging
+import os
+from fastapi import APIRouter, Body, Depends, HTTPException, Query, Request, Response, status
+from fastapi.responses import StreamingResponse
 from fastapi.security import OAuth2PasswordBearer
 from sqlalchemy.ext.asyncio import AsyncSession
+from pydantic import ValidationError
+from sqlalchemy import insert, or_, tuple_
 from sqlalchemy.future import select
-from typing import List
+from typing import Any, List, Optional
 
 
 from backend import models
 from backend import schemas
+from backend.bus import bus
 from backend.db import SessionLocal, get_db
 from backend.security import decode_access_token
-from backend import dispatch
+from backend import dispatch, ledger
+from backend.encoding import dumps
+from backend.matching import batch_dispatcher
+from backend.principals import resolve_principal
+from backend.recovery import release_orders
+from backend.scheduler import DispatchQueueFull, dispatch_scheduler
+from backend.websocket_manager import QueueConnection, manager
 
 router = APIRouter(prefix="/orders", tags=["orders"])
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/token")
+logger = logging.getLogger("telego.orders")
 
-async def get_current_user_email(token: str = Depends(oauth2_scheme)):
+# Intervalo dos comentários de keepalive do SSE
+SSE_KEEPALIVE_SECONDS = 15.0
+
+# Máximo de pedidos por chamada de /orders/bulk
+ORDER_BULK_MAX = int(os.getenv("ORDER_BULK_MAX", "500"))
+
+# Tamanho de página do histórico de pedidos
+ORDER_PAGE_SIZE = int(os.getenv("ORDER_PAGE_SIZE", "50"))
+ORDER_PAGE_SIZE_MAX = int(os.getenv("ORDER_PAGE_SIZE_MAX", "200"))
+
+async def get_current_token_payload(token: str = Depends(oauth2_scheme)):
     payload = decode_access_token(token)
     if not payload or "sub" not in payload:
         raise HTTPException(
@@ -23,18 +48,48 @@ async def get_current_user_email(token: str = Depends(oauth2_scheme)):
             detail="Invalid authentication credentials",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    return payload
+
+async def get_current_user_email(payload: dict = Depends(get_current_token_payload)):
     return payload.get("sub")
 
-async def get_current_courier(email: str = Depends(get_current_user_email), db: AsyncSession = Depends(get_db)):
-    stmt = select(models.Courier).where(models.Courier.email == email)
-    result = await db.execute(stmt)
-    courier = result.scalars().first()
-    if courier is None:
+async def get_current_courier(payload: dict = Depends(get_current_token_payload), db: AsyncSession = Depends(get_db)):
+    principal = await resolve_principal(db, payload)
+    if principal is None or principal.courier_id is None:
         raise HTTPException(status_code=404, detail="Courier not found")
-    return courier
+    # Objeto transiente: as rotas só usam o id e o email do motoboy
+    return models.Courier(id=principal.courier_id, email=principal.email)
+
+def _check_dispatch_capacity():
+    if dispatch.DISPATCH_STRATEGY != "batch" and dispatch_scheduler.full():
+        # Fila de dispatch cheia: recusa antes de criar o pedido
+        raise HTTPException(
+            status_code=503,
+            detail="Muitos pedidos aguardando motoboy, tente novamente em instantes",
+            headers={"Retry-After": "5"},
+        )
+
+def _enqueue_dispatch(order_id: int, created_at: datetime.datetime) -> bool:
+    """Queues the order for dispatch; False when the dispatch queue refused it."""
+    if dispatch.DISPATCH_STRATEGY == "batch":
+        batch_dispatcher.submit(order_id)
+        return True
+    try:
+        dispatch_scheduler.submit(order_id, created_at=created_at)
+    except DispatchQueueFull:
+        return False
+    return True
+
+async def _defer_dispatch(db: AsyncSession, order_ids: List[int]):
+    # A fila encheu depois da checagem: o pedido já existe, então fica para a
+    # próxima passada de recuperação em vez de falhar a requisição
+    await release_orders(db, order_ids)
+    await db.commit()
+    logger.warning("Fila de dispatch cheia; dispatch adiado", extra={"orders": len(order_ids)})
 
 @router.post("/", response_model=schemas.Order)
 async def create_order(order: schemas.OrderCreate, db: AsyncSession = Depends(get_db)):
+    _check_dispatch_capacity()
     new_order = models.Order(
         restaurant_id=order.restaurant_id,
         customer_name=order.customer_name,
@@ -42,68 +97,284 @@ async def create_order(order: schemas.OrderCreate, db: AsyncSession = Depends(ge
         pickup_address=order.pickup_address,
         price=order.price,
         order_value=order.order_value,
-        status="SEARCHING"
+        status="SEARCHING",
+        dispatch_owner=bus.node_id,
     )
     db.add(new_order)
     await db.commit()
     await db.refresh(new_order)
 
-    asyncio.create_task(dispatch.dispatch_order(new_order.id))
+    if not _enqueue_dispatch(new_order.id, new_order.created_at):
+        await _defer_dispatch(db, [new_order.id])
+        await db.refresh(new_order)
 
     return new_order
 
+@router.post("/bulk", response_model=schemas.OrderBulkResult)
+async def create_orders_bulk(items: List[Any] = Body(...), db: AsyncSession = Depends(get_db)):
+    """
+    Creates many orders in one multi-row INSERT ... RETURNING and queues them
+    for dispatch. Items that fail validation, name an unknown restaurant or do
+    not fit in the dispatch queue are reported by index without failing the
+    rest of the batch.
+    """
+    if len(items) > ORDER_BULK_MAX:
+        raise HTTPException(status_code=413, detail=f"Máximo de {ORDER_BULK_MAX} pedidos por lote")
+    _check_dispatch_capacity()
+
+    results = [schemas.OrderBulkItem(index=i) for i in range(len(items))]
+    valid = []
+    for i, item in enumerate(items):
+        try:
+            valid.append((i, schemas.OrderCreate.model_validate(item)))
+        except ValidationError as e:
+            results[i].error = "; ".join(
+                f"{'.'.join(str(part) for part in err['loc']) or 'item'}: {err['msg']}" for err in e.errors()
+            )
+
+    # Restaurante inexistente derrubaria o lote inteiro na FK do Postgres
+    restaurant_ids = {order.restaurant_id for _, order in valid}
+    known = set((await db.execute(
+        select(models.Restaurant.id).where(models.Restaurant.id.in_(restaurant_ids))
+    )).scalars()) if restaurant_ids else set()
+    rows = []
+    for i, order in valid:
+        if order.restaurant_id in known:
+            rows.append((i, order))
+        else:
+            results[i].error = "Restaurante não encontrado"
+
+    if dispatch.DISPATCH_STRATEGY != "batch":
+        # Só cria o que cabe na fila de dispatch; o resto volta como erro do item
+        room = dispatch_scheduler.room()
+        for i, _ in rows[room:]:
+            results[i].error = "Fila de dispatch cheia, tente novamente em instantes"
+        rows = rows[:room]
+
+    if rows:
+        # RETURNING na ordem dos parâmetros: cada id volta para o item que o gerou
+        stmt = insert(models.Order).returning(models.Order.id, models.Order.created_at, sort_by_parameter_order=True)
+        created = (await db.execute(
+            stmt, [dict(order.model_dump(), status="SEARCHING", dispatch_owner=bus.node_id) for _, order in rows]
+        )).all()
+        await db.commit()
+        deferred = []
+        for (i, _), row in zip(rows, created):
+            results[i].id = row.id
+            if not _enqueue_dispatch(row.id, row.created_at):
+                deferred.append(row.id)
+        if deferred:
+            await _defer_dispatch(db, deferred)
+
+    return schemas.OrderBulkResult(created=len(rows), failed=len(items) - len(rows), results=results)
+
+# Só as colunas que schemas.Order devolve, mais o nome do restaurante
+ORDER_LISTING_COLUMNS = (
+    models.Order.id,
+    models.Order.restaurant_id,
+    models.Order.courier_id,
+    models.Order.customer_name,
+    models.Order.delivery_address,
+    models.Order.pickup_address,
+    models.Order.price,
+    models.Order.order_value,
+    models.Order.status,
+    models.Order.current_candidate_courier_id,
+    models.Order.offer_sent_at,
+    models.Order.attempt_count,
+    models.Order.created_at,
+    models.Restaurant.name.label("restaurantName"),
+)
+
+def _order_listing():
+    """Order listing with the restaurant joined in the same round trip."""
+    return select(*ORDER_LISTING_COLUMNS).outerjoin(
+        models.Restaurant, models.Restaurant.id == models.Order.restaurant_id
+    )
+
+async def _available_orders(db: AsyncSession, courier_id: int):
+    stmt = _order_listing().where(
+        models.Order.status == "SEARCHING",
+        or_(
+            models.Order.current_candidate_courier_id == courier_id,
+            models.Order.id.in_(dispatch.offers_for_courier(courier_id))
+        )
+    )
+    result = await db.execute(stmt)
+    return result.all()
+
 @router.get("/available", response_model=List[schemas.Order])
 async def get_available_orders(db: AsyncSession = Depends(get_db), current_courier: models.Courier = Depends(get_current_courier)):
     """
     Retorna pedidos que estão aguardando resposta deste motoboy específico.
     Isso serve como fallback caso o WebSocket falhe.
     """
-    stmt = select(models.Order).where(
-        models.Order.status == "SEARCHING",
-        models.Order.current_candidate_courier_id == current_courier.id
-    )
-    result = await db.execute(stmt)
-    orders = result.scalars().all()
-    
-    for order in orders:
-        stmt_res = select(models.Restaurant).where(models.Restaurant.id == order.restaurant_id)
-        res = await db.execute(stmt_res)
-        restaurant = res.scalars().first()
-        if restaurant:
-            order.restaurantName = restaurant.name
-                
-    return orders
+    # Quem consulta por polling continua recebendo ofertas
+    manager.poll(f"courier_{current_courier.id}")
+    return await _available_orders(db, current_courier.id)
+
+def _mailbox_headers(response: Response, user_id: str):
+    # Para o cliente retomar a próxima espera de onde parou
+    response.headers["X-Mailbox-Epoch"] = manager.mailboxes.epoch
+    response.headers["X-Mailbox-Seq"] = str(manager.mailboxes.last_seq(user_id))
+
+@router.get("/available/wait", response_model=List[schemas.Order])
+async def wait_for_available_orders(
+    response: Response,
+    timeout: float = Query(25.0, ge=0, le=60),
+    last_seq: Optional[int] = None,
+    epoch: Optional[str] = None,
+    db: AsyncSession = Depends(get_db),
+    current_courier: models.Courier = Depends(get_current_courier)
+):
+    """
+    Long-poll de /available: se não há pedido aguardando o motoboy, segura a
+    requisição até chegar uma oferta ou o tempo acabar (lista vazia).
+    Com ``last_seq``/``epoch`` (devolvidos nos cabeçalhos X-Mailbox-Seq e
+    X-Mailbox-Epoch) as ofertas perdidas entre duas chamadas também acordam.
+    """
+    courier_id = current_courier.id
+    user_id = f"courier_{courier_id}"
+    manager.poll(user_id)
+    orders = await _available_orders(db, courier_id)
+    if orders or timeout == 0:
+        _mailbox_headers(response, user_id)
+        return orders
+    # Não segura uma conexão do banco enquanto espera
+    await db.rollback()
+
+    connection = QueueConnection()
+    session = await manager.connect(connection, user_id, "COURIER")
+    woken = False
+    try:
+        manager.resume(session, last_seq, epoch)
+        deadline = asyncio.get_running_loop().time() + timeout
+        while not woken:
+            remaining = deadline - asyncio.get_running_loop().time()
+            message = await connection.receive(max(remaining, 0))
+            if message is None:
+                break
+            woken = message["type"] == "NEW_ORDER"
+    finally:
+        await manager.disconnect(user_id, session)
+        _mailbox_headers(response, user_id)
+    return await _available_orders(db, courier_id) if woken else []
+
+@router.get("/stream")
+async def stream_courier_events(
+    request: Request,
+    epoch: Optional[str] = None,
+    current_courier: models.Courier = Depends(get_current_courier)
+):
+    """
+    Server-Sent Events com as mesmas mensagens do WebSocket do motoboy.
+    O ``id`` de cada evento é a sequência da caixa postal; o cabeçalho
+    Last-Event-ID (com ``epoch``) retoma de onde o cliente parou.
+    """
+    user_id = f"courier_{current_courier.id}"
+    last_event_id = request.headers.get("last-event-id")
+    last_seq = int(last_event_id) if last_event_id and last_event_id.isdigit() else None
+
+    connection = QueueConnection()
+    session = await manager.connect(connection, user_id, "COURIER")
+    manager.resume(session, last_seq, epoch)
+
+    async def events():
+        try:
+            while True:
+                message = await connection.receive(SSE_KEEPALIVE_SECONDS)
+                if message is None:
+                    if connection.closed_with is not None:
+                        return
+                    # Comentário de keepalive; também conta como sinal de vida
+                    manager.touch(session)
+                    yield ": keepalive\n\n"
+                    continue
+                manager.touch(session)
+                event_id = f"id: {message['seq']}\n" if "seq" in message else ""
+                yield f"{event_id}event: {message['type']}\ndata: {dumps(message).decode('utf-8')}\n\n"
+        finally:
+            await manager.disconnect(user_id, session)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+def encode_cursor(created_at: datetime.datetime, order_id: int) -> str:
+    raw = f"{created_at.isoformat()}|{order_id}".encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("utf-8")
+        created_at, order_id = raw.rsplit("|", 1)
+        return datetime.datetime.fromisoformat(created_at), int(order_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+
+class OrderHistoryParams:
+    """Query parameters shared by the paginated history endpoints."""
+
+    def __init__(
+        self,
+        status: Optional[List[str]] = Query(None),
+        created_from: Optional[datetime.datetime] = None,
+        created_to: Optional[datetime.datetime] = None,
+        limit: Optional[int] = Query(None, ge=1, le=ORDER_PAGE_SIZE_MAX),
+        cursor: Optional[str] = None,
+    ):
+        self.status = status
+        self.created_from = created_from
+        self.created_to = created_to
+        self.cursor = decode_cursor(cursor) if cursor else None
+        # Sem limit nem cursor o cliente quer a lista inteira (é o que o app faz hoje)
+        if limit is None and self.cursor is not None:
+            limit = ORDER_PAGE_SIZE
+        self.limit = limit
+
+async def _order_history(db: AsyncSession, response: Response, owner_column, owner_id: int, params: OrderHistoryParams):
+    """
+    One page of an entity's orders, newest first, keyset-paginated on
+    ``(created_at, id)`` so every page is a range scan of the composite index
+    on the owner column. ``X-Next-Cursor`` is set when there is another page.
+    Callers that send neither ``limit`` nor ``cursor`` get every order.
+    """
+    stmt = _order_listing().where(owner_column == owner_id)
+    if params.status:
+        stmt = stmt.where(models.Order.status.in_(params.status))
+    if params.created_from is not None:
+        stmt = stmt.where(models.Order.created_at >= params.created_from)
+    if params.created_to is not None:
+        stmt = stmt.where(models.Order.created_at < params.created_to)
+    if params.cursor is not None:
+        stmt = stmt.where(tuple_(models.Order.created_at, models.Order.id) < params.cursor)
+    stmt = stmt.order_by(models.Order.created_at.desc(), models.Order.id.desc())
+    if params.limit is None:
+        return (await db.execute(stmt)).all()
+
+    rows = (await db.execute(stmt.limit(params.limit + 1))).all()
+    # Uma linha a mais só para saber se existe próxima página
+    if len(rows) > params.limit:
+        rows = rows[:params.limit]
+        last = rows[-1]
+        response.headers["X-Next-Cursor"] = encode_cursor(last.created_at, last.id)
+    return rows
 
 @router.get("/restaurant/{restaurant_id}", response_model=List[schemas.Order])
-async def get_restaurant_orders(restaurant_id: int, db: AsyncSession = Depends(get_db)):
-    stmt = select(models.Order).where(models.Order.restaurant_id == restaurant_id)
-    result = await db.execute(stmt)
-    orders = result.scalars().all()
-    
-    # Adicionamos metadados para o frontend
-    for order in orders:
-        order.restaurantName = "Seu Restaurante"
-        order.pickupAddress = "Endereço da Loja"
-        order.deliveryAddress = "Endereço do Cliente"
-        order.price = 12.0
-        order.orderValue = 0.0
-        
-    return orders
+async def get_restaurant_orders(
+    restaurant_id: int,
+    response: Response,
+    params: OrderHistoryParams = Depends(),
+    db: AsyncSession = Depends(get_db)
+):
+    return await _order_history(db, response, models.Order.restaurant_id, restaurant_id, params)
 
 @router.get("/courier/{courier_id}", response_model=List[schemas.Order])
-async def get_courier_orders(courier_id: int, db: AsyncSession = Depends(get_db)):
-    stmt = select(models.Order).where(models.Order.courier_id == courier_id)
-    result = await db.execute(stmt)
-    orders = result.scalars().all()
-    
-    for order in orders:
-        stmt_res = select(models.Restaurant).where(models.Restaurant.id == order.restaurant_id)
-        res = await db.execute(stmt_res)
-        restaurant = res.scalars().first()
-        if restaurant:
-            order.restaurantName = restaurant.name
-            
-    return orders
+async def get_courier_orders(
+    courier_id: int,
+    response: Response,
+    params: OrderHistoryParams = Depends(),
+    db: AsyncSession = Depends(get_db)
+):
+    return await _order_history(db, response, models.Order.courier_id, courier_id, params)
 
 @router.post("/{order_id}/respond", response_model=schemas.Order)
 async def respond_to_order(
@@ -119,23 +390,29 @@ async def respond_to_order(
     if not order:
         raise HTTPException(status_code=404, detail="Pedido não encontrado")
 
-    if order.current_candidate_courier_id != current_courier.id:
+    offered_to = dispatch.open_offers.get(order_id)
+    if offered_to is None and not dispatch.dispatcher.owns(order_id):
+        # Dispatch rodando em outro worker: a oferta aberta está no ledger
+        entry = await db.get(models.DispatchLedger, order_id)
+        offered_to = ledger.parse_ids(entry.candidate_courier_ids) if entry else set()
+    if order.current_candidate_courier_id != current_courier.id and current_courier.id not in (offered_to or ()):
         raise HTTPException(status_code=403, detail="Não é a sua vez de responder a este pedido")
 
     if response:
-        order.courier_id = current_courier.id
-        order.status = "ASSIGNED"
-        print(f"✅ Pedido {order_id} ACEITO pelo motoboy {current_courier.id}")
-    else:
-        order.current_candidate_courier_id = None
-        print(f"❌ Pedido {order_id} RECUSADO pelo motoboy {current_courier.id}")
+        # O primeiro aceite vence; os demais, e quem aceita uma oferta vencida, recebem 409
+        if not await dispatch.claim_order(db, order_id, current_courier.id):
+            raise HTTPException(status_code=409, detail="Pedido já foi aceito por outro motoboy ou a oferta expirou")
+        logger.info("Pedido aceito", extra={"order_id": order_id, "courier_id": current_courier.id})
 
-    await db.commit()
+        # Sinaliza o dispatch que uma resposta foi recebida
+        dispatch.signal_response(order.id, current_courier.id, True)
+    else:
+        if order.current_candidate_courier_id == current_courier.id:
+            order.current_candidate_courier_id = None
+        await db.commit()
+        logger.info("Pedido recusado", extra={"order_id": order_id, "courier_id": current_courier.id})
 
-    # Sinaliza o loop de dispatch que uma resposta foi recebida
-    from backend.dispatch import courier_responses
-    if order.id in courier_responses:
-        courier_responses[order.id].set()
+        dispatch.decline_offer(order_id, current_courier.id)
 
     await db.refresh(order)
     return order
@@ -159,9 +436,8 @@ async def update_order_status(order_id: int, status: str, db: AsyncSession = Dep
         await manager.notify_order_update(order.id, status, f"restaurant_{order.restaurant_id}")
         if order.courier_id:
             await manager.notify_order_update(order.id, status, f"courier_{order.courier_id}")
-        print(f"✅ Notificação de status '{status}' enviada para o pedido {order.id}")
-    except Exception as e:
-        print(f"❌ Erro ao enviar notificação de status: {e}")
+    except Exception:
+        logger.exception("Erro ao enviar notificação de status", extra={"order_id": order.id, "status": status})
         
     return order
 
@@ -183,6 +459,7 @@ async def cancel_order(order_id: int, db: AsyncSession = Depends(get_db)):
     except:
         pass
 
+    await ledger.remove(db, order_id)
     await db.delete(order)
     await db.commit()
     
@@ -1,42 +1,74 @@
 """
 WebSocket Router para comunicações em tempo real
 """
+import logging
+from typing import Optional
+
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect
+from backend.locations import location_pipeline
+from backend.registry import courier_registry
 from backend.websocket_manager import manager
 
 router = APIRouter()
+logger = logging.getLogger("telego.ws")
+
+def _sync_courier_presence(user_id: str, online: bool):
+    # O registro de motoboys acompanha a primeira/última sessão neste worker
+    if not user_id.startswith("courier_"):
+        return
+    try:
+        courier_id = int(user_id.split("_", 1)[1])
+    except ValueError:
+        # Presença vinda de outro worker com id malformado: não derruba o listener
+        logger.warning("Presença com id de motoboy inválido", extra={"user_id": user_id})
+        return
+    courier_registry.set_connected(courier_id, online)
+
+manager.presence.on_change(_sync_courier_presence)
 
 @router.websocket("/ws/courier/{courier_id}")
-async def courier_websocket_endpoint(websocket: WebSocket, courier_id: str):
+async def courier_websocket_endpoint(websocket: WebSocket, courier_id: int, last_seq: Optional[int] = None, epoch: Optional[str] = None):
     """
     WebSocket para motoboys receberem notificações de pedidos
+    Na reconexão, ``last_seq`` e ``epoch`` recuperam só as mensagens perdidas
     """
     user_id = f"courier_{courier_id}"
     
-    await manager.connect(websocket, user_id, "COURIER")
+    session = await manager.connect(websocket, user_id, "COURIER")
+    manager.resume(session, last_seq, epoch)
     
     try:
         # Mantém a conexão aberta e escuta por mensagens
         while True:
             # Recebe dados do motoboy (ex: localização, status)
             data = await websocket.receive_json()
+            # Qualquer mensagem conta como sinal de vida
+            manager.touch(session)
             
             # Processa diferentes tipos de mensagens
             if data.get("type") == "LOCATION_UPDATE":
-                lat = data.get("lat")
-                lng = data.get("lng")
-                print(f"📍 Motoboy {courier_id} atualizou localização: {lat}, {lng}")
-                # Aqui você poderia salvar no banco de dados
+                try:
+                    lat = float(data.get("lat"))
+                    lng = float(data.get("lng"))
+                except (TypeError, ValueError):
+                    continue
+                if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+                    continue
+                # Vai para a memória na hora e para o banco no próximo flush
+                await location_pipeline.put(courier_id, lat, lng)
                 
-            elif data.get("type") == "HEARTBEAT":
-                # Só para manter a conexão ativa
+            elif data.get("type") in ("HEARTBEAT", "PONG"):
+                # Heartbeat do app ou resposta ao PING do servidor (o touch acima já registrou)
                 pass
                 
             elif data.get("type") == "ORDER_RESPONSE":
                 # Resposta a um pedido (aceitar/recusar) via WebSocket
                 order_id = data.get("order_id")
                 accepted = data.get("accepted")
-                print(f"📩 Motoboy {courier_id} respondeu pedido {order_id} via WS: {'ACEITO' if accepted else 'RECUSADO'}")
+                logger.info(
+                    "Resposta de oferta via WebSocket",
+                    extra={"order_id": order_id, "courier_id": courier_id, "accepted": bool(accepted)},
+                )
                 
                 # Importação local para evitar circular import
                 from backend.routers.orders import respond_to_order
@@ -46,33 +78,37 @@ async def courier_websocket_endpoint(websocket: WebSocket, courier_id: str):
                     # Buscamos o motoboy para passar para a função
                     from sqlalchemy import select
                     from backend import models
-                    stmt = select(models.Courier).where(models.Courier.id == int(courier_id))
+                    stmt = select(models.Courier).where(models.Courier.id == courier_id)
                     result = await db.execute(stmt)
                     courier = result.scalars().first()
                     
                     if courier:
                         try:
                             await respond_to_order(order_id, accepted, db, courier)
-                            print(f"✅ Resposta do pedido {order_id} processada com sucesso")
-                        except Exception as e:
-                            print(f"❌ Erro ao processar respond_to_order via WS: {e}")
+                        except Exception:
+                            logger.exception(
+                                "Erro ao processar resposta via WebSocket",
+                                extra={"order_id": order_id, "courier_id": courier_id},
+                            )
                 
     except WebSocketDisconnect:
         # Remove a conexão quando desconectar
-        await manager.disconnect(user_id)
-        print(f"❌ Motoboy {courier_id} desconectado")
-    except Exception as e:
-        print(f"❌ Erro no WebSocket do motoboy {courier_id}: {e}")
-        await manager.disconnect(user_id)
+        await manager.disconnect(user_id, session)
+        logger.debug("Motoboy desconectado", extra={"courier_id": courier_id})
+    except Exception:
+        logger.warning("Erro no WebSocket do motoboy", exc_info=True, extra={"courier_id": courier_id})
+        await manager.disconnect(user_id, session)
 
 @router.websocket("/ws/restaurant/{restaurant_id}")
-async def restaurant_websocket_endpoint(websocket: WebSocket, restaurant_id: str):
+async def restaurant_websocket_endpoint(websocket: WebSocket, restaurant_id: int, last_seq: Optional[int] = None, epoch: Optional[str] = None):
     """
     WebSocket para restaurantes receberem atualizações de pedidos
+    Na reconexão, ``last_seq`` e ``epoch`` recuperam só as mensagens perdidas
     """
     user_id = f"restaurant_{restaurant_id}"
     
-    await manager.connect(websocket, user_id, "RESTAURANT")
+    session = await manager.connect(websocket, user_id, "RESTAURANT")
+    manager.resume(session, last_seq, epoch)
     
     try:
         # Restaurante só escuta atualizações (não envia muitas coisas)
@@ -80,13 +116,14 @@ async def restaurant_websocket_endpoint(websocket: WebSocket, restaurant_id: str
             # Apenas mantém a conexão aberta
             # Pode receber pings/heartbeats
             data = await websocket.receive_text()
+            manager.touch(session)
             
             if data == "ping":
                 await websocket.send_text("pong")
                 
     except WebSocketDisconnect:
-        await manager.disconnect(user_id)
-        print(f"❌ Restaurante {restaurant_id} desconectado")
-    except Exception as e:
-        print(f"❌ Erro no WebSocket do restaurante {restaurant_id}: {e}")
-        await manager.disconnect(user_id)
\ No newline at end of file
+        await manager.disconnect(user_id, session)
+        logger.debug("Restaurante desconectado", extra={"restaurant_id": restaurant_id})
+    except Exception:
+        logger.warning("Erro no WebSocket do restaurante", exc_info=True, extra={"restaurant_id": restaurant_id})
+        await manager.disconnect(user_id, session)
\ No newline at end of file
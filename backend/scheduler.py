@@ -0,0 +1,184 @@
+"""
+Fila de dispatch com prioridade e número limitado de workers.
+
+Orders are not handed to the dispatch engine as soon as they are created. They
+wait in a priority queue ordered by their due time (creation time plus the
+dispatch SLA, so the oldest orders go first) and a fixed pool of workers feeds
+them to the engine. A worker carries an order only until its first offer went
+out - loading the order, planning the waves and recording the offer, the part
+that needs database sessions - and then takes the next one; waiting for the
+couriers costs the engine a timing-wheel entry, not a worker. ``workers``
+therefore bounds how many dispatches start at once, not how many are open, so
+a burst of orders waits in the queue instead of opening a database session per
+order at once while slow couriers do not hold the queue back.
+
+The queue holds at most ``queue_limit`` orders: ``submit`` raises
+``DispatchQueueFull`` beyond that. The API checks ``full()`` first to refuse new
+orders with a 503 before creating them; an order refused after it was created
+(the queue filled up in between) or during recovery is handed back by clearing
+its dispatch owner, so a later recovery pass (``backend.recovery``) queues it
+again. Orders left in the queue at shutdown stay SEARCHING in the database and
+are picked up the same way.
+"""
+import asyncio
+import datetime
+import itertools
+import logging
+import os
+import time
+from typing import Dict, List, Optional
+
+from backend import dispatch
+from backend.metrics import metrics
+
+logger = logging.getLogger("telego.dispatch")
+
+DISPATCH_WORKERS = int(os.getenv("DISPATCH_WORKERS", "50"))
+DISPATCH_QUEUE_LIMIT = int(os.getenv("DISPATCH_QUEUE_LIMIT", "1000"))
+DISPATCH_SLA_SECONDS = float(os.getenv("DISPATCH_SLA_SECONDS", "120"))
+
+QUEUE_WAIT = metrics.histogram(
+    "telego_dispatch_queue_wait_seconds", "Time an order waits in the dispatch queue before a worker takes it.",
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300),
+)
+
+
+class DispatchQueueFull(Exception):
+    """The dispatch queue is at ``queue_limit``; the order was not queued."""
+
+
+class DispatchScheduler:
+    def __init__(self, workers: int = DISPATCH_WORKERS, queue_limit: int = DISPATCH_QUEUE_LIMIT,
+                 sla_seconds: float = DISPATCH_SLA_SECONDS, engine=None):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.sla_seconds = sla_seconds
+        self.engine = engine or dispatch.dispatcher
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._workers: List[asyncio.Task] = []
+        self._queued: Dict[int, float] = {}
+        self._seq = itertools.count()
+        self.in_flight = 0
+        self.dispatching = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def __len__(self) -> int:
+        return len(self._queued)
+
+    def full(self) -> bool:
+        return len(self._queued) >= self.queue_limit
+
+    def room(self) -> int:
+        """How many more orders the queue takes."""
+        return max(self.queue_limit - len(self._queued), 0)
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        if self._workers and self._workers[0].get_loop() is not loop:
+            # Loop novo (ex.: entre testes): a fila do loop anterior não vale mais
+            self._workers = []
+            self._queued.clear()
+            self._queue = None
+        if self._queue is None:
+            self._queue = asyncio.PriorityQueue()
+        self._workers = [task for task in self._workers if not task.done()]
+        while len(self._workers) < self.workers:
+            self._workers.append(asyncio.create_task(self._work()))
+
+    async def stop(self):
+        """Stops the workers; queued orders stay SEARCHING for a recovery pass."""
+        workers, self._workers = self._workers, []
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        self._queued.clear()
+        self._queue = None
+
+    def submit(self, order_id: int, created_at: Optional[datetime.datetime] = None,
+               sla_seconds: Optional[float] = None, **kwargs) -> bool:
+        """
+        Queues an order for dispatch; ``kwargs`` go to the engine's ``submit``.
+        Returns False if the order is already queued and raises
+        ``DispatchQueueFull`` when the queue is at capacity.
+        """
+        self.start()
+        if order_id in self._queued:
+            return False
+        if self.full():
+            self.rejected += 1
+            raise DispatchQueueFull(order_id)
+        created = (created_at or datetime.datetime.utcnow()).replace(tzinfo=datetime.timezone.utc).timestamp()
+        due = created + (self.sla_seconds if sla_seconds is None else sla_seconds)
+        self._queued[order_id] = time.monotonic()
+        self._queue.put_nowait((due, next(self._seq), order_id, kwargs))
+        self.submitted += 1
+        return True
+
+    async def _work(self):
+        while True:
+            _, _, order_id, kwargs = await self._queue.get()
+            enqueued = self._queued.pop(order_id, None)
+            if enqueued is None:
+                continue
+            wait = time.monotonic() - enqueued
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            QUEUE_WAIT.observe(wait)
+            self.in_flight += 1
+            try:
+                done = self.engine.submit(order_id, **kwargs)
+                self.dispatching += 1
+                done.add_done_callback(lambda done, order_id=order_id: self._finished(order_id, done))
+                first_offer = self.engine.first_offer(order_id)
+                if first_offer is not None:
+                    # Não propaga o cancelamento do dispatch (drain) para o worker
+                    await asyncio.wait({first_offer})
+            except Exception:
+                self.failed += 1
+                self.completed += 1
+                logger.exception("Erro no dispatch", extra={"order_id": order_id})
+            finally:
+                self.in_flight -= 1
+
+    def _finished(self, order_id: int, done: asyncio.Future):
+        self.dispatching -= 1
+        self.completed += 1
+        if not done.cancelled() and done.exception() is not None:
+            self.failed += 1
+            logger.error("Erro no dispatch", exc_info=done.exception(), extra={"order_id": order_id})
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        started = self.completed + self.in_flight + self.dispatching
+        return {
+            "workers": self.workers,
+            "queued": len(self._queued),
+            "queue_limit": self.queue_limit,
+            "in_flight": self.in_flight,
+            "dispatching": self.dispatching,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "avg_wait_ms": round(self.total_wait / started * 1000, 2) if started else 0.0,
+            "max_wait_ms": round(self.max_wait * 1000, 2),
+            "oldest_wait_ms": round((now - min(self._queued.values())) * 1000, 2) if self._queued else 0.0,
+        }
+
+
+dispatch_scheduler = DispatchScheduler()
+
+metrics.gauge("telego_dispatch_queued", "Orders waiting in the dispatch queue.", callback=lambda: len(dispatch_scheduler))
+metrics.gauge(
+    "telego_dispatch_in_flight", "Orders the workers are starting (until the first offer).",
+    callback=lambda: dispatch_scheduler.in_flight,
+)
+metrics.gauge(
+    "telego_dispatch_open", "Orders queued by the scheduler whose dispatch is still open.",
+    callback=lambda: dispatch_scheduler.dispatching,
+)
@@ -61,6 +61,16 @@ class OrderBase(BaseModel):
 class OrderCreate(OrderBase):
     pass
 
+class OrderBulkItem(BaseModel):
+    index: int
+    id: Optional[int] = None
+    error: Optional[str] = None
+
+class OrderBulkResult(BaseModel):
+    created: int
+    failed: int
+    results: List[OrderBulkItem]
+
 class Order(OrderBase):
     id: int
     courier_id: Optional[int] = None
@@ -69,6 +79,7 @@ class Order(OrderBase):
     offer_sent_at: Optional[datetime.datetime] = None
     attempt_count: int
     created_at: Optional[datetime.datetime] = None
+    restaurantName: Optional[str] = None
 
     class Config:
         from_attributes = True
@@ -1,3 +1,4 @@
+import logging
 import os
 from datetime import datetime, timedelta, timezone
 from jose import JWTError, jwt
@@ -8,6 +9,8 @@ SECRET_KEY = os.getenv("SECRET_KEY", "a_secure_default_secret_key_for_dev")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
+logger = logging.getLogger("telego.auth")
+
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 def verify_password(plain_password, hashed_password):
@@ -28,5 +31,6 @@ def decode_access_token(token: str):
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         return payload
     except JWTError as e:
-        print(f"JWT Decode Error: {e}")
+        # Tokens inválidos podem vir em rajadas: amostrado
+        logger.warning("Token JWT inválido: %s", type(e).__name__, extra={"sample": 100})
         return None
@@ -0,0 +1,203 @@
+"""
+Índice espacial em memória para a busca de motoboys próximos.
+
+The index buckets courier positions into a uniform lat/lng grid so radius and
+k-nearest queries only look at the cells that can intersect the search circle,
+instead of computing a distance against every courier in the fleet. Positions
+live in contiguous NumPy arrays and distances are computed by the vectorized
+kernel in ``backend.geo``.
+"""
+import math
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+
+from backend import geo
+
+KM_PER_DEGREE = math.pi * geo.EARTH_RADIUS_KM / 180.0
+
+Cell = Tuple[int, int]
+
+
+class CourierIndex:
+    """
+    Uniform grid bucket index of courier positions.
+
+    Couriers are inserted, moved and removed incrementally, so the index can
+    follow location updates and availability changes without a rebuild.
+    Queries do not wrap around the antimeridian.
+    """
+
+    def __init__(self, cell_size_deg: float = 0.01, ellipsoidal: bool = False, capacity: int = 1024):
+        self.cell_size = cell_size_deg
+        self.ellipsoidal = ellipsoidal
+        self._cells: Dict[Cell, Set[int]] = {}
+        self._slots: Dict[int, int] = {}
+        self._cell_of: Dict[int, Cell] = {}
+        self._free: List[int] = []
+        self._ids = np.full(capacity, -1, dtype=np.int64)
+        self._lat = np.zeros(capacity, dtype=np.float64)
+        self._lng = np.zeros(capacity, dtype=np.float64)
+        self._size = 0
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def __contains__(self, courier_id: int) -> bool:
+        return courier_id in self._slots
+
+    def _cell(self, lat: float, lng: float) -> Cell:
+        return (math.floor(lat / self.cell_size), math.floor(lng / self.cell_size))
+
+    def _allocate(self, courier_id: int) -> int:
+        if self._free:
+            slot = self._free.pop()
+        else:
+            if self._size == len(self._ids):
+                grow = len(self._ids)
+                self._ids = np.concatenate([self._ids, np.full(grow, -1, dtype=np.int64)])
+                self._lat = np.concatenate([self._lat, np.zeros(grow)])
+                self._lng = np.concatenate([self._lng, np.zeros(grow)])
+            slot = self._size
+            self._size += 1
+        self._ids[slot] = courier_id
+        return slot
+
+    def position(self, courier_id: int) -> Optional[Tuple[float, float]]:
+        slot = self._slots.get(courier_id)
+        if slot is None:
+            return None
+        return (float(self._lat[slot]), float(self._lng[slot]))
+
+    def insert(self, courier_id: int, lat: float, lng: float):
+        """Adds a courier to the index, moving it if it is already there."""
+        if courier_id in self._slots:
+            self.move(courier_id, lat, lng)
+            return
+        slot = self._allocate(courier_id)
+        self._lat[slot] = lat
+        self._lng[slot] = lng
+        cell = self._cell(lat, lng)
+        self._cells.setdefault(cell, set()).add(slot)
+        self._slots[courier_id] = slot
+        self._cell_of[slot] = cell
+
+    def move(self, courier_id: int, lat: float, lng: float):
+        """Updates the position of an indexed courier."""
+        slot = self._slots.get(courier_id)
+        if slot is None:
+            self.insert(courier_id, lat, lng)
+            return
+        cell = self._cell(lat, lng)
+        old_cell = self._cell_of[slot]
+        if cell != old_cell:
+            self._discard_from_cell(slot, old_cell)
+            self._cells.setdefault(cell, set()).add(slot)
+            self._cell_of[slot] = cell
+        self._lat[slot] = lat
+        self._lng[slot] = lng
+
+    def remove(self, courier_id: int):
+        """Removes a courier from the index; unknown ids are ignored."""
+        slot = self._slots.pop(courier_id, None)
+        if slot is None:
+            return
+        self._discard_from_cell(slot, self._cell_of.pop(slot))
+        self._ids[slot] = -1
+        self._free.append(slot)
+
+    def _discard_from_cell(self, slot: int, cell: Cell):
+        bucket = self._cells.get(cell)
+        if bucket is not None:
+            bucket.discard(slot)
+            if not bucket:
+                del self._cells[cell]
+
+    def sync(self, entries: Iterable[Tuple[int, float, float]]):
+        """
+        Brings the index in line with a full list of (id, lat, lng) entries,
+        touching only the couriers that appeared, moved or disappeared.
+        """
+        seen = set()
+        for courier_id, lat, lng in entries:
+            seen.add(courier_id)
+            slot = self._slots.get(courier_id)
+            if slot is None or self._lat[slot] != lat or self._lng[slot] != lng:
+                self.move(courier_id, lat, lng)
+        for courier_id in [cid for cid in self._slots if cid not in seen]:
+            self.remove(courier_id)
+
+    def snapshot(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Returns copies of (ids, lats, lngs) for every indexed courier."""
+        live = self._ids[:self._size] >= 0
+        return (
+            self._ids[:self._size][live].copy(),
+            self._lat[:self._size][live].copy(),
+            self._lng[:self._size][live].copy(),
+        )
+
+    def _cell_range(self, lat: float, lng: float, radius_km: float):
+        dlat = radius_km / KM_PER_DEGREE
+        # Usa o cosseno da latitude mais próxima do polo dentro da faixa buscada
+        edge_lat = min(89.9, abs(lat) + dlat)
+        dlng = min(180.0, radius_km / (KM_PER_DEGREE * math.cos(math.radians(edge_lat))))
+        lo = self._cell(lat - dlat, lng - dlng)
+        hi = self._cell(lat + dlat, lng + dlng)
+        return lo, hi
+
+    def _candidate_slots(self, lat: float, lng: float, radius_km: float) -> np.ndarray:
+        (lat_lo, lng_lo), (lat_hi, lng_hi) = self._cell_range(lat, lng, radius_km)
+        span = (lat_hi - lat_lo + 1) * (lng_hi - lng_lo + 1)
+
+        slots: List[int] = []
+        if span > len(self._cells):
+            for (clat, clng), bucket in self._cells.items():
+                if lat_lo <= clat <= lat_hi and lng_lo <= clng <= lng_hi:
+                    slots.extend(bucket)
+        else:
+            for clat in range(lat_lo, lat_hi + 1):
+                for clng in range(lng_lo, lng_hi + 1):
+                    bucket = self._cells.get((clat, clng))
+                    if bucket:
+                        slots.extend(bucket)
+        return np.fromiter(slots, dtype=np.int64, count=len(slots))
+
+    def _distances(self, lat: float, lng: float, slots: np.ndarray) -> np.ndarray:
+        return geo.distances_km(lat, lng, self._lat[slots], self._lng[slots], ellipsoidal=self.ellipsoidal)
+
+    def within(self, lat: float, lng: float, radius_km: float) -> List[Tuple[int, float]]:
+        """Returns (courier_id, distance_km) pairs within the radius, nearest first."""
+        slots = self._candidate_slots(lat, lng, radius_km)
+        if not len(slots):
+            return []
+        distances = self._distances(lat, lng, slots)
+        (order,) = geo.radius_tiers(distances, [radius_km])
+        return list(zip(self._ids[slots[order]].tolist(), distances[order].tolist()))
+
+    def tiers(self, lat: float, lng: float, radii: Sequence[float]) -> List[List[int]]:
+        """
+        Courier ids per radius tier in one pass: tier i holds the couriers with
+        radii[i-1] < distance <= radii[i], nearest first.
+        """
+        slots = self._candidate_slots(lat, lng, radii[-1])
+        if not len(slots):
+            return [[] for _ in radii]
+        distances = self._distances(lat, lng, slots)
+        return [self._ids[slots[tier]].tolist() for tier in geo.radius_tiers(distances, radii)]
+
+    def nearest(self, lat: float, lng: float, k: int, max_radius_km: Optional[float] = None) -> List[Tuple[int, float]]:
+        """Returns up to k (courier_id, distance_km) pairs, nearest first."""
+        if k <= 0 or not self._slots:
+            return []
+        radius = self.cell_size * KM_PER_DEGREE
+        limit = max_radius_km if max_radius_km is not None else math.pi * geo.EARTH_RADIUS_KM
+        while True:
+            radius = min(radius, limit)
+            found = self.within(lat, lng, radius)
+            if len(found) >= k or len(found) == len(self._slots) or radius >= limit:
+                return found[:k]
+            radius *= 2
+
+
+# Índice global usado pelo dispatch
+courier_index = CourierIndex()
@@ -0,0 +1,97 @@
+"""
+Timing wheel hierárquico para os prazos das ofertas de dispatch.
+
+Timers are kept in ``levels`` wheels of ``slots`` buckets each. Level 0 has a
+resolution of one tick; every level above covers ``slots`` times the span of
+the one below and its buckets are cascaded down as time reaches them. Schedule
+and cancel are O(1) and advancing the wheel only touches the buckets whose
+time has come, so hundreds of thousands of pending deadlines cost one small
+object each instead of one event-loop timer handle each.
+"""
+import math
+from typing import Any, List, Optional, Set
+
+
+class Timer:
+    __slots__ = ("expires", "payload", "_bucket")
+
+    def __init__(self, expires: int, payload: Any):
+        self.expires = expires
+        self.payload = payload
+        self._bucket: Optional[Set["Timer"]] = None
+
+
+class TimingWheel:
+    def __init__(self, tick: float = 0.05, slots: int = 256, levels: int = 4, start: float = 0.0):
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self._wheels = [[set() for _ in range(slots)] for _ in range(levels)]
+        self._widths = [slots ** level for level in range(levels)]
+        # Último tick já processado
+        self._current = int(start // tick)
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def schedule(self, deadline: float, payload: Any) -> Timer:
+        """Schedules ``payload`` to expire at ``deadline`` (same clock as advance)."""
+        expires = max(self._current + 1, math.ceil(deadline / self.tick))
+        timer = Timer(expires, payload)
+        self._place(timer)
+        self._count += 1
+        return timer
+
+    def cancel(self, timer: Timer) -> bool:
+        """Cancels a pending timer; returns False if it already fired or was cancelled."""
+        bucket = timer._bucket
+        if bucket is None or timer not in bucket:
+            return False
+        bucket.discard(timer)
+        timer._bucket = None
+        self._count -= 1
+        return True
+
+    def _place(self, timer: Timer):
+        delta = timer.expires - self._current
+        level = 0
+        while level < self.levels - 1 and delta >= self._widths[level] * self.slots:
+            level += 1
+        # Prazos além do alcance ficam no nível mais alto e são recolocados a cada volta
+        index = (timer.expires // self._widths[level]) % self.slots
+        bucket = self._wheels[level][index]
+        bucket.add(timer)
+        timer._bucket = bucket
+
+    def advance(self, now: float) -> List[Any]:
+        """Moves the wheel up to ``now`` and returns the payloads that expired."""
+        target = int(now // self.tick)
+        expired: List[Any] = []
+        if not self._count:
+            self._current = max(self._current, target)
+            return expired
+
+        while self._current < target and self._count:
+            self._current += 1
+            tick = self._current
+            for level in range(self.levels - 1, 0, -1):
+                width = self._widths[level]
+                if tick % width == 0:
+                    bucket = self._wheels[level][(tick // width) % self.slots]
+                    if bucket:
+                        timers = list(bucket)
+                        bucket.clear()
+                        for timer in timers:
+                            self._place(timer)
+
+            bucket = self._wheels[0][tick % self.slots]
+            if bucket:
+                for timer in bucket:
+                    timer._bucket = None
+                    expired.append(timer.payload)
+                self._count -= len(bucket)
+                bucket.clear()
+
+        self._current = max(self._current, target)
+        return expired
@@ -2,48 +2,462 @@
 WebSocket Manager para notificações em tempo real
 """
 from fastapi import WebSocket
-from typing import Dict, List
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+import asyncio
 import json
+import logging
+import os
+import time
+
+from backend.bus import MessageBus, bus
+from backend.encoding import Envelope
+from backend.mailbox import MailboxStore
+from backend.metrics import metrics
+from backend.presence import PresenceRegistry, Session
+
+logger = logging.getLogger("telego.ws")
+
+# Canal das mensagens para conexões que estão em outro worker
+WEBSOCKET_CHANNEL = "telego_websocket"
+
+# Fila de saída de cada conexão
+QUEUE_SIZE = int(os.getenv("WS_QUEUE_SIZE", "100"))
+QUEUE_POLICY = os.getenv("WS_QUEUE_POLICY", "drop_oldest")  # drop_oldest | coalesce | disconnect
+QUEUE_POLICIES = ("drop_oldest", "coalesce", "disconnect")
+
+# Métricas das conexões (/metrics)
+SEND_LATENCY = metrics.histogram(
+    "telego_ws_send_latency_seconds", "Time from queueing a message to handing it to the socket."
+)
+FAILED_SENDS = metrics.counter("telego_ws_failed_sends_total", "Sends that failed and evicted the session.")
+DROPPED_MESSAGES = metrics.counter(
+    "telego_ws_dropped_messages_total", "Messages dropped or coalesced by a full send queue.", ("reason",)
+)
+
+
+def _coalesce_key(message: dict) -> Optional[Tuple[str, object]]:
+    # Só a última atualização de status de um pedido interessa
+    if message.get("type") == "ORDER_UPDATE":
+        return ("ORDER_UPDATE", message.get("order_id"))
+    return None
+
+
+class QueueConnection:
+    """
+    Conexão que não é WebSocket (SSE, long-poll): as mensagens vão para uma fila
+
+    Lets HTTP streaming and long-poll clients open a regular session, so they
+    count as online and are fed by the same writer, mailbox and bus path as
+    WebSocket clients.
+    """
+    def __init__(self, max_size: int = QUEUE_SIZE):
+        self.queue: "asyncio.Queue[Optional[str]]" = asyncio.Queue(max_size)
+        self.closed_with: Optional[int] = None
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, text: str):
+        await self.queue.put(text)
+
+    async def close(self, code: int = 1000):
+        self.closed_with = code
+        # Acorda quem está lendo
+        try:
+            self.queue.put_nowait(None)
+        except asyncio.QueueFull:
+            pass
+
+    async def receive(self, timeout: Optional[float] = None) -> Optional[dict]:
+        """Próxima mensagem, ou None se a conexão foi fechada ou o tempo acabou"""
+        try:
+            text = await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        return json.loads(text) if text is not None else None
+
+
+class ConnectionWriter:
+    """
+    Fila de saída de uma conexão, esvaziada por uma task própria
+
+    Enqueueing never waits on the socket, so a slow client only delays its own
+    messages. When the queue is full the policy decides: drop the oldest
+    message, replace a queued message with the same coalescing key (falling
+    back to dropping the oldest), or disconnect the client.
+    """
+    def __init__(self, manager: "ConnectionManager", session: Session,
+                 max_size: int = QUEUE_SIZE, policy: str = QUEUE_POLICY):
+        if policy not in QUEUE_POLICIES:
+            raise ValueError(f"Política de fila inválida: {policy}")
+        self.manager = manager
+        self.session = session
+        self.websocket = session.websocket
+        self.max_size = max_size
+        self.policy = policy
+        # (chave de coalescência, mensagem, enfileirada_em)
+        self.queue: Deque[Tuple[Optional[Tuple[str, object]], Envelope, float]] = deque()
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.closed = False
+        self._wake = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def put(self, envelope: Envelope) -> bool:
+        """Enfileira sem esperar; retorna False se a conexão foi encerrada"""
+        if self.closed:
+            return False
+        key = _coalesce_key(envelope.message)
+        now = time.perf_counter()
+        if self.policy == "coalesce" and key is not None:
+            for i, (queued_key, _, queued_at) in enumerate(self.queue):
+                if queued_key == key:
+                    # Mantém a posição e a idade da mensagem substituída
+                    self.queue[i] = (key, envelope, queued_at)
+                    self.coalesced += 1
+                    DROPPED_MESSAGES.inc(reason="coalesced")
+                    return True
+        if len(self.queue) >= self.max_size:
+            if self.policy == "disconnect":
+                logger.warning(
+                    "Conexão lenta demais; desconectando",
+                    extra={"user_id": self.session.user_id, "queued": len(self.queue), "sample": 10},
+                )
+                self.manager._evict(self.session, code=1013)
+                return False
+            self.queue.popleft()
+            self.dropped += 1
+            DROPPED_MESSAGES.inc(reason="queue_full")
+        self.queue.append((key, envelope, now))
+        self._idle.clear()
+        self._wake.set()
+        return True
+
+    async def _run(self):
+        while True:
+            if not self.queue:
+                self._idle.set()
+                self._wake.clear()
+                await self._wake.wait()
+                continue
+            _, envelope, queued_at = self.queue.popleft()
+            try:
+                # O JSON é gerado uma vez por mensagem, não por conexão
+                await self.websocket.send_text(envelope.text)
+            except Exception:
+                # Se der erro ao enviar, remove a conexão
+                FAILED_SENDS.inc()
+                self.manager._evict(self.session)
+                return
+            latency = time.perf_counter() - queued_at
+            SEND_LATENCY.observe(latency)
+            self.sent += 1
+            self.latency_total += latency
+            self.latency_max = max(self.latency_max, latency)
+
+    async def flush(self):
+        """Espera a fila esvaziar"""
+        if not self.closed:
+            await self._idle.wait()
+
+    def close(self):
+        self.closed = True
+        self.queue.clear()
+        self._idle.set()
+        self._task.cancel()
+
+    def stats(self) -> dict:
+        return {
+            "depth": len(self.queue),
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+            "avg_latency_ms": round(self.latency_total / self.sent * 1000, 2) if self.sent else 0.0,
+            "max_latency_ms": round(self.latency_max * 1000, 2),
+        }
+
+
+# Canal dos avisos de presença entre workers
+PRESENCE_CHANNEL = "telego_presence"
+# Usuários por mensagem na resposta a um pedido de ressincronização
+PRESENCE_SNAPSHOT_BATCH = 200
+
+REAP_INTERVAL_SECONDS = float(os.getenv("WS_REAP_INTERVAL", "15"))
 
 class ConnectionManager:
     """
     Gerencia conexões WebSocket e envia notificações
+
+    Connections are local to the worker that accepted them; messages for a
+    user connected elsewhere are forwarded over the message bus. A user may
+    have several sessions (see PresenceRegistry), each with its own bounded
+    send queue (see ConnectionWriter).
     """
-    def __init__(self):
-        # Armazena as conexões ativas: {user_id: WebSocket}
-        self.active_connections: Dict[str, WebSocket] = {}
+    def __init__(self, message_bus: Optional[MessageBus] = None,
+                 queue_size: int = QUEUE_SIZE, queue_policy: str = QUEUE_POLICY,
+                 presence: Optional[PresenceRegistry] = None,
+                 mailboxes: Optional[MailboxStore] = None):
+        self.presence = presence if presence is not None else PresenceRegistry()
+        self.mailboxes = mailboxes if mailboxes is not None else MailboxStore()
+        self.queue_size = queue_size
+        self.queue_policy = queue_policy
+        self.evicted = 0
+        self.reaped = 0
+        self._reaper: Optional[asyncio.Task] = None
+        self.bus = message_bus if message_bus is not None else bus
+        self.bus.subscribe(WEBSOCKET_CHANNEL, self._on_bus_message)
+        self.bus.subscribe(PRESENCE_CHANNEL, self._on_presence_message)
+        self.bus.on_start(self.request_presence)
+        self.presence.on_change(self._announce)
+
+    @property
+    def active_connections(self) -> Dict[str, WebSocket]:
+        """
+        Conexão mais recente de cada usuário conectado neste worker
+        """
+        return {session.user_id: session.websocket for session in self.presence.all_sessions()}
     
-    async def connect(self, websocket: WebSocket, user_id: str, user_type: str):
+    async def connect(self, websocket: WebSocket, user_id: str, user_type: str) -> Session:
         """
         Aceita uma nova conexão WebSocket
+        Outras sessões do mesmo usuário (outra aba, reconexão) continuam ativas
         """
         await websocket.accept()
-        self.active_connections[user_id] = websocket
-        print(f"✅ {user_type} {user_id} conectado via WebSocket")
+        session = self.presence.add(user_id, websocket)
+        session.writer = ConnectionWriter(self, session, self.queue_size, self.queue_policy)
+        logger.debug("Sessão conectada", extra={"user_id": user_id, "user_type": user_type, "session": session.id})
+        return session
+
+    def touch(self, session: Session):
+        """
+        Registra sinal de vida da sessão (heartbeat, ping ou qualquer mensagem)
+        """
+        self.presence.touch(session)
+
+    def _announce(self, user_id: str, online: bool):
+        # Avisa os outros workers quando o usuário entra ou sai deste
+        self.bus.publish_nowait(PRESENCE_CHANNEL, {"user_id": user_id, "online": online, "node": self.bus.node_id})
+
+    def request_presence(self):
+        """
+        Pede aos outros workers a lista de quem está conectado neles; sem isso
+        um worker recém-iniciado só conhece quem entrar ou sair depois dele
+        """
+        self.bus.publish_nowait(PRESENCE_CHANNEL, {"sync": True, "node": self.bus.node_id})
+
+    def _publish_snapshot(self):
+        users = self.presence.local_users()
+        # Em lotes, para caber no limite de payload do NOTIFY
+        for start in range(0, len(users), PRESENCE_SNAPSHOT_BATCH):
+            self.bus.publish_nowait(PRESENCE_CHANNEL, {
+                "users": users[start:start + PRESENCE_SNAPSHOT_BATCH], "node": self.bus.node_id,
+            })
+
+    def _on_presence_message(self, payload: dict):
+        if payload.get("sync"):
+            self._publish_snapshot()
+        elif "users" in payload:
+            for user_id in payload["users"]:
+                self.presence.set_remote(user_id, payload["node"], True)
+        else:
+            self.presence.set_remote(payload["user_id"], payload["node"], payload["online"])
+
+    def poll(self, user_id: str):
+        """
+        Registra um poll HTTP (/orders/available) como sinal de vida do usuário
+        """
+        self.presence.poll(user_id)
+
+    def _drop(self, session: Session) -> bool:
+        if session.writer is not None:
+            session.writer.close()
+        return self.presence.remove(session)
+
+    def _evict(self, session: Session, code: int = 1011):
+        if self._drop(session):
+            self.evicted += 1
+        asyncio.get_running_loop().create_task(self._close_socket(session.websocket, code))
+
+    @staticmethod
+    async def _close_socket(websocket: WebSocket, code: int):
+        try:
+            await websocket.close(code=code)
+        except Exception:
+            pass
+
+    def start_reaper(self, interval: float = REAP_INTERVAL_SECONDS):
+        """
+        Inicia a varredura periódica de sessões sem sinal de vida
+        """
+        if self._reaper is None or self._reaper.done():
+            self._reaper = asyncio.create_task(self._reap_loop(interval))
+
+    async def stop_reaper(self):
+        if self._reaper is not None:
+            self._reaper.cancel()
+            await asyncio.gather(self._reaper, return_exceptions=True)
+            self._reaper = None
+
+    async def _reap_loop(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            self.reap()
+            self.ping_quiet()
+
+    def ping_quiet(self) -> int:
+        """
+        Manda PING para as sessões caladas há mais de metade do timeout, para
+        o cliente responder antes de ser derrubado; retorna quantas
+        """
+        quiet = [
+            session for session in self.presence.quiet_sessions(self.presence.idle_timeout / 2)
+            if not session.writer.closed
+        ]
+        if quiet:
+            # Fora da caixa postal: não tem sequência nem é reenviado
+            envelope = Envelope({"type": "PING"})
+            for session in quiet:
+                session.writer.put(envelope)
+        return len(quiet)
+
+    def reap(self) -> int:
+        """
+        Encerra as sessões ociosas; retorna quantas foram removidas
+        """
+        # Quem só fazia polling e parou fica offline
+        self.presence.expire_polls()
+        idle = self.presence.idle_sessions()
+        for session in idle:
+            logger.info("Sessão sem heartbeat; desconectando", extra={"user_id": session.user_id, "session": session.id})
+            if self._drop(session):
+                self.reaped += 1
+            # 1001: o servidor está encerrando a conexão
+            asyncio.get_running_loop().create_task(self._close_socket(session.websocket, 1001))
+        return len(idle)
     
+    async def _send_local(self, user_id: str, message: dict) -> bool:
+        """
+        Enfileira para todas as sessões do usuário neste worker
+        Retorna False se o usuário não está conectado aqui
+        """
+        sessions = self.presence.sessions(user_id)
+        if not sessions:
+            return False
+        # Numerada e guardada na caixa postal para reenvio após reconexão
+        envelope = self.mailboxes.append(user_id, message)
+        delivered = False
+        for session in sessions:
+            delivered = session.writer.put(envelope) or delivered
+        return delivered
+
+    async def _broadcast_local(self, message: dict):
+        # Só enfileira: o tempo do broadcast não depende do cliente mais lento
+        envelope = Envelope(message)
+        for session in self.presence.all_sessions():
+            session.writer.put(envelope)
+
+    async def flush(self):
+        """
+        Espera todas as filas de saída deste worker esvaziarem
+        """
+        await asyncio.gather(*(session.writer.flush() for session in self.presence.all_sessions()))
+
+    def stats(self) -> dict:
+        """
+        Profundidade das filas e latência de envio por sessão
+        """
+        connections = {
+            f"{session.user_id}#{session.id}": session.writer.stats()
+            for session in self.presence.all_sessions()
+        }
+        return {
+            "connections": len(connections),
+            "policy": self.queue_policy,
+            "queue_size": self.queue_size,
+            "queued": sum(c["depth"] for c in connections.values()),
+            "dropped": sum(c["dropped"] for c in connections.values()),
+            "evicted": self.evicted,
+            "reaped": self.reaped,
+            "max_latency_ms": max((c["max_latency_ms"] for c in connections.values()), default=0.0),
+            "per_connection": connections,
+        }
+
+    async def send(self, user_id: str, message: dict) -> bool:
+        """
+        Sends to a user wherever they are connected. Returns True if queued by
+        this worker; otherwise the message is forwarded to the other workers.
+        """
+        if await self._send_local(user_id, message):
+            return True
+        if not self.presence.is_online(user_id):
+            # Offline em todos os workers: fica guardada até a reconexão
+            self.mailboxes.append(user_id, message)
+        await self.bus.publish(WEBSOCKET_CHANNEL, {"user_id": user_id, "message": message})
+        return False
+
+    def resume(self, session: Session, last_seq: Optional[int] = None, epoch: Optional[str] = None) -> Optional[int]:
+        """
+        Abre a sessão informando a época e a última sequência da caixa postal.
+        Com ``last_seq``, reenvia só o que o cliente perdeu, ou pede resync se
+        a lacuna não está mais guardada. Retorna quantas mensagens foram
+        reenviadas (None quando foi pedido resync).
+        """
+        user_id = session.user_id
+        state = {"epoch": self.mailboxes.epoch, "last_seq": self.mailboxes.last_seq(user_id)}
+        if last_seq is None:
+            session.writer.put(Envelope({"type": "SESSION", **state}))
+            return 0
+        missed = self.mailboxes.since(user_id, last_seq, epoch)
+        if missed is None:
+            session.writer.put(Envelope({"type": "RESYNC_REQUIRED", **state}))
+            return None
+        session.writer.put(Envelope({"type": "SESSION", **state}))
+        for envelope in missed:
+            session.writer.put(envelope)
+        return len(missed)
+
+    async def broadcast(self, message: dict):
+        await self._broadcast_local(message)
+        await self.bus.publish(WEBSOCKET_CHANNEL, {"user_id": None, "message": message})
+
+    async def _on_bus_message(self, payload: dict):
+        # Mensagem de outro worker: só entrega localmente, nunca republica
+        if payload["user_id"] is None:
+            await self._broadcast_local(payload["message"])
+        else:
+            await self._send_local(payload["user_id"], payload["message"])
+
     async def send_to_courier(self, courier_id: int, order_data: dict) -> bool:
         """
         Envia um pedido para um motoboy específico
-        Retorna True se enviado, False se motoboy offline
+        Retorna True se enfileirado neste worker, False se o motoboy não está
+        conectado aqui (a mensagem segue pelo barramento para os outros workers)
         """
-        user_id = f"courier_{courier_id}"
-        
-        if user_id in self.active_connections:
-            try:
-                await self.active_connections[user_id].send_json({
-                    "type": "NEW_ORDER",
-                    "order": order_data,
-                    "action_required": True,
-                    "timeout_seconds": 20
-                })
-                return True
-            except:
-                # Se der erro ao enviar, remove a conexão
-                del self.active_connections[user_id]
-                return False
-        
-        return False
+        return await self.send(f"courier_{courier_id}", {
+            "type": "NEW_ORDER",
+            "order": order_data,
+            "action_required": True,
+            "timeout_seconds": order_data.get("timeout_seconds", 20)
+        })
     
+    async def withdraw_offer(self, courier_id: int, order_id: int, reason: str = "TAKEN") -> bool:
+        """
+        Avisa o motoboy que uma oferta não está mais disponível
+        (aceita por outro motoboy, expirada ou cancelada)
+        """
+        return await self.send(f"courier_{courier_id}", {
+            "type": "ORDER_WITHDRAWN",
+            "order_id": order_id,
+            "reason": reason,
+            "message": f"Pedido {order_id} não está mais disponível"
+        })
+
     async def notify_order_update(self, order_id: int, status: str, to_user_id: str = None, text: str = None):
         """
         Notifica atualização de status de um pedido
@@ -58,31 +472,23 @@ class ConnectionManager:
         
         if to_user_id:
             # Envia para um usuário específico
-            if to_user_id in self.active_connections:
-                try:
-                    await self.active_connections[to_user_id].send_json(message)
-                except:
-                    del self.active_connections[to_user_id]
+            await self.send(to_user_id, message)
         else:
             # Envia para todos conectados (broadcast)
-            disconnected = []
-            for user_id, ws in self.active_connections.items():
-                try:
-                    await ws.send_json(message)
-                except:
-                    disconnected.append(user_id)
-            
-            # Remove conexões que falharam
-            for user_id in disconnected:
-                del self.active_connections[user_id]
+            await self.broadcast(message)
     
-    async def disconnect(self, user_id: str):
+    async def disconnect(self, user_id: str, session: Optional[Session] = None):
         """
-        Remove uma conexão
+        Remove uma sessão (ou todas as do usuário, se nenhuma for informada)
         """
-        if user_id in self.active_connections:
-            del self.active_connections[user_id]
-            print(f"❌ {user_id} desconectado")
+        sessions = [session] if session is not None else self.presence.sessions(user_id)
+        for current in sessions:
+            if self._drop(current):
+                logger.debug("Sessão desconectada", extra={"user_id": user_id, "session": current.id})
 
 # Cria uma instância global para ser usada em todo o app
-manager = ConnectionManager()
\ No newline at end of file
+manager = ConnectionManager()
+metrics.gauge(
+    "telego_ws_active_connections", "Open sessions (WebSocket, SSE and long-poll) on this worker.",
+    callback=lambda: len(manager.presence),
+)
@@ -0,0 +1,86 @@
+import asyncio
+import json
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from backend import models, dispatch
+from backend.db import Base
+from backend.registry import courier_registry
+from backend.websocket_manager import manager
+
+# Use an in-memory async SQLite database for testing
+SQLALCHEMY_DATABASE_URL = "sqlite+aiosqlite:///:memory:"
+engine = create_async_engine(
+    SQLALCHEMY_DATABASE_URL,
+    connect_args={"check_same_thread": False},
+    poolclass=StaticPool,
+)
+TestingSessionLocal = async_sessionmaker(
+    autocommit=False, autoflush=False, bind=engine, expire_on_commit=False
+)
+
+@pytest.fixture(scope="function")
+async def db_session():
+    """Fixture to create a new database session for each test."""
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+    async with TestingSessionLocal() as session:
+        yield session
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+    # A conexão única do StaticPool fica presa ao loop deste teste
+    await engine.dispose()
+
+async def sync_registry(session_factory=TestingSessionLocal):
+    # Dispatch lê os motoboys do registro em memória, não do banco
+    await courier_registry.reconcile(session_factory)
+    # e só oferta para quem está conectado (aqui, "em outro worker")
+    for courier_id in courier_registry.snapshot()[0].tolist():
+        manager.presence.set_remote(f"courier_{courier_id}", "tests", True)
+
+async def wait_for_offer(order_id: int, courier_ids: set):
+    while dispatch.open_offers.get(order_id) != courier_ids:
+        await asyncio.sleep(0.01)
+
+async def accept(order_id: int, courier_id: int):
+    async with TestingSessionLocal() as db:
+        order_to_update = await db.get(models.Order, order_id)
+        order_to_update.status = "ASSIGNED"
+        order_to_update.courier_id = courier_id
+        await db.commit()
+    dispatch.signal_response(order_id, courier_id, True)
+
+@contextmanager
+def count_statements():
+    """Collects the SQL statements run on the test engine inside the block."""
+    statements = []
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+
+class FakeWebSocket:
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.sent = []
+        self.closed_with = None
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, text):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        self.sent.append(json.loads(text))
+
+    async def close(self, code: int = 1000):
+        self.closed_with = code
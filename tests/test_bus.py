@@ -0,0 +1,97 @@
+import asyncio
+import json
+
+import pytest
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from backend import dispatch, models
+from backend.bus import InMemoryBus, MessageBus, bus
+from backend.websocket_manager import ConnectionManager
+from tests.conftest import TestingSessionLocal, sync_registry, wait_for_offer
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.sent = []
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, text):
+        self.sent.append(json.loads(text))
+
+
+def test_a_bus_must_implement_publish():
+    class Silent(MessageBus):
+        pass
+
+    with pytest.raises(TypeError):
+        Silent()
+
+
+@pytest.mark.asyncio
+async def test_messages_reach_connections_on_other_workers():
+    hub = []
+    worker_a = ConnectionManager(InMemoryBus(hub))
+    worker_b = ConnectionManager(InMemoryBus(hub))
+    courier_ws, restaurant_ws = FakeWebSocket(), FakeWebSocket()
+    await worker_b.connect(courier_ws, "courier_7", "COURIER")
+    await worker_a.connect(restaurant_ws, "restaurant_1", "RESTAURANT")
+
+    # Entregue pelo worker B, não pelo A
+    assert not await worker_a.send_to_courier(7, {"id": 1, "timeout_seconds": 15})
+    await worker_b.flush()
+    assert [m["type"] for m in courier_ws.sent] == ["NEW_ORDER"]
+
+    await worker_b.notify_order_update(1, "ASSIGNED")
+    await asyncio.gather(worker_a.flush(), worker_b.flush())
+    assert [m["type"] for m in courier_ws.sent] == ["NEW_ORDER", "ORDER_UPDATE"]
+    assert [m["type"] for m in restaurant_ws.sent] == ["ORDER_UPDATE"]
+
+
+@pytest.mark.asyncio
+async def test_worker_that_starts_late_learns_who_is_online_elsewhere():
+    hub = []
+    worker_a = ConnectionManager(InMemoryBus(hub))
+    await worker_a.connect(FakeWebSocket(), "courier_7", "COURIER")
+    worker_a.poll("courier_8")
+
+    # O worker B não viu os avisos de entrada: pede a lista ao conectar o barramento
+    worker_b = ConnectionManager(InMemoryBus(hub))
+    assert not worker_b.presence.is_courier_online(7)
+    await worker_b.bus.start()
+    await asyncio.sleep(0.01)
+    assert worker_b.presence.is_courier_online(7)
+    assert worker_b.presence.is_courier_online(8)
+    assert not worker_b.presence.is_courier_online(9)
+
+
+@pytest.mark.asyncio
+async def test_response_from_another_worker_wakes_the_dispatch(db_session: AsyncSession):
+    restaurant = models.Restaurant(id=1, name="R", lat=0, lng=0)
+    courier = models.Courier(id=1, name="C1", email="c1@example.com", lat=0.001, lng=0.001, available=True)
+    order = models.Order(id=1, restaurant_id=restaurant.id, status="SEARCHING")
+    db_session.add_all([restaurant, courier, order])
+    await db_session.commit()
+    await sync_registry()
+
+    # Outro worker, onde chegou o aceite do motoboy
+    other_worker = InMemoryBus(bus.hub)
+    try:
+        task = asyncio.create_task(dispatch.dispatch_order(order.id, session_local=TestingSessionLocal))
+        await wait_for_offer(order.id, {courier.id})
+        async with TestingSessionLocal() as db:
+            assert await dispatch.claim_order(db, order.id, courier.id)
+        await other_worker.publish(
+            dispatch.RESPONSES_CHANNEL, {"order_id": order.id, "courier_id": courier.id, "accepted": True}
+        )
+        assert await asyncio.wait_for(task, timeout=2) == "ASSIGNED"
+
+        # Pedido que este worker não conduz: a resposta segue pelo barramento
+        forwarded = []
+        other_worker.subscribe(dispatch.RESPONSES_CHANNEL, forwarded.append)
+        dispatch.signal_response(99, courier.id, False)
+        await asyncio.sleep(0.01)
+        assert forwarded == [{"order_id": 99, "courier_id": courier.id, "accepted": False}]
+    finally:
+        bus.hub.remove(other_worker)
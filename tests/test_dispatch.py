@@ -2,32 +2,21 @@
 import pytest
 import asyncio
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
-from sqlalchemy.pool import StaticPool
+from sqlalchemy.future import select
 from backend import models, dispatch
 from backend.db import Base
+from backend.websocket_manager import manager
+from tests.conftest import TestingSessionLocal, accept, sync_registry, wait_for_offer
 
-# Use an in-memory async SQLite database for testing
-SQLALCHEMY_DATABASE_URL = "sqlite+aiosqlite:///:memory:"
-engine = create_async_engine(
-    SQLALCHEMY_DATABASE_URL,
-    connect_args={"check_same_thread": False},
-    poolclass=StaticPool,
-)
-TestingSessionLocal = async_sessionmaker(
-    autocommit=False, autoflush=False, bind=engine, expire_on_commit=False
-)
-
-@pytest.fixture(scope="function")
-async def db_session():
-    """Fixture to create a new database session for each test."""
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
 
-    async with TestingSessionLocal() as session:
-        yield session
+    def __call__(self):
+        return self.now
 
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.drop_all)
+    def advance(self, seconds: float):
+        self.now += seconds
 
 @pytest.mark.asyncio
 async def test_dispatch_success_on_first_try(db_session: AsyncSession):
@@ -37,29 +26,46 @@ async def test_dispatch_success_on_first_try(db_session: AsyncSession):
     order = models.Order(id=1, restaurant_id=restaurant.id, status="SEARCHING")
     db_session.add_all([restaurant, courier, order])
     await db_session.commit()
+    await sync_registry()
 
     async def simulate_courier_acceptance(order_id: int, courier_id: int):
-        await asyncio.sleep(0.1)
-        if event := dispatch.courier_responses.get(order_id):
-            async with TestingSessionLocal() as db:
-                order_to_update = await db.get(models.Order, order_id)
-                if order_to_update:
-                    order_to_update.status = "ASSIGNED"
-                    order_to_update.courier_id = courier_id
-                    await db.commit()
-                    event.set()
+        await wait_for_offer(order_id, {courier_id})
+        await accept(order_id, courier_id)
 
     dispatch_task = asyncio.create_task(dispatch.dispatch_order(order.id, session_local=TestingSessionLocal))
     acceptance_task = asyncio.create_task(simulate_courier_acceptance(order.id, courier.id))
-    await asyncio.gather(dispatch_task, acceptance_task)
+    status, _ = await asyncio.gather(dispatch_task, acceptance_task)
 
     # Verification
+    assert status == "ASSIGNED"
     final_order = await db_session.get(models.Order, order.id)
     await db_session.refresh(final_order)
     assert final_order.status == "ASSIGNED"
     assert final_order.courier_id == courier.id
     assert final_order.attempt_count == 1
 
+@pytest.mark.asyncio
+async def test_first_offer_resolves_before_the_dispatch(db_session: AsyncSession, monkeypatch):
+    restaurant = models.Restaurant(id=1, name="R", lat=0, lng=0)
+    courier = models.Courier(id=1, name="C1", email="c1@example.com", lat=0.01, lng=0.01, available=True)
+    db_session.add_all([restaurant, courier, models.Order(id=1, restaurant_id=1, status="SEARCHING")])
+    await db_session.commit()
+    await sync_registry()
+
+    engine = dispatch.DispatchEngine()
+    monkeypatch.setattr(dispatch, "dispatcher", engine)
+    try:
+        done = engine.submit(1, session_factory=TestingSessionLocal)
+        await asyncio.wait_for(engine.first_offer(1), timeout=2)
+        # O scheduler libera o worker aqui: a oferta está aberta e o pedido segue no engine
+        assert dispatch.open_offers[1] == {1}
+        assert not done.done()
+        await accept(1, 1)
+        assert await asyncio.wait_for(done, timeout=2) == "ASSIGNED"
+        assert engine.first_offer(1) is None
+    finally:
+        await engine.stop()
+
 @pytest.mark.asyncio
 async def test_dispatch_timeout_and_second_courier_accepts(db_session: AsyncSession, monkeypatch):
     # Setup
@@ -69,22 +75,17 @@ async def test_dispatch_timeout_and_second_courier_accepts(db_session: AsyncSess
     order = models.Order(id=1, restaurant_id=restaurant.id, status="SEARCHING")
     db_session.add_all([restaurant, courier1, courier2, order])
     await db_session.commit()
+    await sync_registry()
+
+    # The injected clock replaces real 20 s offer timeouts
+    clock = FakeClock()
+    monkeypatch.setattr(dispatch, "dispatcher", dispatch.DispatchEngine(clock=clock))
 
     async def simulate_second_courier_acceptance():
-        await asyncio.sleep(0.2)
-        if event := dispatch.courier_responses.get(order.id):
-            async with TestingSessionLocal() as db:
-                order_in_db = await db.get(models.Order, order.id)
-                if order_in_db and order_in_db.current_candidate_courier_id == courier2.id:
-                    order_in_db.status = "ASSIGNED"
-                    order_in_db.courier_id = courier2.id
-                    await db.commit()
-                    event.set()
-
-    original_wait_for = asyncio.wait_for
-    async def mocked_wait_for(fut, timeout):
-        return await original_wait_for(fut, 0.1)
-    monkeypatch.setattr(asyncio, "wait_for", mocked_wait_for)
+        await wait_for_offer(order.id, {courier1.id})
+        clock.advance(dispatch.OFFER_TIMEOUT_SECONDS + 1)
+        await wait_for_offer(order.id, {courier2.id})
+        await accept(order.id, courier2.id)
 
     dispatch_task = asyncio.create_task(dispatch.dispatch_order(order.id, session_local=TestingSessionLocal))
     acceptance_task = asyncio.create_task(simulate_second_courier_acceptance())
@@ -96,3 +97,214 @@ async def test_dispatch_timeout_and_second_courier_accepts(db_session: AsyncSess
     assert final_order.status == "ASSIGNED"
     assert final_order.courier_id == courier2.id
     assert final_order.attempt_count == 2
+
+@pytest.mark.asyncio
+async def test_parallel_dispatch_first_accept_wins(db_session: AsyncSession):
+    from fastapi import HTTPException
+    from backend.routers.orders import respond_to_order
+
+    restaurant = models.Restaurant(id=1, name="R", lat=0, lng=0)
+    couriers = [
+        models.Courier(id=i, name=f"C{i}", email=f"c{i}@example.com", lat=0.001 * i, lng=0.001 * i, available=True)
+        for i in range(1, 4)
+    ]
+    order = models.Order(id=1, restaurant_id=restaurant.id, status="SEARCHING")
+    db_session.add_all([restaurant, *couriers, order])
+    await db_session.commit()
+    await sync_registry()
+
+    async def simulate_race():
+        while not dispatch.open_offers.get(order.id):
+            await asyncio.sleep(0.01)
+        assert dispatch.open_offers[order.id] == {1, 2, 3}
+        async with TestingSessionLocal() as db:
+            await respond_to_order(order.id, True, db, couriers[1])
+        async with TestingSessionLocal() as db:
+            with pytest.raises(HTTPException) as exc:
+                await respond_to_order(order.id, True, db, couriers[0])
+            assert exc.value.status_code in (403, 409)
+
+    await asyncio.gather(
+        dispatch.dispatch_order(order.id, session_local=TestingSessionLocal, strategy="parallel"),
+        simulate_race(),
+    )
+
+    final_order = await db_session.get(models.Order, order.id)
+    await db_session.refresh(final_order)
+    assert final_order.status == "ASSIGNED"
+    assert final_order.courier_id == 2
+    assert final_order.attempt_count == 3
+    assert not dispatch.open_offers
+
+@pytest.mark.asyncio
+async def test_accepting_an_expired_offer_is_refused(db_session: AsyncSession):
+    import datetime
+    from fastapi import HTTPException
+    from backend.routers.orders import respond_to_order
+
+    couriers = [
+        models.Courier(id=i, name=f"C{i}", email=f"c{i}@example.com", lat=0, lng=0, available=True)
+        for i in (1, 2, 12)
+    ]
+    order = models.Order(id=1, restaurant_id=1, status="SEARCHING")
+    # Onda paralela de outro worker cujo prazo já passou
+    entry = models.DispatchLedger(
+        order_id=1, strategy="parallel", candidate_courier_ids="1,2", tried_courier_ids="1,2",
+        deadline=datetime.datetime.utcnow() - datetime.timedelta(seconds=1),
+    )
+    db_session.add_all([models.Restaurant(id=1, name="R", lat=0, lng=0), *couriers, order, entry])
+    await db_session.commit()
+
+    async with TestingSessionLocal() as db:
+        with pytest.raises(HTTPException) as exc:
+            await respond_to_order(1, True, db, couriers[0])
+        assert exc.value.status_code == 409
+
+    # Com a oferta aberta, só quem está na onda pode aceitar (12 não casa com "1,2")
+    entry.deadline = datetime.datetime.utcnow() + datetime.timedelta(seconds=30)
+    await db_session.commit()
+    async with TestingSessionLocal() as db:
+        assert not await dispatch.claim_order(db, 1, 12)
+    async with TestingSessionLocal() as db:
+        accepted = await respond_to_order(1, True, db, couriers[1])
+        assert (accepted.status, accepted.courier_id) == ("ASSIGNED", 2)
+
+@pytest.mark.asyncio
+async def test_reserved_courier_is_not_offered_to_a_second_order(db_session: AsyncSession):
+    from backend.reservations import reservations
+
+    restaurant = models.Restaurant(id=1, name="R", lat=0, lng=0)
+    courier = models.Courier(id=1, name="C1", email="c1@example.com", lat=0.001, lng=0.001, available=True)
+    first = models.Order(id=1, restaurant_id=restaurant.id, status="SEARCHING")
+    second = models.Order(id=2, restaurant_id=restaurant.id, status="SEARCHING")
+    db_session.add_all([restaurant, courier, first, second])
+    await db_session.commit()
+    await sync_registry()
+
+    first_task = asyncio.create_task(dispatch.dispatch_order(first.id, session_local=TestingSessionLocal))
+    await wait_for_offer(first.id, {courier.id})
+    assert reservations.holder(courier.id) == first.id
+
+    # O único motoboy está reservado para o primeiro pedido
+    status = await dispatch.dispatch_order(second.id, session_local=TestingSessionLocal)
+    assert status == "NO_COURIER_FOUND"
+    assert second.id not in dispatch.open_offers
+
+    await accept(first.id, courier.id)
+    assert await first_task == "ASSIGNED"
+    assert reservations.holder(courier.id) is None
+
+@pytest.mark.asyncio
+async def test_offline_couriers_are_skipped(db_session: AsyncSession):
+    restaurant = models.Restaurant(id=1, name="R", lat=0, lng=0)
+    near = models.Courier(id=1, name="C1", email="c1@example.com", lat=0.001, lng=0.001, available=True)
+    far = models.Courier(id=2, name="C2", email="c2@example.com", lat=0.005, lng=0.005, available=True)
+    order = models.Order(id=1, restaurant_id=restaurant.id, status="SEARCHING")
+    db_session.add_all([restaurant, near, far, order])
+    await db_session.commit()
+    await sync_registry()
+    manager.presence.set_remote("courier_1", "tests", False)
+
+    task = asyncio.create_task(dispatch.dispatch_order(order.id, session_local=TestingSessionLocal))
+    # O mais próximo está offline: a primeira oferta já vai para o segundo
+    await wait_for_offer(order.id, {far.id})
+    await accept(order.id, far.id)
+    assert await task == "ASSIGNED"
+
+@pytest.mark.asyncio
+async def test_recovery_skips_expired_offer_and_drain_keeps_checkpoint(db_session: AsyncSession):
+    import datetime
+    from backend.recovery import recover_dispatches
+
+    restaurant = models.Restaurant(id=1, name="R", lat=0, lng=0)
+    courier1 = models.Courier(id=1, name="C1", email="c1@example.com", lat=0.01, lng=0.01, available=True)
+    courier2 = models.Courier(id=2, name="C2", email="c2@example.com", lat=0.02, lng=0.02, available=True)
+    order = models.Order(id=1, restaurant_id=1, status="SEARCHING", current_candidate_courier_id=1, attempt_count=1)
+    entry = models.DispatchLedger(
+        order_id=1,
+        strategy="sequential",
+        candidate_courier_ids="1",
+        tried_courier_ids="1",
+        deadline=datetime.datetime.utcnow() - datetime.timedelta(seconds=5),
+    )
+    db_session.add_all([restaurant, courier1, courier2, order, entry])
+    await db_session.commit()
+    await sync_registry()
+
+    assert await recover_dispatches(TestingSessionLocal) == 1
+    while not dispatch.open_offers.get(order.id):
+        await asyncio.sleep(0.01)
+    assert dispatch.open_offers[order.id] == {2}
+
+    await dispatch.drain()
+    assert not dispatch.open_offers
+
+    async with TestingSessionLocal() as db:
+        checkpoint = await db.get(models.DispatchLedger, order.id)
+        resumed = await db.get(models.Order, order.id)
+    assert checkpoint.candidate_courier_ids == "2"
+    assert checkpoint.tried_courier_ids == "1,2"
+    assert resumed.current_candidate_courier_id == 2
+    assert resumed.attempt_count == 2
+
+@pytest.mark.asyncio
+async def test_recovery_only_takes_over_orders_of_dead_workers(db_session: AsyncSession, monkeypatch):
+    import datetime
+    from backend.bus import bus
+    from backend.recovery import recover_dispatches, release_lease
+    from backend.scheduler import dispatch_scheduler
+
+    resumed = []
+    monkeypatch.setattr(dispatch_scheduler, "submit", lambda order_id, **kwargs: resumed.append(order_id) or True)
+    now = datetime.datetime.utcnow()
+    db_session.add_all([
+        models.Restaurant(id=1, name="R", lat=0, lng=0),
+        models.DispatchNode(node_id="alive", lease_until=now + datetime.timedelta(seconds=30)),
+        models.DispatchNode(node_id="dead", lease_until=now - datetime.timedelta(seconds=1)),
+        models.Order(id=1, restaurant_id=1, status="SEARCHING", dispatch_owner="alive"),
+        models.Order(id=2, restaurant_id=1, status="SEARCHING", dispatch_owner="dead"),
+        models.Order(id=3, restaurant_id=1, status="SEARCHING"),
+        models.Order(id=4, restaurant_id=1, status="ASSIGNED", dispatch_owner="dead"),
+    ])
+    await db_session.commit()
+
+    assert await recover_dispatches(TestingSessionLocal) == 2
+    assert resumed == [2, 3]
+    # Os pedidos retomados agora são deste worker: a próxima passada não os repete
+    assert await recover_dispatches(TestingSessionLocal) == 0
+
+    async with TestingSessionLocal() as db:
+        owners = dict((await db.execute(select(models.Order.id, models.Order.dispatch_owner))).all())
+        nodes = set((await db.execute(select(models.DispatchNode.node_id))).scalars())
+    assert owners == {1: "alive", 2: bus.node_id, 3: bus.node_id, 4: "dead"}
+    assert nodes == {"alive", bus.node_id}
+
+    # Ao desligar, o lease é liberado e outro worker assume os pedidos
+    await release_lease(TestingSessionLocal)
+    async with TestingSessionLocal() as db:
+        assert bus.node_id not in set((await db.execute(select(models.DispatchNode.node_id))).scalars())
+
+@pytest.mark.asyncio
+async def test_dispatch_releases_connection_while_waiting(tmp_path):
+    pooled_engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'pool.db'}")
+    PooledSession = async_sessionmaker(bind=pooled_engine, expire_on_commit=False)
+    async with pooled_engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    async with PooledSession() as db:
+        db.add_all([
+            models.Restaurant(id=1, name="R", lat=0, lng=0),
+            models.Courier(id=1, name="C1", email="c1@example.com", lat=0.01, lng=0.01, available=True),
+            models.Order(id=1, restaurant_id=1, status="SEARCHING"),
+        ])
+        await db.commit()
+    await sync_registry(PooledSession)
+
+    task = asyncio.create_task(dispatch.dispatch_order(1, session_local=PooledSession))
+    try:
+        while not dispatch.open_offers.get(1):
+            await asyncio.sleep(0.01)
+        assert pooled_engine.pool.checkedout() == 0
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        await pooled_engine.dispose()
@@ -0,0 +1,56 @@
+import datetime
+import decimal
+import json
+
+import pytest
+
+from backend import encoding
+from backend.encoding import Envelope, FastJSONResponse
+
+
+def test_envelope_encodes_once(monkeypatch):
+    calls = []
+    real_dumps = encoding.dumps
+    monkeypatch.setattr(encoding, "dumps", lambda obj: calls.append(obj) or real_dumps(obj))
+
+    envelope = Envelope({"type": "ORDER_UPDATE", "order_id": 1, "message": "Pedido 1 atualizado"})
+    texts = {envelope.text for _ in range(1000)}
+    assert len(calls) == 1
+    assert json.loads(texts.pop())["message"] == "Pedido 1 atualizado"
+
+
+def test_stdlib_fallback_matches_fast_encoder(monkeypatch):
+    payload = {"id": 1, "nome": "Pizzaria São João", "valores": [1.5, None, True], "ativo": False}
+    fast = encoding.dumps(payload)
+    monkeypatch.setattr(encoding, "orjson", None)
+    assert encoding.dumps(payload) == fast
+    assert FastJSONResponse(payload).body == fast
+
+
+@pytest.fixture(params=["orjson", "stdlib"])
+def backend(request, monkeypatch):
+    if request.param == "stdlib":
+        monkeypatch.setattr(encoding, "orjson", None)
+    elif encoding.orjson is None:
+        pytest.skip("orjson não instalado")
+    return request.param
+
+
+def test_unknown_types_encode_the_same_on_both_backends(backend):
+    payload = {
+        "created_at": datetime.datetime(2024, 5, 1, 12, 30, 0, 250000),
+        "day": datetime.date(2024, 5, 1),
+        "total": decimal.Decimal("12.50"),
+        1: "chave inteira",
+    }
+    assert json.loads(encoding.dumps(payload)) == {
+        "created_at": "2024-05-01T12:30:00.250000",
+        "day": "2024-05-01",
+        "total": "12.50",
+        "1": "chave inteira",
+    }
+
+
+def test_non_finite_floats_encode_as_null_on_both_backends(backend):
+    payload = {"lat": float("nan"), "valores": [1.5, float("inf"), (float("-inf"),)]}
+    assert encoding.dumps(payload) == b'{"lat":null,"valores":[1.5,null,[null]]}'
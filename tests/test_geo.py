@@ -0,0 +1,25 @@
+import numpy as np
+from geopy.distance import geodesic
+from backend import geo
+
+
+def test_lambert_tracks_geodesic():
+    lats = np.array([-23.55, -23.60, -23.40, -22.90])
+    lngs = np.array([-46.63, -46.70, -46.50, -43.20])
+    distances = geo.distances_km(-23.5505, -46.6333, lats, lngs, ellipsoidal=True)
+    expected = [geodesic((-23.5505, -46.6333), (lat, lng)).kilometers for lat, lng in zip(lats, lngs)]
+    assert np.allclose(distances, expected, atol=0.01)
+    assert geo.lambert_km(1.0, 1.0, 1.0, 1.0) == 0.0
+
+
+def test_distance_matrix_shape_matches_rows():
+    matrix = geo.distance_matrix([0.0, 0.1], [0.0, 0.1], [0.0, 0.05, 0.1], [0.0, 0.05, 0.1])
+    assert matrix.shape == (2, 3)
+    assert np.allclose(matrix[0], geo.haversine_km(0.0, 0.0, [0.0, 0.05, 0.1], [0.0, 0.05, 0.1]))
+    assert matrix[0, 0] == 0.0 and matrix[1, 2] == 0.0
+
+
+def test_radius_tiers_are_disjoint_and_sorted():
+    distances = np.array([4.0, 0.5, 12.0, 1.5, 0.9, 2.5])
+    tiers = geo.radius_tiers(distances, [1, 2, 3, 5, 10])
+    assert [tier.tolist() for tier in tiers] == [[1, 4], [3], [5], [0], []]
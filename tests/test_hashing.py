@@ -0,0 +1,113 @@
+import asyncio
+import threading
+import time
+
+import httpx
+import pytest
+from fastapi import FastAPI
+from passlib.context import CryptContext
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from backend import models
+from backend.db import get_db
+from backend.hashing import HasherBusy, PasswordHasher
+from backend.loop_monitor import LoopLagMonitor
+from backend.routers import auth
+from tests.conftest import TestingSessionLocal
+
+
+class BlockingContext:
+    def __init__(self):
+        self.release = threading.Event()
+
+    def hash(self, password):
+        self.release.wait(2)
+        return f"hashed:{password}"
+
+
+@pytest.mark.asyncio
+async def test_hasher_rejects_when_the_queue_is_full():
+    context = BlockingContext()
+    hasher = PasswordHasher(context, max_workers=1, max_pending=2)
+    try:
+        first = asyncio.ensure_future(hasher.hash("a"))
+        second = asyncio.ensure_future(hasher.hash("b"))
+        await asyncio.sleep(0)
+        with pytest.raises(HasherBusy):
+            await hasher.hash("c")
+
+        context.release.set()
+        assert await asyncio.gather(first, second) == ["hashed:a", "hashed:b"]
+        assert hasher.stats()["rejected"] == 1
+        assert hasher.stats()["pending"] == 0
+        assert await hasher.hash("d") == "hashed:d"
+    finally:
+        hasher.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_cancelled_request_keeps_its_slot_until_the_hash_finishes():
+    context = BlockingContext()
+    hasher = PasswordHasher(context, max_workers=1, max_pending=1)
+    try:
+        request = asyncio.ensure_future(hasher.hash("a"))
+        await asyncio.sleep(0.05)
+        request.cancel()
+        await asyncio.gather(request, return_exceptions=True)
+        # O bcrypt ainda está rodando na thread: o slot continua ocupado
+        assert hasher.stats()["pending"] == 1
+        with pytest.raises(HasherBusy):
+            await hasher.hash("b")
+
+        context.release.set()
+        while hasher.stats()["pending"]:
+            await asyncio.sleep(0.01)
+        assert await hasher.hash("c") == "hashed:c"
+    finally:
+        hasher.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_login_rehashes_passwords_made_with_old_parameters(db_session: AsyncSession, monkeypatch):
+    old_hash = CryptContext(schemes=["bcrypt"], bcrypt__rounds=4).hash("secret")
+    db_session.add(models.User(id=1, email="u1@example.com", hashed_password=old_hash, name="U1", role="CUSTOMER"))
+    await db_session.commit()
+    hasher = PasswordHasher(CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=5))
+    monkeypatch.setattr(auth, "password_hasher", hasher)
+
+    app = FastAPI()
+    app.include_router(auth.router)
+
+    async def override_get_db():
+        async with TestingSessionLocal() as db:
+            yield db
+
+    app.dependency_overrides[get_db] = override_get_db
+    try:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            wrong = await client.post("/token", data={"username": "u1@example.com", "password": "nope"})
+            assert wrong.status_code == 401
+            response = await client.post("/token", data={"username": "u1@example.com", "password": "secret"})
+            assert response.status_code == 200
+    finally:
+        hasher.shutdown()
+
+    async with TestingSessionLocal() as db:
+        stored = (await db.get(models.User, 1)).hashed_password
+    assert stored != old_hash and stored.startswith("$2b$05$")
+
+
+@pytest.mark.asyncio
+async def test_loop_monitor_counts_stalls():
+    monitor = LoopLagMonitor(interval=0.01, threshold=0.05)
+    monitor.start()
+    try:
+        await asyncio.sleep(0.03)
+        # Código síncrono que não devolve o controle ao loop
+        time.sleep(0.1)
+        await asyncio.sleep(0.03)
+    finally:
+        await monitor.stop()
+    stats = monitor.stats()
+    assert stats["stalls"] >= 1
+    assert stats["max_lag_ms"] >= 50
@@ -0,0 +1,103 @@
+import asyncio
+
+import pytest
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from backend import models
+from backend.locations import LocationPipeline
+from backend.registry import CourierRegistry
+from backend.spatial import CourierIndex
+from tests.conftest import TestingSessionLocal
+
+
+@pytest.mark.asyncio
+async def test_updates_are_coalesced_and_flushed_in_bulk(db_session: AsyncSession):
+    couriers = [
+        models.Courier(id=i, name=f"C{i}", email=f"c{i}@example.com", lat=0, lng=0, available=True)
+        for i in range(1, 4)
+    ]
+    db_session.add_all(couriers)
+    await db_session.commit()
+    index = CourierIndex()
+    registry = CourierRegistry(index=index, session_factory=TestingSessionLocal)
+    await registry.warm()
+
+    pipeline = LocationPipeline(flush_interval=3600, batch_size=2, session_factory=TestingSessionLocal, registry=registry)
+    try:
+        for step in range(5):
+            for courier_id in (1, 2, 3):
+                await pipeline.put(courier_id, courier_id + step / 100, -courier_id)
+
+        # Memória e índice já refletem a última posição antes de qualquer gravação
+        assert pipeline.position(1) == (1.04, -1)
+        assert index.position(1) == (1.04, -1)
+        assert pipeline.stats()["pending"] == 3
+        assert pipeline.coalesced == 12
+
+        assert await pipeline.flush() == 3
+    finally:
+        await pipeline.stop()
+
+    async with TestingSessionLocal() as db:
+        rows = {c.id: (c.lat, c.lng) for c in (await db.execute(models.Courier.__table__.select())).all()}
+    assert rows == {1: (1.04, -1), 2: (2.04, -2), 3: (3.04, -3)}
+    assert pipeline.stats()["pending"] == 0
+
+
+@pytest.mark.asyncio
+async def test_full_dirty_table_waits_for_a_flush(db_session: AsyncSession):
+    db_session.add_all([
+        models.Courier(id=i, name=f"C{i}", email=f"c{i}@example.com", lat=0, lng=0, available=True)
+        for i in range(1, 4)
+    ])
+    await db_session.commit()
+
+    registry = CourierRegistry(index=CourierIndex(), session_factory=TestingSessionLocal)
+    pipeline = LocationPipeline(flush_interval=3600, max_pending=2, session_factory=TestingSessionLocal, registry=registry)
+    try:
+        await pipeline.put(1, 1, 1)
+        await pipeline.put(2, 2, 2)
+        # Atualizar quem já está pendente não ocupa espaço novo
+        await pipeline.put(2, 2.5, 2.5)
+        await asyncio.wait_for(pipeline.put(3, 3, 3), timeout=2)
+        assert pipeline.backpressure_waits == 1
+        assert pipeline.flushes == 1
+    finally:
+        await pipeline.stop()
+
+    async with TestingSessionLocal() as db:
+        courier = await db.get(models.Courier, 2)
+        assert (courier.lat, courier.lng) == (2.5, 2.5)
+        courier = await db.get(models.Courier, 3)
+        assert (courier.lat, courier.lng) == (3, 3)
+
+
+class _DatabaseDown:
+    def __init__(self):
+        self.attempts = 0
+
+    def __call__(self):
+        self.attempts += 1
+        raise ConnectionError("banco fora do ar")
+
+
+@pytest.mark.asyncio
+async def test_failed_flush_backs_off_and_keeps_producers_waiting():
+    factory = _DatabaseDown()
+    pipeline = LocationPipeline(
+        flush_interval=0.02, max_pending=1, max_backoff=0.08,
+        session_factory=factory, registry=CourierRegistry(index=CourierIndex()),
+    )
+    try:
+        await pipeline.put(1, 1, 1)
+        blocked = asyncio.create_task(pipeline.put(2, 2, 2))
+        await asyncio.sleep(0.3)
+        # Espera 0.02, 0.04, 0.08, 0.08... em vez de tentar em loop
+        assert 2 <= factory.attempts <= 7
+        assert pipeline.failures == pipeline.failures_in_a_row == factory.attempts
+        # Nada foi gravado: quem espera espaço continua esperando
+        assert not blocked.done()
+        assert pipeline.stats()["pending"] == 1
+    finally:
+        blocked.cancel()
+        await pipeline.stop()
@@ -0,0 +1,63 @@
+import io
+import json
+import logging
+import queue
+
+import pytest
+
+from backend.log import DROPPED_RECORDS, NonBlockingQueueHandler, setup_logging, stop_logging
+
+
+@pytest.fixture
+def log_stream():
+    stream = io.StringIO()
+    setup_logging(stream=stream, fmt="json", level="INFO", levels="dispatch=DEBUG,ws=WARNING")
+    yield stream
+    stop_logging()
+    root = logging.getLogger("telego")
+    root.handlers = []
+    root.propagate = True
+    root.setLevel(logging.NOTSET)
+    for name in ("dispatch", "ws"):
+        logging.getLogger(f"telego.{name}").setLevel(logging.NOTSET)
+
+
+def read(stream):
+    stop_logging()
+    return [json.loads(line) for line in stream.getvalue().splitlines()]
+
+
+def test_records_are_written_as_json_with_subsystem_levels(log_stream):
+    logging.getLogger("telego.dispatch").debug("Oferta enviada", extra={"order_id": 1, "courier_id": 2})
+    logging.getLogger("telego.ws").info("Sessão conectada")
+    logging.getLogger("telego.orders").debug("Só com DEBUG")
+    try:
+        raise ValueError("boom")
+    except ValueError:
+        logging.getLogger("telego.bus").exception("Erro no canal %s", "x")
+
+    first, second = read(log_stream)
+    assert (first["logger"], first["level"], first["msg"]) == ("telego.dispatch", "DEBUG", "Oferta enviada")
+    assert (first["order_id"], first["courier_id"]) == (1, 2)
+    assert second["msg"] == "Erro no canal x"
+    assert "ValueError: boom" in second["exc"]
+
+
+def test_high_volume_records_are_sampled(log_stream):
+    logger = logging.getLogger("telego.auth")
+    for i in range(25):
+        logger.warning("Token inválido %s", i, extra={"sample": 10})
+    records = read(log_stream)
+    assert [r["msg"] for r in records] == ["Token inválido 0", "Token inválido 10", "Token inválido 20"]
+    assert all(r["sampled"] == 10 for r in records)
+
+
+def test_full_queue_drops_instead_of_blocking():
+    handler = NonBlockingQueueHandler(queue.Queue(1))
+    logger = logging.Logger("telego.test")
+    logger.addHandler(handler)
+    before = DROPPED_RECORDS.value()
+    for _ in range(3):
+        logger.warning("x")
+    assert handler.queue.qsize() == 1
+    assert DROPPED_RECORDS.value() == before + 2
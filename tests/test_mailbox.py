@@ -0,0 +1,54 @@
+import json
+
+import pytest
+
+from backend.bus import InMemoryBus
+from backend.mailbox import MailboxStore
+from backend.websocket_manager import ConnectionManager
+from tests.conftest import FakeWebSocket
+
+
+def test_since_returns_gap_or_requires_resync():
+    store = MailboxStore(capacity=3)
+    for i in range(5):
+        store.append("courier_1", {"type": "ORDER_UPDATE", "order_id": i})
+
+    assert store.last_seq("courier_1") == 5
+    assert [json.loads(e.text)["seq"] for e in store.since("courier_1", 3)] == [4, 5]
+    assert store.since("courier_1", 5) == []
+    # Lacuna mais antiga que a caixa, sequência do futuro ou de outra época
+    assert store.since("courier_1", 1) is None
+    assert store.since("courier_1", 9) is None
+    assert store.since("courier_1", 4, epoch="outra") is None
+    assert store.since("courier_2", 0) == []
+
+
+@pytest.mark.asyncio
+async def test_reconnect_receives_only_missed_messages():
+    manager = ConnectionManager(InMemoryBus())
+    first = FakeWebSocket()
+    session = await manager.connect(first, "courier_1", "COURIER")
+    manager.resume(session)
+    await manager.withdraw_offer(1, 10)
+    await manager.flush()
+    hello, withdrawn = first.sent
+    assert hello["type"] == "SESSION" and withdrawn["seq"] == 1
+    await manager.disconnect("courier_1", session)
+
+    # Enquanto estava offline
+    await manager.withdraw_offer(1, 11)
+    await manager.withdraw_offer(1, 12)
+
+    second = FakeWebSocket()
+    session = await manager.connect(second, "courier_1", "COURIER")
+    assert manager.resume(session, last_seq=1, epoch=hello["epoch"]) == 2
+    await manager.flush()
+    assert [m.get("order_id") for m in second.sent] == [None, 11, 12]
+    assert [m.get("seq") for m in second.sent[1:]] == [2, 3]
+
+    third = FakeWebSocket()
+    session = await manager.connect(third, "courier_1", "COURIER")
+    assert manager.resume(session, last_seq=1, epoch="reiniciado") is None
+    await manager.flush()
+    assert [m["type"] for m in third.sent] == ["RESYNC_REQUIRED"]
+    await manager.disconnect("courier_1")
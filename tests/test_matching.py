@@ -0,0 +1,84 @@
+import asyncio
+import itertools
+import numpy as np
+import pytest
+from backend import dispatch, models
+from backend.matching import BatchDispatcher, solve_assignment
+from tests.conftest import TestingSessionLocal, sync_registry
+
+
+def brute_force_cost(cost):
+    rows, cols = cost.shape
+    best = np.inf
+    for perm in itertools.permutations(range(cols), rows):
+        best = min(best, sum(cost[r, c] for r, c in enumerate(perm)))
+    return best
+
+
+@pytest.mark.parametrize("shape", [(3, 3), (3, 5), (5, 3), (6, 6)])
+def test_solve_assignment_is_optimal(shape):
+    rng = np.random.default_rng(7)
+    for _ in range(20):
+        cost = rng.uniform(0, 10, size=shape)
+        pairs = solve_assignment(cost)
+        assert len(pairs) == min(shape)
+        assert len({r for r, _ in pairs}) == len({c for _, c in pairs}) == len(pairs)
+        expected = brute_force_cost(cost if shape[0] <= shape[1] else cost.T)
+        assert np.isclose(sum(cost[r, c] for r, c in pairs), expected)
+
+
+def test_solve_assignment_skips_forbidden_pairs():
+    cost = np.array([[1.0, np.inf], [np.inf, np.inf]])
+    assert solve_assignment(cost) == [(0, 0)]
+
+
+@pytest.mark.asyncio
+async def test_batch_round_beats_greedy(db_session):
+    # Greedy per-order dispatch would give courier 1 to order 1 and leave
+    # order 2 with the far courier; the batch solution swaps them.
+    restaurants = [
+        models.Restaurant(id=1, name="R1", lat=0.0, lng=0.0),
+        models.Restaurant(id=2, name="R2", lat=0.0, lng=0.02),
+    ]
+    couriers = [
+        models.Courier(id=1, name="C1", email="c1@example.com", lat=0.0, lng=0.01, available=True),
+        models.Courier(id=2, name="C2", email="c2@example.com", lat=0.0, lng=-0.005, available=True),
+    ]
+    orders = [models.Order(id=i, restaurant_id=i, status="SEARCHING") for i in (1, 2)]
+    db_session.add_all([*restaurants, *couriers, *orders])
+    await db_session.commit()
+    await sync_registry()
+
+    batcher = BatchDispatcher(window_seconds=60, offer_timeout=0.1, session_factory=TestingSessionLocal)
+    batcher.submit(1)
+    batcher.submit(2)
+    try:
+        assert sorted(await batcher.run_round()) == [(1, 2), (2, 1)]
+        await asyncio.sleep(0.3)
+        assert dispatch.open_offers == {}
+        assert sorted(batcher.pending) == [1, 2]
+    finally:
+        await batcher.stop()
+
+
+@pytest.mark.asyncio
+async def test_batch_round_skips_offline_couriers(db_session):
+    from backend.websocket_manager import manager
+
+    db_session.add_all([
+        models.Restaurant(id=1, name="R1", lat=0.0, lng=0.0),
+        models.Courier(id=1, name="C1", email="c1@example.com", lat=0.0, lng=0.001, available=True),
+        models.Courier(id=2, name="C2", email="c2@example.com", lat=0.0, lng=0.01, available=True),
+        models.Order(id=1, restaurant_id=1, status="SEARCHING"),
+    ])
+    await db_session.commit()
+    await sync_registry()
+    # O mais próximo está offline: a oferta vai para o outro
+    manager.presence.set_remote("courier_1", "tests", False)
+
+    batcher = BatchDispatcher(window_seconds=60, offer_timeout=0.1, session_factory=TestingSessionLocal)
+    batcher.submit(1)
+    try:
+        assert await batcher.run_round() == [(1, 2)]
+    finally:
+        await batcher.stop()
@@ -0,0 +1,74 @@
+import asyncio
+
+import httpx
+import pytest
+from fastapi import FastAPI
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from backend import dispatch, models
+from backend.metrics import REQUEST_LATENCY, MetricsMiddleware, MetricsRegistry
+from tests.conftest import TestingSessionLocal, accept, sync_registry, wait_for_offer
+
+
+def test_registry_renders_prometheus_text():
+    registry = MetricsRegistry()
+    sends = registry.counter("sends_total", "Sends.", ("result",))
+    latency = registry.histogram("latency_seconds", "Latency.", ("route",), buckets=(0.1, 1))
+    registry.gauge("open", "Open things.", callback=lambda: 3)
+    sends.inc(result="ok")
+    sends.inc(2, result="ok")
+    for value in (0.05, 0.1, 0.5, 7):
+        latency.observe(value, route="/a")
+
+    assert registry.counter("sends_total", "Sends.", ("result",)) is sends
+    text = registry.render()
+    assert 'sends_total{result="ok"} 3' in text
+    assert 'latency_seconds_bucket{route="/a",le="0.1"} 2' in text
+    assert 'latency_seconds_bucket{route="/a",le="1"} 3' in text
+    assert 'latency_seconds_bucket{route="/a",le="+Inf"} 4' in text
+    assert 'latency_seconds_count{route="/a"} 4' in text
+    assert "# TYPE open gauge\nopen 3" in text
+
+    with pytest.raises(ValueError):
+        sends.inc(status="ok")
+
+
+@pytest.mark.asyncio
+async def test_middleware_labels_requests_with_the_route_template():
+    app = FastAPI()
+    app.add_middleware(MetricsMiddleware)
+
+    @app.get("/things/{thing_id}")
+    async def get_thing(thing_id: int):
+        return {"id": thing_id}
+
+    before = REQUEST_LATENCY.count(method="GET", route="/things/{thing_id}", status=200)
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+        for thing_id in (1, 2, 3):
+            assert (await client.get(f"/things/{thing_id}")).status_code == 200
+        assert (await client.get("/missing")).status_code == 404
+    assert REQUEST_LATENCY.count(method="GET", route="/things/{thing_id}", status=200) == before + 3
+    assert REQUEST_LATENCY.count(method="GET", route="unmatched", status=404) >= 1
+
+
+@pytest.mark.asyncio
+async def test_dispatch_records_assignment_metrics(db_session: AsyncSession):
+    restaurant = models.Restaurant(id=1, name="R", lat=0, lng=0)
+    courier = models.Courier(id=1, name="C1", email="c1@example.com", lat=0.001, lng=0.001, available=True)
+    order = models.Order(id=1, restaurant_id=1, status="SEARCHING")
+    db_session.add_all([restaurant, courier, order])
+    await db_session.commit()
+    await sync_registry()
+
+    assigned = dispatch.OUTCOMES.value(status="ASSIGNED")
+    to_assign = dispatch.TIME_TO_ASSIGN.count()
+    responses = dispatch.OFFER_RESPONSE.count(outcome="accepted")
+
+    task = asyncio.create_task(dispatch.dispatch_order(order.id, session_local=TestingSessionLocal))
+    await wait_for_offer(order.id, {courier.id})
+    await accept(order.id, courier.id)
+    assert await task == "ASSIGNED"
+
+    assert dispatch.OUTCOMES.value(status="ASSIGNED") == assigned + 1
+    assert dispatch.TIME_TO_ASSIGN.count() == to_assign + 1
+    assert dispatch.OFFER_RESPONSE.count(outcome="accepted") == responses + 1
@@ -0,0 +1,109 @@
+import pytest
+from sqlalchemy import event, inspect, text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from backend import models  # noqa: F401 - registra as tabelas em Base.metadata
+from backend.db import Base
+from backend.init_db import init_db
+from backend.migrations import LATEST_VERSION, current_version, run_migrations
+
+
+@pytest.fixture
+async def engine(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'telego.db'}")
+    yield engine
+    await engine.dispose()
+
+
+def indexes(conn, table):
+    return {index["name"] for index in inspect(conn).get_indexes(table)}
+
+
+@pytest.mark.asyncio
+async def test_fresh_database_is_migrated_once(engine):
+    assert await run_migrations(engine) == list(range(1, LATEST_VERSION + 1))
+    assert await current_version(engine) == LATEST_VERSION
+    async with engine.connect() as conn:
+        assert {"ix_orders_restaurant_created", "ix_orders_courier_created", "ix_orders_candidate_status"} <= (
+            await conn.run_sync(indexes, "orders")
+        )
+        assert "ix_couriers_available" in await conn.run_sync(indexes, "couriers")
+
+    # Schema em dia: só a consulta da versão
+    statements = []
+    event.listen(engine.sync_engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+    assert await run_migrations(engine) == []
+    assert len(statements) == 1
+
+
+@pytest.mark.asyncio
+async def test_legacy_orders_table_gets_missing_columns(engine):
+    async with engine.begin() as conn:
+        await conn.execute(text(
+            "CREATE TABLE orders (id INTEGER PRIMARY KEY, restaurant_id INTEGER, courier_id INTEGER, "
+            "status VARCHAR, current_candidate_courier_id INTEGER, offer_sent_at TIMESTAMP, attempt_count INTEGER)"
+        ))
+        await conn.execute(text("INSERT INTO orders (id, restaurant_id, status) VALUES (1, 1, 'DELIVERED')"))
+
+    await run_migrations(engine)
+
+    async with engine.connect() as conn:
+        columns = await conn.run_sync(lambda sync_conn: {c["name"] for c in inspect(sync_conn).get_columns("orders")})
+        assert {"customer_name", "delivery_address", "pickup_address", "price", "order_value", "created_at"} <= columns
+        row = (await conn.execute(text("SELECT status, created_at FROM orders WHERE id = 1"))).one()
+        assert row.status == "DELIVERED"
+        # Backfill: pedido antigo também entra no histórico paginado
+        assert row.created_at is not None
+        created_at = next(
+            column for column in await conn.run_sync(lambda sync_conn: inspect(sync_conn).get_columns("orders"))
+            if column["name"] == "created_at"
+        )
+        assert created_at["nullable"] is False
+        assert "ix_orders_restaurant_created" in await conn.run_sync(indexes, "orders")
+
+
+def schema(conn):
+    inspector = inspect(conn)
+    return {
+        table: (
+            {column["name"] for column in inspector.get_columns(table)},
+            {index["name"] for index in inspector.get_indexes(table)},
+        )
+        for table in inspector.get_table_names()
+        if table != "schema_version"
+    }
+
+
+@pytest.mark.asyncio
+async def test_migrated_schema_matches_models(engine, tmp_path):
+    await run_migrations(engine)
+    models_engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'models.db'}")
+    try:
+        async with models_engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+            expected = await conn.run_sync(schema)
+    finally:
+        await models_engine.dispose()
+
+    async with engine.connect() as conn:
+        assert await conn.run_sync(schema) == expected
+
+
+@pytest.mark.asyncio
+async def test_schema_built_from_the_models_migrates_cleanly(engine):
+    # Bancos criados pelo init_db antigo (create_all, sem schema_version)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.execute(text("INSERT INTO orders (id, restaurant_id, status, created_at, dispatch_owner) "
+                                "VALUES (1, 1, 'SEARCHING', '2024-01-01 00:00:00', 'node')"))
+
+    assert await run_migrations(engine) == list(range(1, LATEST_VERSION + 1))
+    async with engine.connect() as conn:
+        assert (await conn.execute(text("SELECT dispatch_owner FROM orders WHERE id = 1"))).scalar() == "node"
+
+
+@pytest.mark.asyncio
+async def test_init_db_records_the_schema_version(engine):
+    await init_db(engine)
+    assert await current_version(engine) == LATEST_VERSION
+    assert await run_migrations(engine) == []
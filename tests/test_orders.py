@@ -0,0 +1,242 @@
+import asyncio
+import datetime
+
+import httpx
+import pytest
+from fastapi import FastAPI, Request, Response
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from backend import dispatch, models
+from backend.db import get_db
+from backend.routers import orders as orders_router
+from backend.routers.orders import stream_courier_events, wait_for_available_orders
+from backend.websocket_manager import manager
+from tests.conftest import TestingSessionLocal, count_statements, sync_registry
+
+
+def make_client(courier: models.Courier) -> httpx.AsyncClient:
+    app = FastAPI()
+    app.include_router(orders_router.router)
+
+    async def override_get_db():
+        async with TestingSessionLocal() as db:
+            yield db
+
+    app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[orders_router.get_current_courier] = lambda: courier
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test")
+
+
+@pytest.mark.asyncio
+async def test_order_listings_run_one_statement(db_session: AsyncSession):
+    restaurants = [models.Restaurant(id=i, name=f"R{i}", lat=0, lng=0) for i in (1, 2)]
+    courier = models.Courier(id=1, name="C1", email="c1@example.com", lat=0, lng=0, available=True)
+    orders = [
+        models.Order(id=i, restaurant_id=1 + i % 2, courier_id=1, status="DELIVERED", price=10.0 + i)
+        for i in range(1, 21)
+    ]
+    orders.append(models.Order(id=21, restaurant_id=2, status="SEARCHING", current_candidate_courier_id=1))
+    db_session.add_all([*restaurants, courier, *orders])
+    await db_session.commit()
+
+    async with make_client(courier) as client:
+        for url, expected in [
+            ("/orders/courier/1", 20),
+            ("/orders/restaurant/2", 11),
+            ("/orders/available", 1),
+        ]:
+            with count_statements() as statements:
+                response = await client.get(url)
+            assert response.status_code == 200
+            body = response.json()
+            assert len(body) == expected
+            assert len(statements) == 1, (url, statements)
+            assert {o["restaurantName"] for o in body} <= {"R1", "R2"}
+
+        courier_orders = (await client.get("/orders/courier/1")).json()
+        # Mais recente primeiro; o id desempata
+        assert courier_orders[0]["id"] == 20
+        assert courier_orders[0]["price"] == 30.0
+        assert courier_orders[0]["restaurantName"] == "R1"
+
+        # O restaurante vê o preço gravado no pedido
+        restaurant_orders = (await client.get("/orders/restaurant/2")).json()
+        prices = {o["id"]: o["price"] for o in restaurant_orders}
+        assert (prices[19], prices[21]) == (29.0, 0.0)
+
+
+@pytest.mark.asyncio
+async def test_long_poll_wakes_on_offer(db_session: AsyncSession):
+    restaurant = models.Restaurant(id=1, name="R", lat=0, lng=0)
+    courier = models.Courier(id=1, name="C1", email="c1@example.com", lat=0.001, lng=0.001, available=True)
+    order = models.Order(id=1, restaurant_id=restaurant.id, status="SEARCHING")
+    db_session.add_all([restaurant, courier, order])
+    await db_session.commit()
+    await sync_registry()
+
+    async with TestingSessionLocal() as db:
+        response = Response()
+        assert await wait_for_available_orders(response, timeout=0.05, db=db, current_courier=courier) == []
+        assert response.headers["X-Mailbox-Epoch"] == manager.mailboxes.epoch
+
+    async def poll():
+        async with TestingSessionLocal() as db:
+            return await wait_for_available_orders(Response(), timeout=5, db=db, current_courier=courier)
+
+    poller = asyncio.create_task(poll())
+    await asyncio.sleep(0.05)
+    dispatch_task = asyncio.create_task(dispatch.dispatch_order(order.id, session_local=TestingSessionLocal))
+    orders = await asyncio.wait_for(poller, timeout=2)
+    assert [o.id for o in orders] == [order.id]
+    assert orders[0].restaurantName == "R"
+
+    await dispatch.drain()
+    dispatch_task.cancel()
+    await asyncio.gather(dispatch_task, return_exceptions=True)
+
+
+@pytest.mark.asyncio
+async def test_sse_stream_resumes_from_last_event_id():
+    courier = models.Courier(id=5, name="C5", email="c5@example.com", lat=0, lng=0, available=True)
+    await manager.withdraw_offer(5, 1)
+    await manager.withdraw_offer(5, 2)
+    last_seq = manager.mailboxes.last_seq("courier_5")
+
+    request = Request({"type": "http", "headers": [(b"last-event-id", str(last_seq - 1).encode())]})
+    response = await stream_courier_events(request, epoch=manager.mailboxes.epoch, current_courier=courier)
+    events = response.body_iterator
+    try:
+        assert (await events.__anext__()).startswith("event: SESSION")
+        replayed = await events.__anext__()
+        assert replayed.startswith(f"id: {last_seq}\nevent: ORDER_WITHDRAWN")
+        assert manager.presence.is_courier_online(5)
+
+        await manager.withdraw_offer(5, 3)
+        live = await events.__anext__()
+        assert live.startswith(f"id: {last_seq + 1}\n") and '"order_id":3' in live
+    finally:
+        await events.aclose()
+    assert not manager.presence.is_courier_online(5)
+
+
+@pytest.mark.asyncio
+async def test_order_history_pages_with_cursor_and_filters(db_session: AsyncSession, monkeypatch):
+    restaurant = models.Restaurant(id=1, name="R1", lat=0, lng=0)
+    courier = models.Courier(id=1, name="C1", email="c1@example.com", lat=0, lng=0, available=True)
+    start = datetime.datetime(2024, 1, 1)
+    # Dois pedidos por instante, para o desempate pelo id
+    orders = [
+        models.Order(
+            id=i, restaurant_id=1, courier_id=1, status="CANCELLED" if i % 5 == 0 else "DELIVERED",
+            created_at=start + datetime.timedelta(hours=(i - 1) // 2),
+        )
+        for i in range(1, 26)
+    ]
+    db_session.add_all([restaurant, courier, *orders])
+    await db_session.commit()
+
+    async with make_client(courier) as client:
+        seen, cursor = [], None
+        while True:
+            params = {"limit": 4, **({"cursor": cursor} if cursor else {})}
+            response = await client.get("/orders/restaurant/1", params=params)
+            assert response.status_code == 200
+            seen.extend(o["id"] for o in response.json())
+            cursor = response.headers.get("X-Next-Cursor")
+            if cursor is None:
+                break
+        assert seen == list(range(25, 0, -1))
+
+        # Sem limit nem cursor vem tudo, como o app espera
+        monkeypatch.setattr(orders_router, "ORDER_PAGE_SIZE", 4)
+        response = await client.get("/orders/restaurant/1")
+        assert [o["id"] for o in response.json()] == list(range(25, 0, -1))
+        assert "X-Next-Cursor" not in response.headers
+
+        response = await client.get("/orders/courier/1", params={
+            "status": "CANCELLED",
+            "created_from": (start + datetime.timedelta(hours=2)).isoformat(),
+            "created_to": (start + datetime.timedelta(hours=10)).isoformat(),
+        })
+        assert [o["id"] for o in response.json()] == [20, 15, 10, 5]
+        assert "X-Next-Cursor" not in response.headers
+
+        assert (await client.get("/orders/courier/1", params={"cursor": "nope"})).status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_bulk_create_keeps_item_order_and_reports_bad_items(db_session: AsyncSession, monkeypatch):
+    db_session.add(models.Restaurant(id=1, name="R1", lat=0, lng=0))
+    await db_session.commit()
+    queued = []
+    monkeypatch.setattr(orders_router, "_enqueue_dispatch", lambda order_id, created_at: queued.append(order_id) or True)
+
+    items = [{"restaurant_id": 1, "customer_name": f"Cliente {i}", "price": 10 + i} for i in range(50)]
+    items[3] = {"customer_name": "sem restaurante"}
+    items[7] = {"restaurant_id": 99}
+    courier = models.Courier(id=1, name="C1", email="c1@example.com", lat=0, lng=0)
+    async with make_client(courier) as client:
+        with count_statements() as statements:
+            response = await client.post("/orders/bulk", json=items)
+    assert response.status_code == 200
+    body = response.json()
+    assert (body["created"], body["failed"]) == (48, 2)
+    assert "restaurant_id" in body["results"][3]["error"]
+    assert body["results"][7]["error"] == "Restaurante não encontrado"
+    # Uma consulta de restaurantes para o lote todo (o INSERT só vira um
+    # comando em bancos com sentinel implícito, como o Postgres)
+    assert sum(s.lstrip().upper().startswith("SELECT") for s in statements) == 1
+
+    ids = [r["id"] for r in body["results"] if r["id"] is not None]
+    assert queued == ids
+    async with TestingSessionLocal() as db:
+        created = {o.id: o for o in (await db.execute(select(models.Order))).scalars()}
+    assert created.keys() == set(ids)
+    # Cada id volta na posição do item que o gerou
+    assert created[body["results"][10]["id"]].customer_name == "Cliente 10"
+    assert all(o.status == "SEARCHING" for o in created.values())
+
+
+@pytest.mark.asyncio
+async def test_order_refused_by_full_queue_is_left_for_recovery(db_session: AsyncSession, monkeypatch):
+    from backend.scheduler import DispatchScheduler
+
+    db_session.add(models.Restaurant(id=1, name="R1", lat=0, lng=0))
+    await db_session.commit()
+    # A fila enche entre a checagem de capacidade e o INSERT
+    monkeypatch.setattr(orders_router, "_check_dispatch_capacity", lambda: None)
+    monkeypatch.setattr(orders_router, "dispatch_scheduler", DispatchScheduler(workers=0, queue_limit=0))
+
+    courier = models.Courier(id=1, name="C1", email="c1@example.com", lat=0, lng=0)
+    async with make_client(courier) as client:
+        response = await client.post("/orders/", json={"restaurant_id": 1, "customer_name": "Cliente"})
+    assert response.status_code == 200
+
+    async with TestingSessionLocal() as db:
+        order = await db.get(models.Order, response.json()["id"])
+    # Sem dono: a próxima passada de recuperação coloca o pedido na fila
+    assert order.status == "SEARCHING"
+    assert order.dispatch_owner is None
+
+
+@pytest.mark.asyncio
+async def test_bulk_create_rejects_items_beyond_dispatch_queue_room(db_session: AsyncSession, monkeypatch):
+    from backend.scheduler import DispatchScheduler
+
+    db_session.add(models.Restaurant(id=1, name="R1", lat=0, lng=0))
+    await db_session.commit()
+    scheduler = DispatchScheduler(workers=0, queue_limit=3)
+    monkeypatch.setattr(orders_router, "dispatch_scheduler", scheduler)
+
+    items = [{"restaurant_id": 1, "customer_name": f"Cliente {i}"} for i in range(5)]
+    courier = models.Courier(id=1, name="C1", email="c1@example.com", lat=0, lng=0)
+    async with make_client(courier) as client:
+        response = await client.post("/orders/bulk", json=items)
+    assert response.status_code == 200
+    body = response.json()
+    assert (body["created"], body["failed"]) == (3, 2)
+    assert [r["error"] is None for r in body["results"]] == [True, True, True, False, False]
+    assert len(scheduler) == 3
+    async with TestingSessionLocal() as db:
+        assert len((await db.execute(select(models.Order))).scalars().all()) == 3
@@ -0,0 +1,90 @@
+import httpx
+import pytest
+from fastapi import FastAPI
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from backend import models
+from backend.db import get_db
+from backend.principals import Principal, PrincipalCache, principal_cache, resolve_principal
+from backend.routers import auth
+from tests.conftest import TestingSessionLocal, count_statements
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_cache_expires_evicts_and_invalidates():
+    clock = FakeClock()
+    cache = PrincipalCache(ttl=10, max_size=2, clock=clock)
+    for i in (1, 2):
+        cache.put(Principal(i, f"u{i}@example.com", f"U{i}", "CUSTOMER"))
+    assert cache.get("u1@example.com").user_id == 1
+
+    # u2 é o menos recente e sai
+    cache.put(Principal(3, "u3@example.com", "U3", "CUSTOMER"))
+    assert cache.get("u2@example.com") is None
+    assert len(cache) == 2
+
+    cache.invalidate("u1@example.com")
+    assert cache.get("u1@example.com") is None
+
+    clock.now = 10
+    assert cache.get("u3@example.com") is None
+    assert len(cache) == 0
+
+
+@pytest.mark.asyncio
+async def test_principal_resolves_from_claims_then_cache(db_session: AsyncSession):
+    principal_cache.clear()
+    user = models.User(id=1, email="c1@example.com", hashed_password="x", name="C1", role="COURIER")
+    courier = models.Courier(id=7, user_id=1, name="C1", email="c1@example.com", lat=0, lng=0)
+    db_session.add_all([user, courier])
+    await db_session.commit()
+
+    async with TestingSessionLocal() as db:
+        with count_statements() as statements:
+            claims = Principal(1, "c1@example.com", "C1", "COURIER", courier_id=7).claims()
+            assert (await resolve_principal(db, claims)).courier_id == 7
+        assert statements == []
+
+        # Token antigo, só com o email: uma consulta e depois o cache
+        with count_statements() as statements:
+            for _ in range(3):
+                principal = await resolve_principal(db, {"sub": "c1@example.com"})
+        assert len(statements) == 1
+        assert (principal.user_id, principal.role, principal.courier_id) == (1, "COURIER", 7)
+
+        principal_cache.invalidate("c1@example.com")
+        with count_statements() as statements:
+            await resolve_principal(db, {"sub": "c1@example.com"})
+        assert len(statements) == 1
+        assert await resolve_principal(db, {"sub": "nobody@example.com"}) is None
+
+
+@pytest.mark.asyncio
+async def test_me_needs_no_query_with_a_fresh_token(db_session: AsyncSession):
+    app = FastAPI()
+    app.include_router(auth.router)
+
+    async def override_get_db():
+        async with TestingSessionLocal() as db:
+            yield db
+
+    app.dependency_overrides[get_db] = override_get_db
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+        response = await client.post("/register", json={
+            "email": "r1@example.com", "password": "secret", "name": "R1", "role": "RESTAURANT"
+        })
+        assert response.status_code == 200
+        headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+        with count_statements() as statements:
+            me = (await client.get("/me", headers=headers)).json()
+        assert statements == []
+        assert me["user"]["email"] == "r1@example.com"
+        assert me["restaurant_id"] is not None
@@ -0,0 +1,39 @@
+import pytest
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from backend import models
+from backend.registry import CourierRegistry
+from backend.spatial import CourierIndex
+from tests.conftest import TestingSessionLocal
+
+
+@pytest.mark.asyncio
+async def test_registry_feeds_index_and_reconciles(db_session: AsyncSession):
+    db_session.add_all([
+        models.Courier(id=1, name="C1", email="c1@example.com", lat=0.0, lng=0.0, available=True),
+        models.Courier(id=2, name="C2", email="c2@example.com", lat=0.0, lng=0.01, available=False),
+    ])
+    await db_session.commit()
+
+    index = CourierIndex()
+    registry = CourierRegistry(index=index, session_factory=TestingSessionLocal)
+    await registry.warm()
+    assert len(registry) == 2
+    # Só os disponíveis entram no índice
+    assert 1 in index and 2 not in index
+
+    registry.set_available(2, True)
+    registry.set_location(1, 0.005, 0.005)
+    assert index.position(1) == (0.005, 0.005)
+    assert sorted(registry.snapshot()[0].tolist()) == [1, 2]
+
+    # Mudanças feitas direto no banco chegam pela reconciliação
+    courier2 = await db_session.get(models.Courier, 2)
+    await db_session.delete(courier2)
+    db_session.add(models.Courier(id=3, name="C3", email="c3@example.com", lat=0.02, lng=0.0, available=True))
+    await db_session.commit()
+
+    assert await registry.reconcile() == {"added": 1, "updated": 0, "removed": 1}
+    assert sorted(registry.snapshot()[0].tolist()) == [1, 3]
+    # A posição ao vivo ainda não gravada vence a do banco
+    assert index.position(1) == (0.005, 0.005)
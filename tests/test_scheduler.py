@@ -0,0 +1,77 @@
+import asyncio
+import datetime
+
+import pytest
+
+from backend.scheduler import DispatchQueueFull, DispatchScheduler
+
+
+class FakeEngine:
+    def __init__(self):
+        self.started = {}
+        self.offered = {}
+
+    def submit(self, order_id, **kwargs):
+        loop = asyncio.get_running_loop()
+        done = loop.create_future()
+        self.started[order_id] = done
+        self.offered[order_id] = loop.create_future()
+        done.add_done_callback(lambda _: self.offer(order_id))
+        return done
+
+    def first_offer(self, order_id):
+        return self.offered[order_id]
+
+    def offer(self, order_id):
+        if not self.offered[order_id].done():
+            self.offered[order_id].set_result(None)
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+@pytest.mark.asyncio
+async def test_workers_bound_starts_and_take_oldest_first():
+    engine = FakeEngine()
+    scheduler = DispatchScheduler(workers=2, queue_limit=3, sla_seconds=60, engine=engine)
+    now = datetime.datetime.utcnow()
+    try:
+        # Enfileira antes dos workers rodarem, para a prioridade decidir a ordem
+        for order_id, age in [(1, 5), (2, 30), (3, 10)]:
+            scheduler.submit(order_id, created_at=now - datetime.timedelta(seconds=age))
+        assert not scheduler.submit(3)
+        assert scheduler.full()
+        # O limite vale para todos: nada passa da capacidade da fila
+        with pytest.raises(DispatchQueueFull):
+            scheduler.submit(4, created_at=now)
+        assert len(scheduler) == 3
+
+        await settle()
+        assert list(engine.started) == [2, 3]
+        assert scheduler.stats()["in_flight"] == 2
+        assert scheduler.stats()["queued"] == 1
+        assert scheduler.submit(4, created_at=now)
+
+        # Um SLA mais curto passa na frente de pedidos mais antigos
+        scheduler.submit(5, created_at=now, sla_seconds=0)
+        # Oferta enviada: o worker segue para o próximo sem esperar o motoboy responder
+        engine.offer(2)
+        await settle()
+        assert list(engine.started) == [2, 3, 5]
+        assert (scheduler.stats()["in_flight"], scheduler.stats()["dispatching"]) == (2, 3)
+
+        engine.started[3].set_exception(RuntimeError("boom"))
+        engine.started[5].cancel()
+        await settle()
+        assert list(engine.started) == [2, 3, 5, 1, 4]
+
+        engine.started[2].set_result("ASSIGNED")
+        await settle()
+        stats = scheduler.stats()
+        assert (stats["completed"], stats["failed"], stats["queued"], stats["rejected"]) == (3, 1, 0, 1)
+        assert (stats["in_flight"], stats["dispatching"]) == (2, 2)
+    finally:
+        await scheduler.stop()
+    assert len(scheduler) == 0
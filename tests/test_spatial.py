@@ -0,0 +1,49 @@
+import random
+from backend.geo import haversine_km
+from backend.spatial import CourierIndex
+
+
+def brute_force(points, lat, lng, radius_km):
+    found = [(cid, haversine_km(lat, lng, plat, plng)) for cid, (plat, plng) in points.items()]
+    return sorted((item for item in found if item[1] <= radius_km), key=lambda item: item[1])
+
+
+def test_within_matches_linear_scan():
+    rng = random.Random(42)
+    index = CourierIndex()
+    points = {}
+    for cid in range(500):
+        points[cid] = (-23.55 + rng.uniform(-0.2, 0.2), -46.63 + rng.uniform(-0.2, 0.2))
+        index.insert(cid, *points[cid])
+
+    for radius in [1, 2, 3, 5, 10]:
+        assert index.within(-23.55, -46.63, radius) == brute_force(points, -23.55, -46.63, radius)
+
+
+def test_move_and_remove_are_incremental():
+    index = CourierIndex()
+    index.insert(1, 0.0, 0.0)
+    index.insert(2, 0.5, 0.5)
+    assert [cid for cid, _ in index.within(0.0, 0.0, 1)] == [1]
+
+    index.move(2, 0.001, 0.001)
+    index.remove(1)
+    assert [cid for cid, _ in index.within(0.0, 0.0, 1)] == [2]
+    assert 1 not in index and len(index) == 1
+
+
+def test_nearest_returns_k_closest():
+    index = CourierIndex()
+    for cid in range(10):
+        index.insert(cid, 0.0, cid * 0.05)
+
+    assert [cid for cid, _ in index.nearest(0.0, 0.0, 3)] == [0, 1, 2]
+    assert [cid for cid, _ in index.nearest(0.0, 0.0, 3, max_radius_km=6)] == [0, 1]
+
+
+def test_sync_drops_missing_couriers():
+    index = CourierIndex()
+    index.sync([(1, 0.0, 0.0), (2, 0.0, 0.01)])
+    index.sync([(2, 0.0, 0.02)])
+    assert 1 not in index
+    assert index.position(2) == (0.0, 0.02)
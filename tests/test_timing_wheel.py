@@ -0,0 +1,28 @@
+import random
+from backend.timing_wheel import TimingWheel
+
+
+def test_timers_fire_on_their_tick_across_levels():
+    # Small wheel so that cascading and out-of-range deadlines are exercised
+    wheel = TimingWheel(tick=1.0, slots=4, levels=2)
+    rng = random.Random(3)
+    deadlines = {i: rng.randint(1, 60) for i in range(200)}
+    for payload, deadline in deadlines.items():
+        wheel.schedule(deadline, payload)
+
+    fired = {}
+    for now in range(1, 61):
+        for payload in wheel.advance(now):
+            fired[payload] = now
+    assert fired == deadlines
+    assert len(wheel) == 0
+
+
+def test_cancel_and_large_jumps():
+    wheel = TimingWheel(tick=0.05, start=100.0)
+    keep = wheel.schedule(120.0, "keep")
+    drop = wheel.schedule(110.0, "drop")
+    assert wheel.cancel(drop) and not wheel.cancel(drop)
+    assert wheel.advance(119.9) == []
+    assert wheel.advance(500.0) == ["keep"]
+    assert not wheel.cancel(keep)
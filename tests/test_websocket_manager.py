@@ -0,0 +1,135 @@
+import asyncio
+import time
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from starlette.websockets import WebSocketDisconnect
+
+from backend.bus import InMemoryBus
+from backend.presence import PresenceRegistry
+from backend.registry import courier_registry
+from backend.routers import websocket as websocket_router
+from backend.websocket_manager import ConnectionManager
+from tests.conftest import FakeWebSocket
+
+
+@pytest.mark.asyncio
+async def test_broadcast_does_not_wait_for_slow_clients():
+    manager = ConnectionManager(InMemoryBus(), queue_size=10)
+    slow, fast = FakeWebSocket(delay=0.5), FakeWebSocket()
+    slow_session = await manager.connect(slow, "courier_1", "COURIER")
+    await manager.connect(fast, "courier_2", "COURIER")
+
+    started = time.perf_counter()
+    await manager.notify_order_update(1, "ASSIGNED")
+    assert time.perf_counter() - started < 0.1
+    await asyncio.sleep(0.01)
+    assert len(fast.sent) == 1 and not slow.sent
+    assert slow_session.writer.stats()["depth"] == 0  # em envio
+
+    await manager.disconnect("courier_1")
+    await manager.disconnect("courier_2")
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("policy, expected", [
+    ("drop_oldest", [(1, "C"), (2, "A"), (2, "B"), (3, "A")]),
+    ("coalesce", [(1, "C"), (1, "X"), (2, "B"), (3, "A")]),
+])
+async def test_full_queue_policies(policy, expected):
+    manager = ConnectionManager(InMemoryBus(), queue_size=3, queue_policy=policy)
+    ws = FakeWebSocket(delay=0.05)
+    await manager.connect(ws, "restaurant_1", "RESTAURANT")
+    # A primeira mensagem sai da fila na hora e fica "em envio"
+    await manager.notify_order_update(1, "C")
+    await asyncio.sleep(0)
+    for order_id, status in [(1, "X"), (2, "A"), (2, "B"), (3, "A")]:
+        await manager.notify_order_update(order_id, status)
+    await manager.flush()
+    assert [(m["order_id"], m["status"]) for m in ws.sent] == expected
+    await manager.disconnect("restaurant_1")
+
+
+@pytest.mark.asyncio
+async def test_disconnect_policy_evicts_slow_consumer():
+    manager = ConnectionManager(InMemoryBus(), queue_size=2, queue_policy="disconnect")
+    ws = FakeWebSocket(delay=1.0)
+    await manager.connect(ws, "courier_1", "COURIER")
+    for order_id in range(4):
+        await manager.withdraw_offer(1, order_id)
+    await asyncio.sleep(0.01)
+    assert "courier_1" not in manager.active_connections
+    assert manager.stats()["evicted"] == 1
+    assert ws.closed_with == 1013
+
+
+@pytest.mark.asyncio
+async def test_sessions_per_user_and_idle_reaping():
+    now = [0.0]
+    manager = ConnectionManager(InMemoryBus(), presence=PresenceRegistry(clock=lambda: now[0], idle_timeout=30))
+    phone, tablet = FakeWebSocket(), FakeWebSocket()
+    phone_session = await manager.connect(phone, "courier_1", "COURIER")
+    tablet_session = await manager.connect(tablet, "courier_1", "COURIER")
+
+    # As duas sessões recebem; nenhuma substitui a outra
+    await manager.withdraw_offer(1, 10)
+    await manager.flush()
+    assert len(phone.sent) == len(tablet.sent) == 1
+
+    # Caladas há mais da metade do timeout: o servidor pede sinal de vida
+    now[0] = 20.0
+    assert manager.ping_quiet() == 2
+    await manager.flush()
+    assert phone.sent[-1] == tablet.sent[-1] == {"type": "PING"}
+    # Só o tablet responde
+    now[0] = 25.0
+    manager.touch(tablet_session)
+    now[0] = 40.0
+    assert manager.ping_quiet() == 1
+    assert manager.reap() == 1
+    await asyncio.sleep(0)
+    assert phone.closed_with == 1001 and tablet.closed_with is None
+    assert manager.presence.is_courier_online(1)
+
+    await manager.disconnect("courier_1", tablet_session)
+    assert not manager.presence.is_courier_online(1)
+    assert phone_session.writer.closed
+
+
+@pytest.mark.asyncio
+async def test_polling_counts_as_presence_until_it_stops():
+    now = [0.0]
+    presence = PresenceRegistry(clock=lambda: now[0], idle_timeout=30, poll_ttl=20)
+    manager = ConnectionManager(InMemoryBus(), presence=presence)
+    changes = []
+    presence.on_change(lambda user_id, online: changes.append((user_id, online)))
+
+    manager.poll("courier_1")
+    assert presence.is_courier_online(1)
+    # Uma espera de long-poll que termina não derruba quem acabou de consultar
+    session = await manager.connect(FakeWebSocket(), "courier_1", "COURIER")
+    await manager.disconnect("courier_1", session)
+    assert presence.is_courier_online(1)
+
+    now[0] = 15.0
+    manager.poll("courier_1")
+    now[0] = 30.0
+    assert manager.reap() == 0
+    assert presence.is_courier_online(1)
+    now[0] = 40.0
+    manager.reap()
+    assert not presence.is_courier_online(1)
+    assert changes == [("courier_1", True), ("courier_1", False)]
+
+
+def test_courier_route_rejects_non_numeric_ids():
+    app = FastAPI()
+    app.include_router(websocket_router.router)
+    with TestClient(app) as client, pytest.raises(WebSocketDisconnect):
+        with client.websocket_connect("/ws/courier/abc"):
+            pass
+
+    # Um id malformado vindo do barramento é ignorado sem derrubar o listener
+    websocket_router._sync_courier_presence("courier_abc", True)
+    assert "abc" not in courier_registry